@@ -1,85 +1,664 @@
 """
 Caterpillar consumes data from Kafka, digests that data (to ensure it passes schema validation), transforms those records and adds them to the Postgres database.
+
+Settings are read from environment variables:
+
+    CATERPILLAR_WRITE_MODE      'bulk' (default) writes records with multi-row INSERTs,
+                                    one transaction per chunk. 'row' inserts and
+                                    commits each record on its own.
+    CATERPILLAR_MAX_BATCH_SIZE  The most records written by one bulk INSERT /
+                                    transaction (default 500)
+    CATERPILLAR_RUN_MODE        'minute' (default) polls Kafka 45 times, a second
+                                    apart, then exits. 'stream' runs until stopped,
+                                    polling as fast as data arrives. 'pipeline'
+                                    streams too, but fetches, validates and writes
+                                    batches at the same time (see
+                                    argus.caterpillar.Pipeline). Also set by
+                                    'entrypoint.py run caterpillar --pipeline'.
+    CATERPILLAR_IDLE_BACKOFF_MAX  In 'stream' and 'pipeline' modes, the longest pause
+                                    (in seconds) between polls that return nothing
+                                    (default 2)
+    CATERPILLAR_PIPELINE_DEPTH  In 'pipeline' mode, how many batches can wait
+                                    between each stage (default 2)
+    CATERPILLAR_TABLE_LAYOUT    'json' (default) stores each record as one json value.
+                                    'typed' stores heartbeats with a column per
+                                    value (see argus.common.data.tables).
+                                    'entrypoint.py run migrate' converts an
+                                    existing json table.
+    CATERPILLAR_PARTITIONING    'none' (default), 'daily' or 'hourly'. With the typed
+                                    layout, splits the heartbeat table into a
+                                    partition per period, so that old data can be
+                                    dropped cheaply by the Janitor.
+    CATERPILLAR_PARTITIONS_AHEAD  How many periods ahead partitions are created
+                                    (default 3)
+    CATERPILLAR_ROLLUPS         Comma separated rollup periods kept up to date as
+                                    heartbeats are written (default 'minute,hour',
+                                    '' for none). 'entrypoint.py run rollup'
+                                    rebuilds them from the heartbeat history.
+    CATERPILLAR_DEAD_LETTER     'true' (default) keeps every rejected record in the
+                                    'heartbeat_rejected' table, written once per
+                                    batch, with the reason and its Kafka
+                                    coordinates. 'entrypoint.py run replay' runs
+                                    them through validation again.
+    CATERPILLAR_OFFSET_STORE    'postgres' (default) stores the Kafka offsets reached
+                                    in the 'kafka_offsets' table, in the
+                                    transaction that finishes each batch, and
+                                    resumes from them (see below). 'kafka' only
+                                    uses the consumer group's committed offsets.
+    CATERPILLAR_NOTIFY          'true' (default) sends a Postgres NOTIFY on the
+                                    tables.NOTIFY_CHANNEL channel for each producer
+                                    with new records, after every committed batch,
+                                    so monitors can LISTEN rather than poll.
+    CATERPILLAR_WATCH           'true' (default) keeps running statistics of each
+                                    producer's load as records are conformed, and
+                                    raises alerts when they cross thresholds (see
+                                    argus.caterpillar.ProducerWatch for the WATCH_
+                                    settings).
+
+The newest heartbeat from each producer is also kept in the 'heartbeat_latest' table,
+upserted in the same transaction as the history it belongs to, as are the per minute
+and per hour aggregates of each producer's heartbeats in the rollup tables.
+
+Each stage of a batch (polling Kafka, decoding, validating and writing) is timed,
+and the batch sizes, rejected records and consumer lag per partition are counted,
+in the application's metrics (see argus.common.Metrics for how to publish them).
+
+In every run mode Kafka offsets are committed only after the matching records have
+been committed to Postgres. If the write fails the consumer is rewound, so the same
+records are fetched again rather than lost. Each record is stored once, however many
+times it is written, as the heartbeat table is unique on Kafka partition and offset
+(see argus.common.data.tables), and rollups only count records newly stored. With
+CATERPILLAR_OFFSET_STORE=postgres the offsets following each batch are written in
+the same transaction as the end of the batch, and partitions are resumed from them
+when assigned, so a crash or a new consumer group neither loses nor re-reads records.
+
+With CATERPILLAR_WATCH on, the alerts raised while a batch is conformed are written
+to the 'heartbeat_alerts' table in the transaction that finishes it, and the
+producers' statistics are checkpointed to the 'producer_stats' table in the same
+way, so a restart carries on from them. While no records arrive, producers are
+still checked for missed heartbeats between polls.
+
+Rejected records are counted by reason and by producer, and gathered while a batch
+is conformed, to be written to the dead-letter table with one INSERT, in the
+transaction that finishes the batch and stores its offsets:
+
+    >>> from argus.common.MemoryKafka import MemoryBroker, MemoryKafkaConnection
+    >>> from argus.common.MemoryPostgres import MemoryPostgresConnection
+    >>> broker = MemoryBroker()
+    >>> producer = MemoryKafkaConnection(None, broker)
+    >>> producer.send("heartbeat", {"cpus": {}}, producer_id="host-1")
+    >>> producer.send("uptime", {}, producer_id="host-2")
+    >>> caterpillar = Caterpillar(
+    ...     kafka_connection=lambda app: MemoryKafkaConnection(app, broker),
+    ...     postgres_connection=MemoryPostgresConnection,
+    ... )
+    >>> caterpillar.log_level = LogLevel.CRITICAL
+    >>> caterpillar.kafka.start_consumer()
+    >>> caterpillar.postgres.connect()
+    >>> rejected = []
+    >>> messages = caterpillar.fetch_batch()
+    >>> caterpillar.conform_data(messages, rejected)
+    []
+    >>> [(record[0], record[2], record[6]) for record in rejected]
+    [('schema', 'host-1', 0), ('deserializer', 'host-2', 1)]
+    >>> caterpillar.write_batch([], rejected, messages)
+    True
+    >>> database = caterpillar.postgres.db_connection
+    >>> database.committed, database.commits
+    ({'heartbeat_rejected': 2, 'kafka_offsets': 1}, 1)
+    >>> caterpillar.producer_rejects.values
+    {('host-1',): 1, ('host-2',): 1}
+
+Messages that decode to anything but an object are rejected as 'decode' as well:
+
+    >>> key = json.dumps({"key": "host-4"}).encode("ascii")
+    >>> for value in (b"[1]", b'"x"'):
+    ...     _ = broker.produce(key, value)
+    >>> rejected = []
+    >>> caterpillar.conform_data(caterpillar.fetch_batch(), rejected)
+    []
+    >>> [(record[0], record[2], record[6]) for record in rejected]
+    [('decode', 'host-4', 2), ('decode', 'host-4', 3)]
+
+Heartbeats sent as deltas (see KAFKA_DELTA_KEYFRAMES) are rebuilt before they are
+validated. A delta whose keyframe has not been seen, such as one read just after a
+restart, is rejected as 'keyframe', until the producer's next keyframe:
+
+    >>> times = dict.fromkeys(delta.CPU_TIME_FIELDS, "1.00")
+    >>> producer.env["delta_keyframes"] = 2
+    >>> producer.start_producer()
+    >>> for load in ("10", "20", "30"):
+    ...     producer.send("heartbeat", {"cpus": {"load": [load], "times": times}},
+    ...                   producer_id="host-3")
+    >>> messages = caterpillar.fetch_batch()
+    >>> [json.loads(message.value)["deserializer"] for message in messages]
+    ['heartbeat', 'heartbeat_delta', 'heartbeat']
+    >>> [item["conformed"]["cpus"]["load"]
+    ...  for item in caterpillar.conform_data(messages)]
+    [[10], [20], [30]]
+    >>> caterpillar.deltas = delta.DeltaDecoder()
+    >>> rejected = []
+    >>> [item["conformed"]["cpus"]["load"]
+    ...  for item in caterpillar.conform_data(messages[1:], rejected)]
+    [[30]]
+    >>> [record[0] for record in rejected]
+    ['keyframe']
 """
 
-from argus.common.Common import CommonAppFramework, LogLevel
-from argus.common.data import schema
+from argus.common.Common import (
+    CommonAppFramework,
+    LogLevel,
+    settings_from_environment,
+)
+from argus.caterpillar.ProducerWatch import ProducerWatch
+from argus.common.data import delta, schema, tables
 from argus.common.KafkaConnection import KafkaConnection
+from argus.common.Metrics import SIZE_BUCKETS
 from argus.common.PostgresConnection import PostgresConnection
+import psycopg2
+from psycopg2.extras import execute_values
 import json
-from time import sleep
+from datetime import datetime, timezone
+from time import monotonic, perf_counter, sleep
+import signal
 import sys
 
+environment_variable_map = {
+    "write_mode": "CATERPILLAR_WRITE_MODE",
+    "max_batch_size": "CATERPILLAR_MAX_BATCH_SIZE",
+    "run_mode": "CATERPILLAR_RUN_MODE",
+    "idle_backoff_max": "CATERPILLAR_IDLE_BACKOFF_MAX",
+    "table_layout": "CATERPILLAR_TABLE_LAYOUT",
+    "partitioning": "CATERPILLAR_PARTITIONING",
+    "partitions_ahead": "CATERPILLAR_PARTITIONS_AHEAD",
+    "notify": "CATERPILLAR_NOTIFY",
+    "rollups": "CATERPILLAR_ROLLUPS",
+    "pipeline_depth": "CATERPILLAR_PIPELINE_DEPTH",
+    "dead_letter": "CATERPILLAR_DEAD_LETTER",
+    "offset_store": "CATERPILLAR_OFFSET_STORE",
+    "watch": "CATERPILLAR_WATCH",
+}
+
+environment_variable_defaults = {
+    "write_mode": "bulk",
+    "max_batch_size": 500,
+    "run_mode": "minute",
+    "idle_backoff_max": 2.0,
+    "table_layout": "json",
+    "partitioning": "none",
+    "partitions_ahead": 3,
+    "notify": True,
+    "rollups": "minute,hour",
+    "pipeline_depth": 2,
+    "dead_letter": True,
+    "offset_store": "postgres",
+    "watch": True,
+}
+
+# the first pause after an empty poll in 'stream' mode, doubling up to the maximum
+IDLE_BACKOFF_START = 0.05
+# how often (in seconds) a streaming Caterpillar checks partitions exist ahead
+PARTITION_CHECK_INTERVAL = 600
+# producers given their own reject counter; later ones are counted as 'other', so
+# a flood of made up producer ids can not grow the metrics without limit
+MAX_REJECT_PRODUCERS = 100
+
+
+def rollup_tables(periods):
+    """
+    Returns a RollupTable for each period in the comma separated 'periods'.
+    """
+    return [
+        tables.RollupTable(period.strip())
+        for period in periods.split(",")
+        if period.strip() != ""
+    ]
+
 
 class Caterpillar(CommonAppFramework):
-    def __init__(self):
+    def __init__(
+        self,
+        kafka_connection=KafkaConnection,
+        postgres_connection=PostgresConnection,
+        run_mode=None,
+    ):
         """
-        Creates both Kafta and Postgres connection objects
+        Creates both Kafta and Postgres connection objects.
+        'kafka_connection' and 'postgres_connection' are called with the application
+        to build those objects, and can be replaced by stand-ins with the same
+        methods (such as argus.common.MemoryKafka) for testing.
+        'run_mode', if given, overrides CATERPILLAR_RUN_MODE.
         """
         super().__init__()
-        self.kafka = KafkaConnection(self)
-        self.schema = schema.full_colander_set()
-        self.postgres = PostgresConnection(self)
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+        if run_mode is not None:
+            self.settings["run_mode"] = run_mode
+        self.kafka = kafka_connection(self)
+        self.schema = schema.compiled_colander_set()
+        self.table = tables.heartbeat_table(
+            self.settings["table_layout"], self.settings["partitioning"]
+        )
+        self.latest = tables.LatestHeartbeatTable()
+        self.rollups = rollup_tables(self.settings["rollups"])
+        self.dead_letters = tables.DeadLetterTable()
+        self.offsets = tables.ConsumerOffsetTable()
+        self.alert_table = tables.AlertTable()
+        self.producer_stats = tables.ProducerStatsTable()
+        # rebuilds heartbeats sent as deltas (see argus.common.data.delta)
+        self.deltas = delta.DeltaDecoder()
+        self.watch = ProducerWatch() if self.settings["watch"] else None
+        # alerts sent to Kafka go through a producer of their own
+        self.alert_kafka = None
+        if self.watch is not None and self.watch.settings["alerts"] == "kafka":
+            self.alert_kafka = kafka_connection(self)
+            self.alert_kafka.env["topic"] = self.watch.settings["alert_topic"]
+        self.partitions_checked = monotonic()
+        self.postgres = postgres_connection(self)
+        self._create_metrics()
+
+    def _create_metrics(self):
+        self.stage_seconds = self.metrics.histogram(
+            "caterpillar_stage_seconds",
+            "Seconds spent on each stage of a batch: poll, decode, validate, write.",
+            ["stage"],
+        )
+        self.batch_size = self.metrics.histogram(
+            "caterpillar_batch_size", "Messages per batch fetched.", buckets=SIZE_BUCKETS
+        )
+        self.messages = self.metrics.counter(
+            "caterpillar_messages_total", "Messages fetched and written.", ["outcome"]
+        )
+        self.rejects = self.metrics.counter(
+            "caterpillar_rejects_total", "Records rejected, by reason.", ["reason"]
+        )
+        self.producer_rejects = self.metrics.counter(
+            "caterpillar_producer_rejects_total",
+            "Records rejected, by producer.",
+            ["producer"],
+        )
+        self.lag = self.metrics.gauge(
+            "caterpillar_consumer_lag",
+            "Messages on each assigned partition not yet fetched.",
+            ["partition"],
+        )
+        self.alert_changes = self.metrics.counter(
+            "caterpillar_alerts_total",
+            "Producer alerts raised and cleared, by kind.",
+            ["kind", "state"],
+        )
 
     def run(self):
         """
         Connects to both Kafka and Postgres, checking that the Postgres table 
-        required is in place and takes around a minute to fetch objects from Kafka, 
-        check conformance and submit to Postgres.
+        required is in place, then fetches objects from Kafka, checks conformance
+        and submits them to Postgres. In 'minute' run mode this takes around a
+        minute; in 'stream' and 'pipeline' run modes it continues until stopped.
         """
         # start the sevices we will need
-        self.kafka.start_consumer()
+        self.metrics.start()
+        self.kafka.start_consumer(
+            stored_offsets=self.stored_offsets
+            if self.settings["offset_store"] == "postgres"
+            else None
+        )
         self.postgres.connect()
+        if self.alert_kafka is not None:
+            self.alert_kafka.start_producer(codec="json")
         # check we have the tables in place
         self._check_postgres()
         # poll and process for results
-        for i in range(45):
-            results = self.kafka.fetch()
-            self.log("Caterpillar finds {} result(s)".format(len(results)))
-            results = self.conform_data(results)
-            self.commit_to_db(results)
-            sys.stdout.flush()
-            sleep(1)
+        if self.settings["run_mode"] == "stream":
+            self.stream()
+        elif self.settings["run_mode"] == "pipeline":
+            from argus.caterpillar.Pipeline import Pipeline
+
+            Pipeline(self).run()
+        else:
+            for i in range(45):
+                self.process_batch()
+                sys.stdout.flush()
+                sleep(1)
+        if self.watch is not None:
+            # so a restart carries on from where this run stopped
+            self.watch.checkpoint_soon()
+            self.idle()
+        self.kafka.close()
+        if self.alert_kafka is not None:
+            self.alert_kafka.close()
+        self.postgres.disconnect()
+        self.metrics.stop()
+
+    def stream(self):
+        """
+        Processes batches until interrupted or sent SIGTERM. Polls again at once
+        while data is arriving, and backs off (up to 'idle_backoff_max' seconds)
+        while the topic is idle or the database is unavailable.
+        """
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        idle_wait = 0
+        try:
+            while self.running:
+                if monotonic() - self.partitions_checked >= PARTITION_CHECK_INTERVAL:
+                    self.maintain_partitions()
+                fetched = self.process_batch()
+                if fetched:
+                    idle_wait = 0
+                    continue
+                if fetched is None:
+                    self._reconnect_postgres()
+                idle_wait = min(
+                    max(idle_wait * 2, IDLE_BACKOFF_START),
+                    self.settings["idle_backoff_max"],
+                )
+                sleep(idle_wait)
+        except KeyboardInterrupt:
+            pass
+        self.log("Caterpillar stream stopped", LogLevel.INFO)
+
+    def stop(self, *args):
+        """
+        Asks a running stream() to finish after its current batch. Also used as the
+        SIGTERM handler.
+        """
+        self.running = False
+
+    def process_batch(self):
+        """
+        Fetches one batch of messages from Kafka, conforms them and commits them to
+        Postgres. Kafka offsets are committed only once the batch is in the
+        database; if the write fails the consumer is rewound to the start of the
+        batch so it is fetched again.
+        Returns the number of messages fetched, or None if the write failed.
+        """
+        messages = self.fetch_batch()
+        if len(messages) == 0:
+            self.idle()
+            self.metrics.publish()
+            return 0
+        rejected = []
+        results = self.conform_data(messages, rejected)
+        if not self.write_batch(results, rejected, messages):
+            self.kafka.rewind(messages)
+            self.metrics.publish()
+            return None
+        self.commit_offsets(messages)
+        self.metrics.publish()
+        return len(messages)
+
+    def fetch_batch(self):
+        """
+        Fetches one batch of messages from Kafka, without committing their offsets.
+        The batch is the list the consumer returned when the poll was from one
+        partition, and those lists joined when it spans several.
+        """
+        start = perf_counter()
+        batches = list(self.kafka.fetch_batches(commit=False))
+        if len(batches) == 1:
+            messages = batches[0]
+        else:
+            messages = [message for batch in batches for message in batch]
+        self.stage_seconds.observe(perf_counter() - start, ("poll",))
+        if len(messages) > 0:
+            self.log("Caterpillar finds {} result(s)", LogLevel.VERBOSE, len(messages))
+            self.batch_size.observe(len(messages))
+            self.messages.inc(len(messages), ("fetched",))
+        return messages
+
+    def write_batch(self, results, rejected=None, messages=()):
+        """
+        Writes conformed 'results', and the dead letters 'rejected' while
+        conforming them, to Postgres (see commit_to_db), with the offsets that
+        follow the fetched 'messages' they came from.
+        Returns True if they were written.
+        """
+        start = perf_counter()
+        offsets = None
+        if self.settings["offset_store"] == "postgres":
+            offsets = self.offsets.rows(messages)
+        written = self.commit_to_db(results, rejected=rejected, offsets=offsets)
+        self.stage_seconds.observe(perf_counter() - start, ("write",))
+        return written
+
+    def idle(self):
+        """
+        Called between polls that return nothing: checks producers for missed
+        heartbeats, and writes any alerts and checkpoint due, which would otherwise
+        wait for the next batch.
+        """
+        if self.watch is None:
+            return
+        self.watch.sweep()
+        if len(self.watch.alerts) > 0 or (
+            len(self.watch.changed) > 0 and self.watch.checkpoint_due()
+        ):
+            self.finish_batch([])
+
+    def commit_offsets(self, messages):
+        """
+        Commits the Kafka offsets of 'messages', once they are written, and
+        updates the consumer lag metrics.
+        """
+        committed = self.kafka.commit(messages)
+        for partition, lag in self.kafka.lag().items():
+            self.lag.set(lag, (str(partition),))
+        return committed
+
+    def stored_offsets(self, topic, partitions):
+        """
+        Returns {partition: offset} stored in the database for 'topic', for those
+        of 'partitions' that have one. Called by the Kafka consumer as partitions
+        are assigned, on a connection of its own from the pool.
+        """
+        with self.postgres.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(self.offsets.select_sql, (topic, list(partitions)))
+            stored = dict(cursor.fetchall())
+            cursor.close()
+            connection.commit()
+        return stored
+
+    def _reconnect_postgres(self):
+        """
+        Replaces the Postgres connection if it has been closed or stopped answering.
+        """
+        self.postgres.ensure_connected()
 
     def _check_postgres(self):
         """
-        If the 'heartbeat' table does not exist, this will create that table.
+        If the 'heartbeat' table does not exist, this will create that table, in the
+        configured table layout. An existing table in a different layout is an
+        error, as it needs migrating first. A partitioned table is given its
+        partitions from the current period on, whether or not it was just created:
+
+        >>> from argus.common.MemoryKafka import MemoryBroker, MemoryKafkaConnection
+        >>> from argus.common.MemoryPostgres import MemoryPostgresConnection
+        >>> caterpillar = Caterpillar(
+        ...     kafka_connection=lambda app: MemoryKafkaConnection(app, MemoryBroker()),
+        ...     postgres_connection=MemoryPostgresConnection,
+        ... )
+        >>> caterpillar.log_level = LogLevel.CRITICAL
+        >>> caterpillar.table = tables.heartbeat_table("typed", "daily")
+        >>> caterpillar.postgres.connect()
+        >>> caterpillar._check_postgres()
+        >>> database = caterpillar.postgres.db_connection
+        >>> caterpillar.table.kafka_index in database.created
+        True
+        >>> now = datetime.now(timezone.utc)
+        >>> caterpillar.table.partition_name(now) in database.created
+        True
         """
         cursor = self.postgres.db_connection.cursor()
-        cursor.execute("SELECT current_database()")
-        database = cursor.fetchone()[0]
-        cursor.execute(
-            "SELECT EXISTS(SELECT * FROM information_schema.tables "
-            "WHERE table_name='heartbeat');"
-        )
-        if not cursor.fetchone()[0]:
+        layout = tables.existing_layout(cursor, self.table.name)
+        if layout is None:
             # then we need to make the table for the data to go into...
             self.log("Postgres database did not have heartbeat database. Creating..")
-            cursor.execute(
-                "CREATE TABLE heartbeat ("
-                "id serial NOT NULL PRIMARY KEY, "
-                "producer_id VARCHAR(200),"
-                "info json NOT NULL);"
-            )
+            self.table.create(cursor)
             self.postgres.db_connection.commit()
-            cursor.execute(
-                "CREATE INDEX producer_index ON heartbeat (" " producer_id );"
+        elif layout != self.table.layout or self.table.partitioned != (
+            tables.is_partitioned(cursor, self.table.name)
+        ):
+            issue = (
+                "The heartbeat table does not match the '{}' layout and '{}' "
+                "partitioning Caterpillar is set to use. Run "
+                "'entrypoint.py run migrate' to convert it.".format(
+                    self.table.layout, self.table.partitioning
+                )
             )
-            self.postgres.db_connection.commit()
+            self.log(issue, LogLevel.CRITICAL)
+            raise Exception(issue)
         else:
             self.log("Heatbeat database table is ready for use")
+        if tables.existing_layout(cursor, self.latest.name) is None:
+            self.log("Creating the latest heartbeat table from the heartbeat history")
+            self.latest.create(cursor)
+            cursor.execute(self.latest.fill_sql(self.table.name, self.table.layout))
+            self.postgres.db_connection.commit()
+        for rollup in self.rollups:
+            if tables.existing_layout(cursor, rollup.name) is None:
+                self.log(
+                    "Creating the {} table. Run 'entrypoint.py run rollup' to fill it "
+                    "from existing heartbeats.".format(rollup.name),
+                    LogLevel.INFO,
+                )
+                rollup.create(cursor)
+                self.postgres.db_connection.commit()
+        if self.settings["dead_letter"] and (
+            tables.existing_layout(cursor, self.dead_letters.name) is None
+        ):
+            self.log("Creating the {} table".format(self.dead_letters.name), LogLevel.INFO)
+            self.dead_letters.create(cursor)
+            self.postgres.db_connection.commit()
+        if self.settings["offset_store"] == "postgres" and (
+            tables.existing_layout(cursor, self.offsets.name) is None
+        ):
+            self.log("Creating the {} table".format(self.offsets.name), LogLevel.INFO)
+            self.offsets.create(cursor)
+            self.postgres.db_connection.commit()
+        if self.watch is not None:
+            self._check_watch_tables(cursor)
+        if not tables.index_exists(cursor, self.table.kafka_index):
+            self._add_kafka_index(cursor)
         cursor.close()
+        self.maintain_partitions()
 
-    def conform_data(self, data_list):
+    def _check_watch_tables(self, cursor):
+        """
+        Creates the alert and producer statistics tables the producer watch needs,
+        and restores its statistics from the last checkpoint.
+        """
+        if self.watch.settings["alerts"] == "postgres" and (
+            tables.existing_layout(cursor, self.alert_table.name) is None
+        ):
+            self.log("Creating the {} table".format(self.alert_table.name), LogLevel.INFO)
+            self.alert_table.create(cursor)
+            self.postgres.db_connection.commit()
+        if tables.existing_layout(cursor, self.producer_stats.name) is None:
+            self.log(
+                "Creating the {} table".format(self.producer_stats.name), LogLevel.INFO
+            )
+            self.producer_stats.create(cursor)
+            self.postgres.db_connection.commit()
+            return
+        cursor.execute(self.producer_stats.select_sql)
+        checkpoint = cursor.fetchall()
+        self.postgres.db_connection.commit()
+        self.watch.load(checkpoint)
+        self.log(
+            "Restored the statistics of {} producer(s)".format(len(checkpoint)),
+            LogLevel.INFO,
+        )
+
+    def _add_kafka_index(self, cursor):
+        """
+        Adds the unique index on Kafka coordinates to a heartbeat table created
+        before there was one. Without it records are still written, but can be
+        stored twice.
+        """
+        self.log(
+            "Indexing the {} table by Kafka partition and offset, so each record is "
+            "stored once. This reads the whole table.".format(self.table.name),
+            LogLevel.INFO,
+        )
+        try:
+            self.table.create_kafka_index(cursor)
+            self.postgres.db_connection.commit()
+        except psycopg2.IntegrityError as e:
+            self._rollback()
+            self.log(
+                "The {} table already holds some records more than once, so can not "
+                "be indexed by Kafka partition and offset, and records fetched again "
+                "will be stored again. Remove the duplicates and restart to index it. "
+                "{}".format(self.table.name, str(e)),
+                LogLevel.WARNING,
+            )
+
+    def maintain_partitions(self):
+        """
+        For a partitioned heartbeat table, creates any missing partitions from the
+        current period to 'partitions_ahead' periods in the future.
+        """
+        self.partitions_checked = monotonic()
+        if not self.table.partitioned:
+            return
+        now = datetime.now(timezone.utc)
+        period = tables.partition_periods[self.table.partitioning][0]
+        try:
+            cursor = self.postgres.db_connection.cursor()
+            created = self.table.create_partitions(
+                cursor, now, now + period * self.settings["partitions_ahead"]
+            )
+            self.postgres.db_connection.commit()
+            cursor.close()
+        except Exception as e:
+            self.log(
+                "Error while creating heartbeat partitions. {}".format(str(e)),
+                LogLevel.WARNING,
+            )
+            self._rollback()
+            return
+        if len(created) > 0:
+            self.log("Created heartbeat partition(s) {}".format(", ".join(created)))
+
+    def conform_data(self, data_list, rejected=None):
         """
         Conform checks that the data we have retrieved from Kafka fits the schemas, so
         we can be reasonbly confident that we are not sumbitting poor data to Postgres.
         This relies on the deserializer value inside the data packat which allows us
         to look up which schema
+        Rejected messages are counted, and if 'rejected' is a list, added to it as
+        dead-letter records (see tables.DeadLetterTable) for commit_to_db to store.
         """
         results = []
+        decode_seconds = 0
+        validate_seconds = 0
         for item in data_list:
-            value = json.loads(item.value.decode())
+            # messages may be JSON or binary (see argus.common.data.wire)
+            start = perf_counter()
+            rebuilt = False
+            try:
+                value = self.decode(item)
+                if not isinstance(value, dict):
+                    raise ValueError(
+                        "Package is a {}, not an object".format(type(value).__name__)
+                    )
+                if value.get("deserializer") == delta.DELTA:
+                    delta_value = value
+                    value = self.deltas.rebuild(value)
+                    rebuilt = True
+            except delta.MissingKeyframe as e:
+                self.log("Unable to rebuild delta. {}", LogLevel.VERBOSE, e)
+                self._reject_message(rejected, "keyframe", e, item, delta_value)
+                continue
+            except Exception as e:
+                self.log("Unable to decode package. {}", LogLevel.VERBOSE, e)
+                self._reject_message(rejected, "decode", e, item)
+                continue
+            finally:
+                decoded = perf_counter()
+                decode_seconds += decoded - start
             deserializer = value.get("deserializer")
             conformed_value = {}
             result = {}
@@ -87,54 +666,306 @@ class Caterpillar(CommonAppFramework):
             if deserializer is None:
                 self.log(
                     "Unable to decode package, deserializer not defined",
-                    LogLevel.WARNING,
+                    LogLevel.VERBOSE,
+                )
+                self._reject_message(
+                    rejected, "deserializer", "deserializer not defined", item, value
                 )
                 continue
             if not deserializer in self.schema:
                 self.log(
-                    "Unale to decode package, deserializer {} not found".format(
-                        deserializer
-                    ),
-                    LogLevel.WARNING,
+                    "Unale to decode package, deserializer {} not found",
+                    LogLevel.VERBOSE,
+                    deserializer,
+                )
+                self._reject_message(
+                    rejected, "deserializer", "deserializer not found", item, value
                 )
                 continue
             if not "data" in value:
                 self.log(
-                    "Unable to decode {}, data value not found".format(deserializer),
-                    LogLevel.WARNING,
+                    "Unable to decode {}, data value not found",
+                    LogLevel.VERBOSE,
+                    deserializer,
                 )
             # can we deserialize successfully?
             try:
                 conformed_value = self.schema[deserializer].deserialize(value["data"])
             except Exception as e:
                 self.log(
-                    "Error while decoding {} package - {}".format(deserializer, str(e))
+                    "Error while decoding {} package - {}", LogLevel.VERBOSE, deserializer, e
                 )
+                self._reject_message(rejected, "schema", e, item, value)
                 continue
+            finally:
+                validate_seconds += perf_counter() - decoded
+            if deserializer == "heartbeat" and not rebuilt:
+                # any heartbeat may be the keyframe of deltas to come
+                self.deltas.keyframe(value)
             # if we have valid data, add some other useful fields
             result["meta"] = {
                 "timestamp": item.timestamp,
                 "timestamp_type": item.timestamp_type,
                 "kafka_offset": item.offset,
+                "kafka_partition": item.partition,
                 "kafta_id": value["id"],
                 "data_type": deserializer,
             }
             result["raw"] = value
             result["conformed"] = conformed_value
             results.append(result)
+            # formatted only if written, as this is logged for every record
             self.log(
-                "{} decoded from {} with timestamp {} and offset {}".format(
-                    deserializer, value["id"], item.timestamp, item.offset
-                )
+                "{} decoded from {} with timestamp {} and offset {}",
+                LogLevel.VERBOSE,
+                deserializer,
+                value["id"],
+                item.timestamp,
+                item.offset,
             )
+        self.stage_seconds.observe(decode_seconds, ("decode",))
+        self.stage_seconds.observe(validate_seconds, ("validate",))
+        if self.watch is not None:
+            start = perf_counter()
+            self.watch.observe(results)
+            self.watch.sweep()
+            self.stage_seconds.observe(perf_counter() - start, ("watch",))
         return results
 
-    def commit_to_db(self, data_list, exception_passthrough=False):
+    def decode(self, message):
+        """
+        Returns the message sent, from a fetched Kafka message.
+        """
+        return self.kafka.decode(message)
+
+    def _count_reject(self, reason, producer_id):
+        self.rejects.inc(labels=(reason,))
+        producer = "unknown" if producer_id is None else str(producer_id)
+        if (producer,) not in self.producer_rejects.values and (
+            len(self.producer_rejects.values) >= MAX_REJECT_PRODUCERS
+        ):
+            producer = "other"
+        self.producer_rejects.inc(labels=(producer,))
+
+    def _reject_message(self, rejected, reason, detail, message, value=None):
+        """
+        Counts a message rejected while conforming it, and adds it (as received)
+        to 'rejected', if that is a list.
+        """
+        if isinstance(value, dict):
+            producer_id = value.get("id")
+            deserializer = value.get("deserializer")
+        else:
+            producer_id = _message_producer(message)
+            deserializer = None
+        self._count_reject(reason, producer_id)
+        if rejected is not None:
+            rejected.append(
+                self.dead_letters.record(
+                    reason,
+                    detail,
+                    message.value,
+                    message.topic,
+                    message.partition,
+                    message.offset,
+                    message.timestamp,
+                    producer_id,
+                    deserializer,
+                )
+            )
+
+    def _reject_item(self, rejected, reason, detail, item):
+        """
+        Counts a conformed record that could not be stored, and adds it (with
+        its message re-encoded as JSON) to 'rejected', if that is a list.
+        """
+        meta = item["meta"]
+        self._count_reject(reason, meta["kafta_id"])
+        if rejected is not None:
+            rejected.append(
+                self.dead_letters.record(
+                    reason,
+                    detail,
+                    json.dumps(item["raw"], default=str).encode("utf-8"),
+                    self.kafka.env["topic"],
+                    meta["kafka_partition"],
+                    meta["kafka_offset"],
+                    meta["timestamp"],
+                    meta["kafta_id"],
+                    meta["data_type"],
+                )
+            )
+
+    def finish_batch(self, rejected, offsets=None, exception_passthrough=False):
+        """
+        Writes the dead-letter records 'rejected' with one INSERT and the consumer
+        'offsets' (from ConsumerOffsetTable.rows), along with the producer watch's
+        alerts and checkpoint, and commits them in one transaction with any of the
+        batch's records not yet committed. Logs one line summing up the rejects by
+        reason.
+        Returns False only if the database connection was lost, so the batch
+        should be fetched again.
+        """
+        store = self.settings["dead_letter"] and len(rejected) > 0
+        alerts = []
+        checkpoint = []
+        if self.watch is not None:
+            alerts = self.watch.take_alerts()
+            checkpoint = self.watch.checkpoint()
+        try:
+            cursor = self.postgres.db_connection.cursor()
+            if store:
+                store = self._in_savepoint(
+                    cursor,
+                    lambda: execute_values(
+                        cursor,
+                        self.dead_letters.insert_rows_sql,
+                        rejected,
+                        page_size=len(rejected),
+                    ),
+                    "Unable to store {} rejected record(s).".format(len(rejected)),
+                    exception_passthrough,
+                )
+            if offsets:
+                self._in_savepoint(
+                    cursor,
+                    lambda: execute_values(
+                        cursor,
+                        self.offsets.upsert_rows_sql,
+                        offsets,
+                        page_size=len(offsets),
+                    ),
+                    "Unable to store the consumer offsets, only the consumer group "
+                    "has them.",
+                    exception_passthrough,
+                )
+            if len(alerts) > 0 and self.watch.settings["alerts"] == "postgres":
+                self._in_savepoint(
+                    cursor,
+                    lambda: execute_values(
+                        cursor,
+                        self.alert_table.insert_rows_sql,
+                        alerts,
+                        page_size=len(alerts),
+                    ),
+                    "Unable to store {} alert(s).".format(len(alerts)),
+                    exception_passthrough,
+                )
+            if len(checkpoint) > 0:
+                self._in_savepoint(
+                    cursor,
+                    lambda: execute_values(
+                        cursor,
+                        self.producer_stats.upsert_rows_sql,
+                        checkpoint,
+                        page_size=len(checkpoint),
+                    ),
+                    "Unable to checkpoint the producer statistics.",
+                    exception_passthrough,
+                )
+            self.postgres.db_connection.commit()
+            cursor.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if self.watch is not None:
+                self.watch.restore(alerts, checkpoint)
+            self.log(
+                "Lost the database connection while finishing a batch. "
+                "{}".format(str(e)),
+                LogLevel.CRITICAL,
+            )
+            if exception_passthrough:
+                raise e
+            return False
+        if len(alerts) > 0:
+            self._report_alerts(alerts)
+        if len(rejected) > 0:
+            reasons = {}
+            for record in rejected:
+                reasons[record[0]] = reasons.get(record[0], 0) + 1
+            self.log(
+                "Rejected {} record(s): {}{}".format(
+                    len(rejected),
+                    ", ".join(
+                        "{} {}".format(count, reason)
+                        for reason, count in sorted(reasons.items())
+                    ),
+                    ", kept in '{}'".format(self.dead_letters.name) if store else "",
+                ),
+                LogLevel.WARNING,
+            )
+        return True
+
+    def _report_alerts(self, alerts):
+        """
+        Counts and logs the producer watch's 'alerts', once their batch is
+        committed, and sends them to Kafka if that is where they go.
+        """
+        for producer_id, kind, state, value, threshold, at in alerts:
+            self.alert_changes.inc(labels=(kind, state))
+            self.log(
+                "{} alert {} for {}: {} (threshold {})",
+                LogLevel.WARNING,
+                kind,
+                state,
+                producer_id,
+                value,
+                threshold,
+            )
+            if self.alert_kafka is not None:
+                self.alert_kafka.send(
+                    "alert",
+                    {
+                        "kind": kind,
+                        "state": state,
+                        "value": value,
+                        "threshold": threshold,
+                        "recorded_at": at.isoformat(),
+                    },
+                    producer_id=producer_id,
+                )
+
+    def _in_savepoint(self, cursor, write, failure, exception_passthrough=False):
+        """
+        Calls 'write' inside a savepoint, so that if it fails (other than by
+        losing the connection) only its own changes are rolled back, and logs
+        'failure'. Returns True if it succeeded.
+        """
+        cursor.execute("SAVEPOINT finish_batch;")
+        try:
+            write()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            raise
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT finish_batch;")
+            self.log("{} {}".format(failure, str(e)), LogLevel.WARNING)
+            if exception_passthrough:
+                raise e
+            return False
+        cursor.execute("RELEASE SAVEPOINT finish_batch;")
+        return True
+
+    def commit_to_db(
+        self, data_list, exception_passthrough=False, rejected=None, offsets=None
+    ):
         """
         With a list of valid (heartbeat) data, this will add the data from that
-        list in to the Postgres database.
+        list in to the Postgres database, updating the latest heartbeat and rollup
+        tables in the same transaction.
+        In 'bulk' write mode the list is split into chunks of at most
+        'max_batch_size' records, and each chunk is written by one multi-row INSERT
+        in a single transaction. A chunk that fails is rolled back and retried row
+        by row, so a bad record is isolated rather than losing its neighbours.
+        In 'row' write mode every record is inserted and committed on its own.
+        Records already stored (by Kafka partition and offset) are skipped.
+        Records that can not be stored are added to the dead-letter records in
+        'rejected' (from conform_data), which are then stored with the consumer
+        'offsets' by finish_batch(), in the same transaction as the last chunk.
         'exception_passthrough' will pass any exceptions up the chain
+        Returns True once every record has been written or rejected by the
+        database as bad data, and False if the database could not be written to.
         """
+        if rejected is None:
+            rejected = []
         try:
             cursor = self.postgres.db_connection.cursor()
         except Exception as e:
@@ -142,22 +973,209 @@ class Caterpillar(CommonAppFramework):
                     LogLevel.CRITICAL)
             if exception_passthrough:
                 raise e
-            return
-        for item in data_list:
-            # We can combine some of the data here, and make a new json string
-            as_json = json.dumps({"data": item["raw"], "meta": item["meta"]})
-            # which we then insert into the database
-            try:
-                cursor.execute(
-                    "INSERT INTO heartbeat (producer_id, info) "
-                    " VALUES( '{}', '{}');".format(item["meta"]["kafta_id"], as_json)
+            return False
+        # (history row, latest row, rollup sample, record) - the latest row and
+        # sample are None if the record is not a heartbeat
+        rows = [
+            (
+                self.table.row(item),
+                self.latest.row(item),
+                tables.rollup_sample(item),
+                item,
+            )
+            for item in data_list
+        ]
+        unstorable = [record for record in rows if record[0] is None]
+        if len(unstorable) > 0:
+            for record in unstorable:
+                self._reject_item(
+                    rejected,
+                    "layout",
+                    "can not be stored in the '{}' table layout".format(
+                        self.table.layout
+                    ),
+                    record[3],
+                )
+            rows = [record for record in rows if record[0] is not None]
+        written = 0
+        try:
+            if self.settings["write_mode"] == "row":
+                written = self._insert_rows(
+                    cursor, rows, exception_passthrough, rejected
+                )
+            else:
+                size = max(1, self.settings["max_batch_size"])
+                for start in range(0, len(rows), size):
+                    written += self._insert_batch(
+                        cursor,
+                        rows[start : start + size],
+                        exception_passthrough,
+                        rejected,
+                        # the last chunk is committed by finish_batch()
+                        commit=start + size < len(rows),
+                    )
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            self.log(
+                "Lost the database connection while writing records. {}".format(
+                    str(e)
+                ),
+                LogLevel.CRITICAL,
+            )
+            if exception_passthrough:
+                raise e
+            return False
+        finally:
+            if not cursor.closed:
+                cursor.close()
+        self.log("{} of {} item(s) processed", LogLevel.VERBOSE, written, len(data_list))
+        self.messages.inc(written, ("written",))
+        if not self.finish_batch(rejected, offsets, exception_passthrough):
+            return False
+        if written > 0 and self.settings["notify"]:
+            self.notify({record[0][0] for record in rows})
+        return True
+
+    def notify(self, producers):
+        """
+        Sends one NOTIFY per producer id in 'producers', with the id as the payload,
+        to let listening monitors know new records are in the database.
+        A failure is logged but not raised, as the records are already stored.
+        """
+        try:
+            cursor = self.postgres.db_connection.cursor()
+            cursor.execute(
+                "SELECT pg_notify(%s, producer) FROM unnest(%s) AS producer;",
+                (tables.NOTIFY_CHANNEL, sorted(producers)),
+            )
+            self.postgres.db_connection.commit()
+            cursor.close()
+        except Exception as e:
+            self.log(
+                "Error while notifying listeners of new records. {}".format(str(e)),
+                LogLevel.WARNING,
+            )
+            self._rollback()
+
+    def _insert_batch(
+        self, cursor, rows, exception_passthrough=False, rejected=None, commit=True
+    ):
+        """
+        Inserts the history of 'rows' with a single multi-row INSERT, upserts the
+        newest heartbeat of each producer among them and their rollups, and commits
+        it all as one transaction (or leaves it open, if 'commit' is not set). On
+        failure the transaction is rolled back and the rows are handed to
+        '_insert_rows' to find (and skip) the bad ones, as are rows some of which
+        were already stored.
+        Returns the number of rows written.
+        """
+        try:
+            execute_values(
+                cursor,
+                self.table.insert_rows_sql,
+                [row for row, latest, sample, item in rows],
+                page_size=len(rows),
+            )
+            if cursor.rowcount < len(rows):
+                # only rollups of the rows newly stored may be added to
+                self.log(
+                    "{} of {} record(s) were already stored, skipping them".format(
+                        len(rows) - cursor.rowcount, len(rows)
+                    ),
+                    LogLevel.INFO,
                 )
+                self._rollback()
+                return self._insert_rows(cursor, rows, exception_passthrough, rejected)
+            latest_rows = self.latest.newest(
+                [latest for row, latest, sample, item in rows if latest is not None]
+            )
+            if len(latest_rows) > 0:
+                execute_values(
+                    cursor,
+                    self.latest.upsert_rows_sql,
+                    latest_rows,
+                    page_size=len(latest_rows),
+                )
+            samples = [
+                sample for row, latest, sample, item in rows if sample is not None
+            ]
+            for rollup in self.rollups:
+                rollup_rows = rollup.aggregate(samples)
+                if len(rollup_rows) > 0:
+                    execute_values(
+                        cursor,
+                        rollup.upsert_rows_sql,
+                        rollup_rows,
+                        page_size=len(rollup_rows),
+                    )
+            if commit:
+                self.postgres.db_connection.commit()
+            return len(rows)
+        except Exception as e:
+            self.log(
+                "Bulk insert of {} record(s) failed, retrying row by row. {}".format(
+                    len(rows), str(e)
+                ),
+                LogLevel.WARNING,
+            )
+            self._rollback()
+        return self._insert_rows(cursor, rows, exception_passthrough, rejected)
+
+    def _insert_rows(self, cursor, rows, exception_passthrough=False, rejected=None):
+        """
+        Inserts and commits 'rows' one at a time, skipping any row already stored,
+        and (adding to the dead letters 'rejected') any row that the database
+        rejects.
+        Returns the number of rows written.
+        """
+        written = 0
+        for row, latest, sample, item in rows:
+            try:
+                self.postgres.execute_prepared(cursor, self.table.insert_row_sql, row)
+                if cursor.rowcount == 0:
+                    self.messages.inc(labels=("duplicate",))
+                    continue
+                if latest is not None:
+                    self.postgres.execute_prepared(
+                        cursor, self.latest.upsert_row_sql, latest
+                    )
+                if sample is not None:
+                    for rollup in self.rollups:
+                        self.postgres.execute_prepared(
+                            cursor, rollup.upsert_row_sql, rollup.aggregate([sample])[0]
+                        )
                 self.postgres.db_connection.commit()
+                written += 1
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # the connection is gone, so no later row can succeed either
+                raise
             except Exception as e:
                 self.log("Error encountered while commiting " \
-                         "new record to database. {}".format( str(e)),
-                         LogLevel.WARNING)
+                         "new record to database. {}", LogLevel.VERBOSE, e)
+                self._reject_item(rejected, "database", e, item)
+                self._rollback()
                 if exception_passthrough:
                     raise e
-                continue
-        self.log("{} item(s) processed".format(len(data_list)))
+        return written
+
+    def _rollback(self):
+        """
+        Rolls back the current transaction, so the connection can be used again
+        after a failed statement.
+        """
+        try:
+            self.postgres.db_connection.rollback()
+        except Exception as e:
+            self.log(
+                "Error while rolling back database transaction. {}".format(str(e)),
+                LogLevel.WARNING,
+            )
+
+
+def _message_producer(message):
+    """
+    Returns the producer id from a Kafka message's key, or None if it has none.
+    """
+    try:
+        return json.loads(message.key)["key"]
+    except Exception:
+        return None
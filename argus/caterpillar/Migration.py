@@ -0,0 +1,143 @@
+"""
+Migration converts an existing 'heartbeat' table to the typed layout (see
+argus.common.data.tables), partitioned as set by CATERPILLAR_PARTITIONING, so that
+Caterpillar can be switched over without losing history. Both json layout tables
+and unpartitioned typed tables can be converted.
+
+The existing table is kept, renamed to 'heartbeat_json' (or 'heartbeat_unpartitioned'),
+and every heartbeat in it is copied into a new 'heartbeat' table in the same
+transaction, once each (by Kafka partition and offset). Partitions are created to
+cover all of the copied data. Once the copy has been checked, the old table can be
+dropped by hand. Caterpillar should be stopped while the migration runs.
+"""
+
+from argus.caterpillar import Caterpillar as caterpillar_settings
+from argus.common.Common import (
+    CommonAppFramework,
+    LogLevel,
+    settings_from_environment,
+)
+from argus.common.data import tables
+from argus.common.PostgresConnection import PostgresConnection
+from datetime import datetime, timezone
+
+
+class Migration(CommonAppFramework):
+    def __init__(self):
+        super().__init__()
+        self.settings = settings_from_environment(
+            caterpillar_settings.environment_variable_map,
+            caterpillar_settings.environment_variable_defaults,
+        )
+        self.postgres = PostgresConnection(self)
+
+    def run(self, exception_passthrough=False):
+        """
+        Migrates the heartbeat table, if it is not already in the typed layout with
+        the configured partitioning.
+        'exception_passthrough' will pass any exceptions up the chain
+        """
+        target = tables.TypedHeartbeatTable(partitioning=self.settings["partitioning"])
+        self.postgres.connect()
+        cursor = self.postgres.db_connection.cursor()
+        layout = tables.existing_layout(cursor)
+        partitioned = tables.is_partitioned(cursor)
+        if layout is None or (layout == target.layout and partitioned == target.partitioned):
+            self.log(
+                "Nothing to migrate: the heartbeat table {}".format(
+                    "does not exist" if layout is None else "is already up to date"
+                ),
+                LogLevel.INFO,
+            )
+            self.postgres.disconnect()
+            return
+        if partitioned:
+            issue = "Can not migrate a partitioned heartbeat table back to one table"
+        elif tables.existing_layout(cursor, self._old_table(layout)) is not None:
+            issue = "Can not migrate, as a '{}' table already exists".format(
+                self._old_table(layout)
+            )
+        else:
+            issue = None
+        if issue is not None:
+            self.log(issue, LogLevel.CRITICAL)
+            self.postgres.disconnect()
+            raise Exception(issue)
+        old_table = self._old_table(layout)
+        try:
+            self._rename(cursor, old_table)
+            target.create(cursor)
+            if target.partitioned:
+                self._create_partitions(cursor, target, old_table, layout)
+            if layout == tables.JSONHeartbeatTable.layout:
+                cursor.execute(target.copy_from_json_sql(old_table))
+            else:
+                cursor.execute(target.copy_from_typed_sql(old_table))
+            copied = cursor.rowcount
+            self.postgres.db_connection.commit()
+        except Exception as e:
+            self.postgres.db_connection.rollback()
+            self.log(
+                "Migration failed, no changes were made. {}".format(str(e)),
+                LogLevel.CRITICAL,
+            )
+            self.postgres.disconnect()
+            if exception_passthrough:
+                raise e
+            return
+        self.log(
+            "Migrated {} heartbeat(s) into the new heartbeat table. The original "
+            "table has been kept as '{}'.".format(copied, old_table),
+            LogLevel.INFO,
+        )
+        cursor.close()
+        self.postgres.disconnect()
+
+    def _old_table(self, layout):
+        if layout == tables.JSONHeartbeatTable.layout:
+            return "heartbeat_json"
+        return "heartbeat_unpartitioned"
+
+    def _rename(self, cursor, old_table):
+        """
+        Renames the heartbeat table, with its indexes and id sequence, so their
+        names are free for the new table.
+        """
+        cursor.execute("ALTER TABLE heartbeat RENAME TO {};".format(old_table))
+        for index in (
+            "producer_index",
+            "heartbeat_producer_time_index",
+            "heartbeat_kafka_index",
+            "heartbeat_pkey",
+        ):
+            cursor.execute(
+                "ALTER INDEX IF EXISTS {} RENAME TO {}_{};".format(
+                    index, old_table, index.replace("heartbeat_", "")
+                )
+            )
+        cursor.execute(
+            "ALTER SEQUENCE IF EXISTS heartbeat_id_seq "
+            "RENAME TO {}_id_seq;".format(old_table)
+        )
+
+    def _create_partitions(self, cursor, target, old_table, layout):
+        """
+        Creates partitions from the oldest heartbeat in 'old_table' to
+        'partitions_ahead' periods from now.
+        """
+        if layout == tables.JSONHeartbeatTable.layout:
+            cursor.execute(
+                "SELECT to_timestamp(min((info->'meta'->>'timestamp')::bigint) / 1000.0) "
+                "FROM {} WHERE info->'meta'->>'data_type' = 'heartbeat';".format(
+                    old_table
+                )
+            )
+        else:
+            cursor.execute("SELECT min(recorded_at) FROM {};".format(old_table))
+        now = datetime.now(timezone.utc)
+        oldest = cursor.fetchone()[0] or now
+        period = tables.partition_periods[target.partitioning][0]
+        created = target.create_partitions(
+            cursor, oldest, now + period * self.settings["partitions_ahead"]
+        )
+        self.log("Created {} heartbeat partition(s)".format(len(created)), LogLevel.INFO)
@@ -0,0 +1,218 @@
+"""
+The Pipeline runs Caterpillar (in the 'pipeline' run mode) as three asyncio stages:
+fetching from Kafka, validating, and writing to Postgres. The stages are joined by
+queues holding at most 'pipeline_depth' batches, so one batch can be validated while
+the next is fetched and the one before is written, and a stage that falls behind
+makes the stages before it wait rather than letting batches pile up in memory.
+
+The Kafka and Postgres clients block, so each stage runs its work on its own
+executor thread: one for the Kafka consumer (which must only be used from one
+thread), one for validation, and one for the Postgres connection. The event loop
+only hands batches between them. Fetching and writing release the GIL while they
+wait on the network, so they overlap with validation; to use more than one core,
+run several workers with '--workers'.
+
+Offsets are still committed only once a batch is written, by the write stage, in
+the order batches were fetched. If a write fails, the batches fetched after it are
+discarded unwritten and the consumer is moved back to the committed offsets, so the
+failed batch and everything after it is fetched again, in order.
+
+On SIGTERM or Ctrl-C fetching stops, and the batches already fetched are validated,
+written and committed before run() returns.
+
+The doctest below fails the first write, and checks every message is still written
+exactly once, with all of the offsets committed.
+
+    >>> from argus.caterpillar.Caterpillar import Caterpillar
+    >>> from argus.common.MemoryKafka import MemoryBroker, MemoryKafkaConnection
+    >>> from argus.common.MemoryPostgres import MemoryPostgresConnection
+    >>> from argus.common.data import schema
+    >>> broker = MemoryBroker(partitions=3)
+    >>> producer = MemoryKafkaConnection(None, broker)
+    >>> times = {child.name: "1.00" for child in schema.CPUTimes().children}
+    >>> for i in range(600):
+    ...     producer.send("heartbeat", {"cpus": {"load": ["1"], "times": times}},
+    ...                   producer_id="host-{}".format(i % 20))
+    >>> written = []
+    >>> class FlakyCaterpillar(Caterpillar):
+    ...     failed = False
+    ...     def commit_to_db(self, data_list, exception_passthrough=False,
+    ...                      rejected=None, offsets=None):
+    ...         if not self.failed:
+    ...             self.failed = True
+    ...             return False
+    ...         written.extend((item["meta"]["kafka_partition"],
+    ...                         item["meta"]["kafka_offset"]) for item in data_list)
+    ...         if len(written) >= 600:
+    ...             self.stop()
+    ...         return True
+    >>> caterpillar = FlakyCaterpillar(
+    ...     kafka_connection=lambda app: MemoryKafkaConnection(
+    ...         app, broker, max_poll_records=50),
+    ...     postgres_connection=MemoryPostgresConnection,
+    ...     run_mode="pipeline",
+    ... )
+    >>> caterpillar.log_level = LogLevel.CRITICAL
+    >>> caterpillar.settings["idle_backoff_max"] = 0.05
+    >>> caterpillar.run()
+    >>> len(written) == len(set(written)) == 600
+    True
+    >>> [broker.committed("default", partition) for partition in range(3)
+    ...  ] == broker.end_offsets()
+    True
+"""
+
+from argus.caterpillar.Caterpillar import IDLE_BACKOFF_START, PARTITION_CHECK_INTERVAL
+from argus.common.Common import LogLevel
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+import asyncio
+import signal
+
+# put on a queue to tell the next stage there are no more batches
+STOP = None
+
+
+class Pipeline:
+    def __init__(self, app):
+        """
+        Prepares to run the Caterpillar 'app' (already connected, with its tables
+        checked) as a pipeline.
+        """
+        self.app = app
+        self.depth = max(1, app.settings["pipeline_depth"])
+        # raised by every failed write; batches fetched before then are discarded
+        self.generation = 0
+        self.kafka_executor = ThreadPoolExecutor(1, thread_name_prefix="pipeline-kafka")
+        self.validate_executor = ThreadPoolExecutor(
+            1, thread_name_prefix="pipeline-validate"
+        )
+        self.postgres_executor = ThreadPoolExecutor(
+            1, thread_name_prefix="pipeline-postgres"
+        )
+
+    def run(self):
+        """
+        Runs the pipeline until the app is stopped (with app.stop(), SIGTERM or
+        Ctrl-C), then drains the batches in flight.
+        """
+        self.app.running = True
+        try:
+            asyncio.run(self._run())
+        finally:
+            for executor in (
+                self.kafka_executor,
+                self.validate_executor,
+                self.postgres_executor,
+            ):
+                executor.shutdown(wait=True)
+        self.app.log("Caterpillar pipeline stopped", LogLevel.INFO)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        handled = []
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signal_number, self.app.stop)
+                handled.append(signal_number)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # signals can only be handled on the main thread
+                pass
+        to_validate = asyncio.Queue(self.depth)
+        to_write = asyncio.Queue(self.depth)
+        stages = [
+            asyncio.ensure_future(self.fetch(to_validate)),
+            asyncio.ensure_future(self.validate(to_validate, to_write)),
+            asyncio.ensure_future(self.write(to_write)),
+        ]
+        try:
+            done, pending = await asyncio.wait(
+                stages, return_when=asyncio.FIRST_EXCEPTION
+            )
+            # a stage only ends early if it failed, which stops the others
+            for stage in pending:
+                stage.cancel()
+            for stage in done:
+                stage.result()
+        finally:
+            for signal_number in handled:
+                loop.remove_signal_handler(signal_number)
+
+    async def _call(self, executor, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, function, *args
+        )
+
+    def _backoff(self, idle_wait):
+        return min(
+            max(idle_wait * 2, IDLE_BACKOFF_START), self.app.settings["idle_backoff_max"]
+        )
+
+    async def fetch(self, to_validate):
+        """
+        Fetches batches until the app is stopped, backing off while the topic is
+        idle. Each batch is tagged with the generation it was fetched in.
+        """
+        idle_wait = 0
+        while self.app.running:
+            generation = self.generation
+            messages = await self._call(self.kafka_executor, self.app.fetch_batch)
+            if len(messages) > 0:
+                idle_wait = 0
+                await to_validate.put((generation, messages))
+                continue
+            await self._call(self.postgres_executor, self.app.idle)
+            self.app.metrics.publish()
+            idle_wait = self._backoff(idle_wait)
+            await asyncio.sleep(idle_wait)
+        await to_validate.put(STOP)
+
+    async def validate(self, to_validate, to_write):
+        """
+        Decodes and validates each batch, skipping those a failed write discarded.
+        """
+        while True:
+            batch = await to_validate.get()
+            if batch is STOP:
+                break
+            generation, messages = batch
+            if generation != self.generation:
+                continue
+            rejected = []
+            results = await self._call(
+                self.validate_executor, self.app.conform_data, messages, rejected
+            )
+            await to_write.put((generation, messages, results, rejected))
+        await to_write.put(STOP)
+
+    async def write(self, to_write):
+        """
+        Writes each batch and then commits its offsets. After a failed write, moves
+        the consumer back to the committed offsets and discards the batches already
+        fetched, then waits before writing again.
+        """
+        idle_wait = 0
+        while True:
+            batch = await to_write.get()
+            if batch is STOP:
+                break
+            generation, messages, results, rejected = batch
+            if generation != self.generation:
+                continue
+            if monotonic() - self.app.partitions_checked >= PARTITION_CHECK_INTERVAL:
+                await self._call(self.postgres_executor, self.app.maintain_partitions)
+            if await self._call(
+                self.postgres_executor, self.app.write_batch, results, rejected, messages
+            ):
+                await self._call(self.kafka_executor, self.app.commit_offsets, messages)
+                self.app.metrics.publish()
+                idle_wait = 0
+                continue
+            # raised before the rewind is queued behind any fetch in progress, so
+            # that fetch's batch is discarded too
+            self.generation += 1
+            await self._call(self.kafka_executor, self.app.kafka.rewind_to_committed)
+            await self._call(self.postgres_executor, self.app._reconnect_postgres)
+            self.app.metrics.publish()
+            idle_wait = self._backoff(idle_wait)
+            await asyncio.sleep(idle_wait)
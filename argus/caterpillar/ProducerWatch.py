@@ -0,0 +1,355 @@
+"""
+The producer watch keeps running statistics of each producer's heartbeats in
+Caterpillar's memory, updated as each batch is conformed, and raises an alert when
+one crosses its threshold:
+
+    load    The exponentially weighted moving average of the host's CPU load (the
+                mean over its cores), halving the weight of older heartbeats every
+                WATCH_HALF_LIFE seconds
+    peak    The highest load of any one core over the last WATCH_PEAK_WINDOW seconds
+    missed  No heartbeat for WATCH_MISSED_AFTER times the producer's usual interval
+
+Each record costs the same small amount of work however many have been seen: the
+average is updated in place, and the rolling maximum is kept as a queue of falling
+peaks, so each peak is added and dropped once. Missed heartbeats are found by a
+sweep of the producers at most once a second, rather than on every record.
+
+Time is heartbeat (Kafka) time, moved on by the clock while nothing arrives, so
+catching up on a backlog does not make producers look missed. Only producers on
+partitions this Caterpillar has read from are swept, so workers sharing a topic
+only report their own. A record no newer than the last one seen from its producer,
+such as one fetched again after a failed write, is not counted twice.
+
+An alert is raised once, when its value reaches the threshold, and cleared once the
+value falls WATCH_CLEAR_MARGIN below it (or, for missed, when the producer reports
+again). The statistics are checkpointed to Postgres, so a restarted Caterpillar
+carries on from them rather than starting cold.
+
+Settings are read from environment variables:
+
+    WATCH_HALF_LIFE     Seconds for a heartbeat's weight in the load average to
+                            halve (default 60)
+    WATCH_PEAK_WINDOW   Seconds the peak load is the highest of (default 300)
+    WATCH_LOAD_ALERT    Average load (%) that raises a 'load' alert (default 90,
+                            0 for none)
+    WATCH_PEAK_ALERT    Peak load (%) that raises a 'peak' alert (default 0, none)
+    WATCH_CLEAR_MARGIN  How far (in %) below its threshold a load or peak must fall
+                            to clear its alert (default 10)
+    WATCH_MISSED_AFTER  Usual heartbeat intervals of silence that raise a 'missed'
+                            alert (default 3, 0 for none)
+    WATCH_ALERTS        Where alerts go, besides the log and the metrics:
+                            'postgres' (default) writes them to the
+                            'heartbeat_alerts' table, with each batch. 'kafka'
+                            sends them to WATCH_ALERT_TOPIC once the batch is
+                            committed. 'log' only logs them.
+    WATCH_ALERT_TOPIC   The Kafka topic alerts are sent to (default 'alerts')
+    WATCH_CHECKPOINT_INTERVAL  Seconds between checkpoints (default 60)
+
+    >>> settings = dict(environment_variable_defaults, half_life=10, load_alert=70,
+    ...                 peak_alert=95, missed_after=3)
+    >>> watch = ProducerWatch(settings)
+    >>> def heartbeat(second, load):
+    ...     return {"meta": {"data_type": "heartbeat", "kafta_id": "web-1",
+    ...                      "timestamp": second * 1000, "kafka_partition": 0},
+    ...             "conformed": {"cpus": {"load": load}}}
+    >>> watch.observe([heartbeat(second, [50, 100]) for second in range(0, 50, 10)])
+    >>> watch.observe([heartbeat(second, [10, 20]) for second in range(50, 100, 10)])
+    >>> [(kind, state, value) for producer, kind, state, value, threshold, at
+    ...  in watch.take_alerts()]
+    [('load', 'raised', 75.0), ('peak', 'raised', 100), ('load', 'cleared', 45.0)]
+    >>> watch.stats("web-1")
+    {'load': 16.88, 'peak': 100, 'interval': 10.0}
+    >>> watch.observe([heartbeat(40, [100, 100])])
+    >>> watch.sweep(now=130 * 1000)
+    >>> [(kind, state, value) for producer, kind, state, value, threshold, at
+    ...  in watch.take_alerts()]
+    [('missed', 'raised', 40.0)]
+
+Checkpoints hold every producer changed since the last one:
+
+    >>> restored = ProducerWatch(settings)
+    >>> restored.load(watch.checkpoint(force=True))
+    >>> restored.stats("web-1"), sorted(restored.states["web-1"].alerts)
+    ({'load': 16.88, 'peak': 100, 'interval': 10.0}, ['missed', 'peak'])
+    >>> watch.checkpoint(force=True)
+    []
+"""
+
+from argus.common.Common import settings_from_environment
+from argus.common.data.tables import kafka_timestamp
+from collections import deque
+from time import monotonic
+import json
+import threading
+
+environment_variable_map = {
+    "half_life": "WATCH_HALF_LIFE",
+    "peak_window": "WATCH_PEAK_WINDOW",
+    "load_alert": "WATCH_LOAD_ALERT",
+    "peak_alert": "WATCH_PEAK_ALERT",
+    "clear_margin": "WATCH_CLEAR_MARGIN",
+    "missed_after": "WATCH_MISSED_AFTER",
+    "alerts": "WATCH_ALERTS",
+    "alert_topic": "WATCH_ALERT_TOPIC",
+    "checkpoint_interval": "WATCH_CHECKPOINT_INTERVAL",
+}
+
+environment_variable_defaults = {
+    "half_life": 60.0,
+    "peak_window": 300.0,
+    "load_alert": 90.0,
+    "peak_alert": 0.0,
+    "clear_margin": 10.0,
+    "missed_after": 3.0,
+    "alerts": "postgres",
+    "alert_topic": "alerts",
+    "checkpoint_interval": 60.0,
+}
+
+# the weight of each new interval in a producer's usual interval
+INTERVAL_WEIGHT = 0.2
+# the shortest usual interval (in milliseconds) missed heartbeats are judged by
+MIN_INTERVAL = 1000
+# seconds between sweeps for missed heartbeats
+SWEEP_INTERVAL = 1.0
+
+
+class ProducerState:
+    """
+    One producer's statistics. Times are Kafka timestamps, in milliseconds.
+    """
+
+    __slots__ = ("at", "partition", "load", "interval", "peaks", "alerts")
+
+    def __init__(self, at, partition, load):
+        self.at = at
+        self.partition = partition
+        self.load = load
+        # the usual time between heartbeats, unknown until the second arrives
+        self.interval = None
+        # (at, peak) pairs, each peak lower than the one before
+        self.peaks = deque()
+        # the kinds of alert raised and not yet cleared
+        self.alerts = set()
+
+
+class ProducerWatch:
+    def __init__(self, settings=None):
+        """
+        Starts with no statistics; load() restores them from a checkpoint.
+        """
+        if settings is None:
+            settings = settings_from_environment(
+                environment_variable_map, environment_variable_defaults
+            )
+        self.settings = settings
+        self.half_life = max(0.001, settings["half_life"]) * 1000
+        self.window = settings["peak_window"] * 1000
+        self.states = {}
+        # the partitions records have been read from, whose producers are swept
+        self.partitions = set()
+        # alert rows (see tables.AlertTable) not yet taken
+        self.alerts = []
+        # producers changed since the last checkpoint
+        self.changed = set()
+        # the newest heartbeat time seen, and when (by the clock) it was seen
+        self.newest = None
+        self.newest_seen = monotonic()
+        self.swept = monotonic()
+        self.checkpointed = monotonic()
+        self._lock = threading.Lock()
+
+    def observe(self, items):
+        """
+        Adds the heartbeats among the conformed records 'items' to their producers'
+        statistics, raising and clearing alerts as they cross their thresholds.
+        """
+        with self._lock:
+            for item in items:
+                meta = item["meta"]
+                if meta["data_type"] == "heartbeat":
+                    self._observe(
+                        meta["kafta_id"],
+                        meta["timestamp"],
+                        meta["kafka_partition"],
+                        item["conformed"]["cpus"]["load"],
+                    )
+
+    def _observe(self, producer_id, at, partition, loads):
+        if len(loads) == 0:
+            return
+        load = sum(loads) / len(loads)
+        peak = max(loads)
+        state = self.states.get(producer_id)
+        if state is None:
+            state = self.states[producer_id] = ProducerState(at, partition, load)
+        elif at <= state.at:
+            return
+        else:
+            elapsed = at - state.at
+            weight = 0.5 ** (elapsed / self.half_life)
+            state.load = weight * state.load + (1 - weight) * load
+            if state.interval is None:
+                state.interval = elapsed
+            else:
+                state.interval += INTERVAL_WEIGHT * (elapsed - state.interval)
+            state.at = at
+            state.partition = partition
+        peaks = state.peaks
+        while len(peaks) > 0 and peaks[-1][1] <= peak:
+            peaks.pop()
+        peaks.append((at, peak))
+        while peaks[0][0] <= at - self.window:
+            peaks.popleft()
+        self.changed.add(producer_id)
+        self.partitions.add(partition)
+        if self.newest is None or at > self.newest:
+            self.newest = at
+            self.newest_seen = monotonic()
+        if "missed" in state.alerts:
+            self._change(producer_id, state, "missed", False, None, None, at)
+        self._check(producer_id, state, "load", state.load, at)
+        self._check(producer_id, state, "peak", peaks[0][1], at)
+
+    def _check(self, producer_id, state, kind, value, at):
+        threshold = self.settings[kind + "_alert"]
+        if threshold <= 0:
+            return
+        if kind in state.alerts:
+            if value < threshold - self.settings["clear_margin"]:
+                self._change(producer_id, state, kind, False, value, threshold, at)
+        elif value >= threshold:
+            self._change(producer_id, state, kind, True, value, threshold, at)
+
+    def _change(self, producer_id, state, kind, raised, value, threshold, at):
+        if raised:
+            state.alerts.add(kind)
+        else:
+            state.alerts.discard(kind)
+        self.alerts.append(
+            (
+                producer_id,
+                kind,
+                "raised" if raised else "cleared",
+                None if value is None else round(value, 2),
+                threshold,
+                kafka_timestamp(at),
+            )
+        )
+
+    def sweep(self, now=None):
+        """
+        Raises a 'missed' alert for each producer that has been silent for
+        'missed_after' of its usual intervals. 'now' is a Kafka timestamp; without
+        it, the sweep is made at most once every SWEEP_INTERVAL seconds.
+        """
+        after = self.settings["missed_after"]
+        if after <= 0 or self.newest is None:
+            return
+        with self._lock:
+            if now is None:
+                if monotonic() - self.swept < SWEEP_INTERVAL:
+                    return
+                now = self.newest + (monotonic() - self.newest_seen) * 1000
+            self.swept = monotonic()
+            for producer_id, state in self.states.items():
+                if (
+                    state.interval is None
+                    or "missed" in state.alerts
+                    or state.partition not in self.partitions
+                ):
+                    continue
+                allowed = after * max(state.interval, MIN_INTERVAL)
+                if now - state.at > allowed:
+                    self._change(
+                        producer_id,
+                        state,
+                        "missed",
+                        True,
+                        (now - state.at) / 1000,
+                        round(allowed / 1000, 2),
+                        now,
+                    )
+                    self.changed.add(producer_id)
+
+    def stats(self, producer_id):
+        """
+        Returns a producer's load average, peak load and usual interval (in
+        seconds), or None for a producer not seen.
+        """
+        state = self.states.get(producer_id)
+        if state is None:
+            return None
+        return {
+            "load": round(state.load, 2),
+            "peak": state.peaks[0][1] if len(state.peaks) > 0 else None,
+            "interval": None if state.interval is None else state.interval / 1000,
+        }
+
+    def take_alerts(self):
+        """
+        Returns the alerts raised and cleared since the last call.
+        """
+        with self._lock:
+            alerts, self.alerts = self.alerts, []
+        return alerts
+
+    def checkpoint_due(self):
+        return self.checkpointed is None or (
+            monotonic() - self.checkpointed >= self.settings["checkpoint_interval"]
+        )
+
+    def checkpoint_soon(self):
+        """
+        Makes the next checkpoint due at once, as on shutdown.
+        """
+        self.checkpointed = None
+
+    def checkpoint(self, force=False):
+        """
+        Returns (producer_id, state as json) for each producer changed since the
+        last checkpoint, once 'checkpoint_interval' has passed (or if 'force' is
+        set); otherwise an empty list.
+        """
+        if not force and not self.checkpoint_due():
+            return []
+        with self._lock:
+            self.checkpointed = monotonic()
+            changed, self.changed = self.changed, set()
+            return [
+                (producer_id, json.dumps(self._saved(self.states[producer_id])))
+                for producer_id in sorted(changed)
+            ]
+
+    def restore(self, alerts, checkpoint):
+        """
+        Puts back the 'alerts' and 'checkpoint' taken for a batch that could not be
+        written, to go with the next one.
+        """
+        with self._lock:
+            self.alerts[:0] = alerts
+            self.changed.update(producer_id for producer_id, state in checkpoint)
+
+    def load(self, rows):
+        """
+        Restores the statistics from checkpoint 'rows' of (producer_id, state).
+        """
+        with self._lock:
+            for producer_id, saved in rows:
+                if isinstance(saved, str):
+                    saved = json.loads(saved)
+                state = ProducerState(saved["at"], saved["partition"], saved["load"])
+                state.interval = saved["interval"]
+                state.peaks.extend(tuple(peak) for peak in saved["peaks"])
+                state.alerts.update(saved["alerts"])
+                self.states[producer_id] = state
+
+    def _saved(self, state):
+        return {
+            "at": state.at,
+            "partition": state.partition,
+            "load": state.load,
+            "interval": state.interval,
+            "peaks": list(state.peaks),
+            "alerts": sorted(state.alerts),
+        }
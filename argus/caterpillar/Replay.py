@@ -0,0 +1,201 @@
+"""
+Replay runs the records Caterpillar rejected (kept in the 'heartbeat_rejected' table,
+see CATERPILLAR_DEAD_LETTER) through decoding, validation and writing again, for
+example once a missing deserializer has been added or a schema relaxed.
+
+Records that now pass are written to the heartbeat tables as if they had just
+arrived, and marked as replayed; those that are still rejected are left as they
+are, to be replayed again later. Records are read in batches, oldest first.
+
+Settings are read from environment variables (as well as Caterpillar's):
+
+    REPLAY_REASONS      Comma separated reasons to replay, such as 'schema,database'
+                            (default '', every reason)
+    REPLAY_BATCH_SIZE   Records read and written at a time (default 500)
+    REPLAY_DRY_RUN      'true' only reports how many records would now pass,
+                            without writing or marking any (default 'false')
+
+A record is marked as replayed just after it is written, so one written moments
+before Replay is stopped can be written again by the next replay.
+"""
+
+from argus.caterpillar import Caterpillar as caterpillar_settings
+from argus.caterpillar.Caterpillar import Caterpillar, rollup_tables
+from argus.common.Common import (
+    CommonAppFramework,
+    LogLevel,
+    settings_from_environment,
+)
+from argus.common.data import delta, schema, tables, wire
+from argus.common.PostgresConnection import PostgresConnection
+from collections import namedtuple
+from time import monotonic
+
+environment_variable_map = {
+    "reasons": "REPLAY_REASONS",
+    "batch_size": "REPLAY_BATCH_SIZE",
+    "dry_run": "REPLAY_DRY_RUN",
+}
+
+environment_variable_defaults = {
+    "reasons": "",
+    "batch_size": 500,
+    "dry_run": False,
+}
+
+# a dead-letter record, with the fields of a fetched Kafka message that
+# Caterpillar.conform_data reads
+ReplayedMessage = namedtuple(
+    "ReplayedMessage",
+    ["id", "topic", "partition", "offset", "timestamp", "timestamp_type", "key", "value"],
+)
+
+
+class Replay(Caterpillar):
+    def __init__(self):
+        # records are read from Postgres rather than Kafka, so the Caterpillar
+        # constructor is skipped and only the Postgres side is set up
+        CommonAppFramework.__init__(self)
+        self.settings = settings_from_environment(
+            caterpillar_settings.environment_variable_map,
+            caterpillar_settings.environment_variable_defaults,
+        )
+        self.settings.update(
+            settings_from_environment(
+                environment_variable_map, environment_variable_defaults
+            )
+        )
+        self.reasons = [
+            reason.strip()
+            for reason in self.settings["reasons"].split(",")
+            if reason.strip() != ""
+        ]
+        self.kafka = None
+        self.schema = schema.compiled_colander_set()
+        self.table = tables.heartbeat_table(
+            self.settings["table_layout"], self.settings["partitioning"]
+        )
+        self.latest = tables.LatestHeartbeatTable()
+        self.rollups = rollup_tables(self.settings["rollups"])
+        self.dead_letters = tables.DeadLetterTable()
+        self.offsets = tables.ConsumerOffsetTable()
+        # replayed records are old, and would only skew the producers' statistics
+        self.watch = None
+        # keyframes are not kept with the rejects, so 'keyframe' rejects stay so
+        self.deltas = delta.DeltaDecoder()
+        self.alert_kafka = None
+        self.partitions_checked = monotonic()
+        self.postgres = PostgresConnection(self)
+        self._create_metrics()
+        # the records commit_to_db could not store, by id(), in the current batch
+        self.failed = set()
+
+    def run(self, exception_passthrough=False):
+        """
+        Replays every pending dead-letter record with one of the chosen reasons.
+        'exception_passthrough' will pass any exceptions up the chain
+        """
+        self.postgres.connect()
+        cursor = self.postgres.db_connection.cursor()
+        if tables.existing_layout(cursor, self.dead_letters.name) is None:
+            self.log(
+                "Nothing to replay: there is no {} table".format(self.dead_letters.name),
+                LogLevel.INFO,
+            )
+            self.postgres.disconnect()
+            return
+        cursor.close()
+        if not self.settings["dry_run"]:
+            self._check_postgres()
+        last_id = 0
+        replayed = 0
+        rejected = 0
+        while True:
+            messages = self._pending(last_id)
+            if len(messages) == 0:
+                break
+            last_id = messages[-1].id
+            passed = []
+            for message in messages:
+                # one at a time, to know which record each result came from
+                for item in self.conform_data([message]):
+                    passed.append((message.id, item))
+            if self.settings["dry_run"]:
+                replayed += len(passed)
+                rejected += len(messages) - len(passed)
+                continue
+            self.failed = set()
+            if not self.commit_to_db(
+                [item for dead_letter_id, item in passed], exception_passthrough
+            ):
+                self.log(
+                    "Lost the database connection, stopping the replay",
+                    LogLevel.CRITICAL,
+                )
+                break
+            written = [
+                dead_letter_id
+                for dead_letter_id, item in passed
+                if id(item) not in self.failed
+            ]
+            self._mark_replayed(written)
+            replayed += len(written)
+            rejected += len(messages) - len(written)
+        self.log(
+            "{} {} record(s), {} still rejected".format(
+                "Would replay" if self.settings["dry_run"] else "Replayed",
+                replayed,
+                rejected,
+            ),
+            LogLevel.INFO,
+        )
+        self.postgres.disconnect()
+
+    def decode(self, message):
+        return wire.decode(message.value)
+
+    def finish_batch(self, rejected, offsets=None, exception_passthrough=False):
+        # records still rejected are already in the table, and stay pending
+        return super().finish_batch([], None, exception_passthrough)
+
+    def _reject_item(self, rejected, reason, detail, item):
+        self._count_reject(reason, item["meta"]["kafta_id"])
+        self.failed.add(id(item))
+
+    def _pending(self, last_id):
+        """
+        Returns the next batch of pending records after 'last_id', as
+        ReplayedMessages.
+        """
+        cursor = self.postgres.db_connection.cursor()
+        reasons = "AND reason = ANY(%s) " if len(self.reasons) > 0 else ""
+        cursor.execute(
+            "SELECT id, kafka_topic, kafka_partition, kafka_offset, kafka_timestamp, "
+            "payload FROM {} WHERE replayed_at IS NULL AND id > %s {}"
+            "ORDER BY id LIMIT %s;".format(self.dead_letters.name, reasons),
+            [last_id]
+            + ([self.reasons] if len(self.reasons) > 0 else [])
+            + [max(1, self.settings["batch_size"])],
+        )
+        rows = cursor.fetchall()
+        self.postgres.db_connection.commit()
+        cursor.close()
+        return [
+            ReplayedMessage(
+                dead_letter_id, topic, partition, offset, timestamp, 0, None, bytes(payload)
+            )
+            for dead_letter_id, topic, partition, offset, timestamp, payload in rows
+        ]
+
+    def _mark_replayed(self, dead_letter_ids):
+        if len(dead_letter_ids) == 0:
+            return
+        cursor = self.postgres.db_connection.cursor()
+        cursor.execute(
+            "UPDATE {} SET replayed_at = now() WHERE id = ANY(%s);".format(
+                self.dead_letters.name
+            ),
+            (dead_letter_ids,),
+        )
+        self.postgres.db_connection.commit()
+        cursor.close()
@@ -0,0 +1,101 @@
+"""
+Rollup rebuilds the rollup tables (see CATERPILLAR_ROLLUPS and
+argus.common.data.tables.RollupTable) from the raw heartbeat history in bulk, for
+example after they were first created, or after changing how heartbeats are stored.
+
+Only buckets from the oldest heartbeat still in the history on are rebuilt, so
+rollups of heartbeats the Janitor has already removed are kept. The finest rollup is
+rebuilt from the history, and each coarser one from the rollup before it, all in one
+transaction. The heartbeat table is locked against writes while this runs, so a
+running Caterpillar simply pauses until it is done.
+"""
+
+from argus.caterpillar import Caterpillar as caterpillar_settings
+from argus.caterpillar.Caterpillar import rollup_tables
+from argus.common.Common import (
+    CommonAppFramework,
+    LogLevel,
+    settings_from_environment,
+)
+from argus.common.data import tables
+from argus.common.PostgresConnection import PostgresConnection
+
+
+class Rollup(CommonAppFramework):
+    def __init__(self):
+        super().__init__()
+        self.settings = settings_from_environment(
+            caterpillar_settings.environment_variable_map,
+            caterpillar_settings.environment_variable_defaults,
+        )
+        # finest first, so each coarser rollup can be built from the one before
+        self.rollups = sorted(
+            rollup_tables(self.settings["rollups"]), key=lambda rollup: rollup.length
+        )
+        self.postgres = PostgresConnection(self)
+
+    def run(self, exception_passthrough=False):
+        """
+        Rebuilds every configured rollup table.
+        'exception_passthrough' will pass any exceptions up the chain
+        """
+        self.postgres.connect()
+        cursor = self.postgres.db_connection.cursor()
+        layout = tables.existing_layout(cursor)
+        if layout is None or len(self.rollups) == 0:
+            self.log(
+                "Nothing to rebuild: {}".format(
+                    "there is no heartbeat table"
+                    if layout is None
+                    else "no rollups are set in CATERPILLAR_ROLLUPS"
+                ),
+                LogLevel.INFO,
+            )
+            self.postgres.disconnect()
+            return
+        try:
+            cursor.execute("LOCK TABLE heartbeat IN SHARE MODE;")
+            cursor.execute(
+                "SELECT min(recorded_at) FROM ({}) AS history;".format(
+                    tables.typed_select_sql("heartbeat", layout)
+                )
+            )
+            oldest = cursor.fetchone()[0]
+            if oldest is None:
+                self.log("Nothing to rebuild: there are no heartbeats", LogLevel.INFO)
+                self.postgres.db_connection.rollback()
+                self.postgres.disconnect()
+                return
+            # whole buckets of the coarsest rollup, so no bucket is half rebuilt
+            since = self.rollups[-1].bucket(oldest)
+            previous = None
+            for rollup in self.rollups:
+                if tables.existing_layout(cursor, rollup.name) is None:
+                    rollup.create(cursor)
+                cursor.execute(
+                    "DELETE FROM {} WHERE bucket >= %s;".format(rollup.name), (since,)
+                )
+                if previous is None:
+                    cursor.execute(rollup.rebuild_sql("heartbeat", layout), (since,))
+                else:
+                    cursor.execute(rollup.merge_from_sql(previous.name), (since,))
+                self.log(
+                    "Rebuilt {} row(s) of {} from {}".format(
+                        cursor.rowcount, rollup.name, since.isoformat()
+                    ),
+                    LogLevel.INFO,
+                )
+                previous = rollup
+            self.postgres.db_connection.commit()
+        except Exception as e:
+            self.postgres.db_connection.rollback()
+            self.log(
+                "Rollup rebuild failed, no changes were made. {}".format(str(e)),
+                LogLevel.CRITICAL,
+            )
+            self.postgres.disconnect()
+            if exception_passthrough:
+                raise e
+            return
+        cursor.close()
+        self.postgres.disconnect()
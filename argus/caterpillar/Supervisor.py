@@ -0,0 +1,274 @@
+"""
+The Supervisor runs several Caterpillar workers as separate processes, so that ingest
+can use more than one core. The workers join the same Kafka consumer group, which
+spreads the topic's partitions across them, and each has its own Kafka and Postgres
+connections. Workers run in 'stream' mode; any that exit are restarted, and the
+throughput of each is logged.
+
+Worker <n> serves its metrics on METRICS_PORT + <n>, and writes them to METRICS_FILE
+with '-<n>' added before the extension (see argus.common.Metrics).
+
+Settings are read from environment variables:
+
+    CATERPILLAR_REPORT_INTERVAL  Seconds between worker checks and throughput reports
+                                     (default 10)
+    CATERPILLAR_RESTART_DELAY    Seconds to wait before restarting a worker that has
+                                     exited (default 1)
+
+The doctest below runs three workers against an in-memory Kafka stand-in with six
+partitions, and checks that each worker is given its own partitions and that every
+message is written exactly once.
+
+    >>> from argus.common.MemoryKafka import MemoryKafkaConnection, MemoryKafkaManager
+    >>> from argus.common.data import schema
+    >>> manager = MemoryKafkaManager()
+    >>> manager.start()
+    >>> broker = manager.MemoryBroker(partitions=6)
+    >>> written = manager.list()
+    >>> class RecordingWorker(CaterpillarWorker):
+    ...     def run(self):
+    ...         self.kafka.start_consumer()
+    ...         self.stream()
+    ...         self.kafka.close()
+    ...     def commit_to_db(self, data_list, exception_passthrough=False,
+    ...                      rejected=None, offsets=None):
+    ...         written.extend([
+    ...             (self.index, item["meta"]["kafka_partition"],
+    ...              item["meta"]["kafka_offset"]) for item in data_list])
+    ...         return True
+    >>> supervisor = Supervisor(3, worker_class=RecordingWorker, worker_kwargs={
+    ...     "kafka_connection": lambda app: MemoryKafkaConnection(app, broker)})
+    >>> supervisor.log_level = LogLevel.CRITICAL
+    >>> supervisor.start()
+    >>> _wait_for(lambda: len(broker.members("default")) == 3)
+    True
+    >>> times = {child.name: "1.00" for child in schema.CPUTimes().children}
+    >>> producer = MemoryKafkaConnection(None, broker)
+    >>> for i in range(600):
+    ...     producer.env["id"] = "host-{}".format(i % 40)
+    ...     producer.send("heartbeat", {"cpus": {"load": ["1"], "times": times}})
+    >>> _wait_for(lambda: len(written) >= 600)
+    True
+    >>> supervisor.stop()
+    >>> coordinates = [(partition, offset) for index, partition, offset in written]
+    >>> len(coordinates) == len(set(coordinates)) == sum(broker.end_offsets()) == 600
+    True
+    >>> partitions = {}
+    >>> for index, partition, offset in written:
+    ...     partitions.setdefault(index, set()).add(partition)
+    >>> sorted(len(owned) for owned in partitions.values())
+    [2, 2, 2]
+    >>> len(set.union(*partitions.values()))
+    6
+    >>> sum(counter.value for counter in supervisor.processed)
+    600
+    >>> manager.shutdown()
+
+A worker in the 'pipeline' run mode counts the messages it commits in the same way:
+
+    >>> from argus.common.MemoryKafka import MemoryBroker
+    >>> from argus.common.MemoryPostgres import MemoryPostgresConnection
+    >>> broker = MemoryBroker(partitions=2)
+    >>> producer = MemoryKafkaConnection(None, broker)
+    >>> for i in range(100):
+    ...     producer.send("heartbeat", {"cpus": {"load": ["1"], "times": times}},
+    ...                   producer_id="host-{}".format(i % 10))
+    >>> class StoppingWorker(CaterpillarWorker):
+    ...     def commit_offsets(self, messages):
+    ...         committed = super().commit_offsets(messages)
+    ...         if self.processed.value >= 100:
+    ...             self.stop()
+    ...         return committed
+    >>> worker = StoppingWorker(
+    ...     0,
+    ...     multiprocessing.Value("L", 0),
+    ...     kafka_connection=lambda app: MemoryKafkaConnection(
+    ...         app, broker, max_poll_records=30),
+    ...     postgres_connection=MemoryPostgresConnection,
+    ...     run_mode="pipeline",
+    ... )
+    >>> worker.log_level = LogLevel.CRITICAL
+    >>> worker.settings["idle_backoff_max"] = 0.05
+    >>> worker.run()
+    >>> worker.processed.value
+    100
+"""
+
+from argus.caterpillar.Caterpillar import Caterpillar
+from argus.common.Common import (
+    CommonAppFramework,
+    LogLevel,
+    settings_from_environment,
+)
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+environment_variable_map = {
+    "report_interval": "CATERPILLAR_REPORT_INTERVAL",
+    "restart_delay": "CATERPILLAR_RESTART_DELAY",
+}
+
+environment_variable_defaults = {
+    "report_interval": 10.0,
+    "restart_delay": 1.0,
+}
+
+
+class CaterpillarWorker(Caterpillar):
+    """
+    A Caterpillar that always streams (or runs as a pipeline), and adds the number
+    of messages it commits to a counter shared with the Supervisor.
+    """
+
+    def __init__(self, index, processed, **kwargs):
+        super().__init__(**kwargs)
+        self.index = index
+        self.processed = processed
+        if self.settings["run_mode"] != "pipeline":
+            self.settings["run_mode"] = "stream"
+        # each worker publishes its own metrics, on the next port or file along
+        metrics_settings = self.metrics.settings
+        if metrics_settings["port"] > 0:
+            metrics_settings["port"] += index
+        if metrics_settings["file"] != "":
+            root, extension = os.path.splitext(metrics_settings["file"])
+            metrics_settings["file"] = "{}-{}{}".format(root, index, extension)
+
+    def commit_offsets(self, messages):
+        # called once a batch is written, by both the stream and pipeline modes
+        committed = super().commit_offsets(messages)
+        with self.processed.get_lock():
+            self.processed.value += len(messages)
+        return committed
+
+
+def _run_worker(worker_class, index, processed, worker_kwargs):
+    """
+    The entry point of each worker process.
+    """
+    worker = worker_class(index, processed, **worker_kwargs)
+    worker.run()
+    # worker processes exit without running atexit handlers
+    worker.flush_logs()
+
+
+class Supervisor(CommonAppFramework):
+    def __init__(self, worker_count, worker_class=CaterpillarWorker, worker_kwargs=None):
+        """
+        Prepares to run 'worker_count' workers. Each is built as
+        worker_class(index, processed_counter, **worker_kwargs) in its own process.
+        """
+        super().__init__()
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+        self.worker_count = worker_count
+        self.worker_class = worker_class
+        self.worker_kwargs = worker_kwargs or {}
+        self.context = multiprocessing.get_context("fork")
+        self.processed = [self.context.Value("L", 0) for i in range(worker_count)]
+        self.workers = [None] * worker_count
+        self.running = False
+
+    def run(self):
+        """
+        Starts the workers, then checks on them and reports their throughput
+        every 'report_interval' seconds until interrupted or sent SIGTERM.
+        """
+        self.start()
+        signal.signal(signal.SIGTERM, self._stop_running)
+        last_counts = [counter.value for counter in self.processed]
+        last_time = time.monotonic()
+        try:
+            while self.running:
+                time.sleep(self.settings["report_interval"])
+                self.check_workers()
+                now = time.monotonic()
+                last_counts = self.report(last_counts, now - last_time)
+                last_time = now
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def start(self):
+        self.running = True
+        for index in range(self.worker_count):
+            self._start_worker(index)
+
+    def check_workers(self):
+        """
+        Restarts any worker process that has exited.
+        """
+        for index, worker in enumerate(self.workers):
+            if self.running and not worker.is_alive():
+                self.log(
+                    "Caterpillar worker {} exited with code {}, restarting".format(
+                        index, worker.exitcode
+                    ),
+                    LogLevel.WARNING,
+                )
+                time.sleep(self.settings["restart_delay"])
+                self._start_worker(index)
+
+    def report(self, last_counts, elapsed):
+        """
+        Logs the messages per second processed by each worker since 'last_counts'
+        were taken, 'elapsed' seconds ago. Returns the current counts.
+        """
+        counts = [counter.value for counter in self.processed]
+        rates = [(now - last) / elapsed for now, last in zip(counts, last_counts)]
+        self.log(
+            "Caterpillar workers: {} - total {:.1f} msg/sec".format(
+                ", ".join(
+                    "#{} {:.1f} msg/sec".format(index, rate)
+                    for index, rate in enumerate(rates)
+                ),
+                sum(rates),
+            ),
+            LogLevel.INFO,
+        )
+        return counts
+
+    def stop(self, timeout=30):
+        """
+        Asks each worker to finish its current batch and exit (with SIGTERM),
+        killing any that have not done so within 'timeout' seconds.
+        """
+        self.running = False
+        for worker in self.workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker is not None:
+                worker.join(max(0, deadline - time.monotonic()))
+                if worker.is_alive():
+                    worker.kill()
+                    worker.join()
+
+    def _stop_running(self, *args):
+        self.running = False
+
+    def _start_worker(self, index):
+        worker = self.context.Process(
+            target=_run_worker,
+            args=(self.worker_class, index, self.processed[index], self.worker_kwargs),
+            name="caterpillar-{}".format(index),
+        )
+        worker.start()
+        self.workers[index] = worker
+
+
+def _wait_for(condition, timeout=30):
+    """
+    Polls 'condition' until it is true or 'timeout' seconds pass. Returns the
+    final result of 'condition'.
+    """
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return condition()
@@ -0,0 +1,572 @@
+"""
+Benchmarks for Caterpillar.
+
+These connect to the Postgres database given by POSTGRES_URL, but only ever write to
+temporary tables, which are dropped when the benchmark disconnects.
+
+    BENCHMARK_RECORDS       How many fake records each benchmark writes (default 5000)
+    BENCHMARK_CPU_COUNT     How many CPUs each fake heartbeat reports (default 8)
+    BENCHMARK_PRODUCERS     How many fake producers the records are spread over
+                                (default 10)
+    BENCHMARK_QUERY_REPEATS How many times each query benchmark query is run
+                                (default 20)
+
+The watch benchmark times the producer watch alone, on BENCHMARK_RECORDS fake
+records from BENCHMARK_PRODUCERS producers, against conforming the same records, and
+needs no database.
+
+The pipeline benchmark runs Faker, the Kafka connection, Caterpillar and its
+database writes together in one process, against the in-memory Kafka stand-in, so
+it needs no network. It needs the faker module too, so is run from a checkout of
+the whole repository:
+
+    PYTHONPATH=. python argus/common/entrypoint.py bench pipeline
+
+    BENCHMARK_RATE          Messages per second Faker sends (default 2000)
+    BENCHMARK_DURATION      Seconds Faker sends for (default 10)
+    BENCHMARK_HOSTS         Virtual hosts Faker simulates (default 100)
+    BENCHMARK_PARTITIONS    Partitions of the in-memory topic (default 4)
+    BENCHMARK_CODEC         The codec Faker sends with (default 'json')
+    BENCHMARK_DELTA_KEYFRAMES  Faker sends heartbeats as deltas, with a keyframe
+                                every this many (default 0, every one whole)
+    BENCHMARK_RUN_MODE      Caterpillar's run mode, 'stream' (default) or 'pipeline'
+    BENCHMARK_POSTGRES      'memory' (default) writes to an in-process stand-in that
+                                only counts rows, timing Caterpillar's own work.
+                                'url' writes to temporary tables in the database at
+                                POSTGRES_URL, such as a local Postgres.
+    BENCHMARK_OUTPUT        A file the results are written to as JSON. They are
+                                always printed as JSON too.
+"""
+
+from argus.caterpillar import Caterpillar as caterpillar_settings
+from argus.caterpillar.Caterpillar import Caterpillar, rollup_tables
+from argus.caterpillar.ProducerWatch import ProducerWatch
+from argus.common.Common import CommonAppFramework, LogLevel, settings_from_environment
+from argus.common.data import delta, schema, tables
+from argus.common.MemoryKafka import MemoryBroker, MemoryKafkaConnection
+from argus.common.MemoryPostgres import MemoryPostgresConnection
+from argus.common.Metrics import percentiles
+from argus.common.PostgresConnection import PostgresConnection
+from psycopg2.extras import execute_values
+from datetime import datetime, timedelta, timezone
+from time import monotonic, perf_counter, time
+import json
+import platform
+import random
+import resource
+import threading
+
+environment_variable_map = {
+    "records": "BENCHMARK_RECORDS",
+    "cpu_count": "BENCHMARK_CPU_COUNT",
+    "producers": "BENCHMARK_PRODUCERS",
+    "query_repeats": "BENCHMARK_QUERY_REPEATS",
+    "rate": "BENCHMARK_RATE",
+    "duration": "BENCHMARK_DURATION",
+    "hosts": "BENCHMARK_HOSTS",
+    "partitions": "BENCHMARK_PARTITIONS",
+    "codec": "BENCHMARK_CODEC",
+    "delta_keyframes": "BENCHMARK_DELTA_KEYFRAMES",
+    "run_mode": "BENCHMARK_RUN_MODE",
+    "postgres": "BENCHMARK_POSTGRES",
+    "output": "BENCHMARK_OUTPUT",
+}
+
+environment_variable_defaults = {
+    "records": 5000,
+    "cpu_count": 8,
+    "producers": 10,
+    "query_repeats": 20,
+    "rate": 2000.0,
+    "duration": 10.0,
+    "hosts": 100,
+    "partitions": 4,
+    "codec": "json",
+    "delta_keyframes": 0,
+    "run_mode": "stream",
+    "postgres": "memory",
+    "output": "",
+}
+
+def fake_records(count, cpu_count, producer_count=10):
+    """
+    Builds 'count' records shaped like the output of Caterpillar.conform_data,
+    spread over 'producer_count' fake producers that each send one heartbeat a
+    second, ending now.
+    """
+    heartbeat = schema.compiled_colander_set()["heartbeat"]
+    end = int(datetime.now(timezone.utc).timestamp() * 1000)
+    records = []
+    for i in range(count):
+        producer_id = "benchmark-{}".format(i % producer_count)
+        data = heartbeat.serialize(
+            {
+                "timestamp": datetime.now(),
+                "cpus": {
+                    "load": [random.randint(0, 100) for cpu in range(cpu_count)],
+                    "times": {
+                        field: random.randrange(0, 100000) / 100
+                        for field in tables.CPU_TIME_FIELDS
+                    },
+                },
+            }
+        )
+        raw = {"id": producer_id, "deserializer": "heartbeat", "data": data}
+        meta = {
+            "timestamp": end - (count - i) // producer_count * 1000,
+            "timestamp_type": 0,
+            "kafka_offset": i,
+            "kafka_partition": 0,
+            "kafta_id": producer_id,
+            "data_type": "heartbeat",
+        }
+        records.append(
+            {"meta": meta, "raw": raw, "conformed": heartbeat.deserialize(data)}
+        )
+    return records
+
+
+def create_scratch_tables(app):
+    """
+    Creates temporary versions of a Caterpillar's 'heartbeat' (in the layout set by
+    CATERPILLAR_TABLE_LAYOUT), 'heartbeat_latest', rollup, dead-letter and offset
+    tables, and those of the producer watch. Temporary tables come first in the
+    search path, so these shadow any real tables for this session only.
+    """
+    cursor = app.postgres.db_connection.cursor()
+    app.table.create(cursor, temporary=True)
+    app.latest.create(cursor, temporary=True)
+    for rollup in app.rollups:
+        rollup.create(cursor, temporary=True)
+    app.dead_letters.create(cursor, temporary=True)
+    app.offsets.create(cursor, temporary=True)
+    if app.watch is not None:
+        app.alert_table.create(cursor, temporary=True)
+        app.producer_stats.create(cursor, temporary=True)
+    app.postgres.db_connection.commit()
+    cursor.close()
+
+
+class InsertBenchmark(Caterpillar):
+    """
+    Compares rows per second written by Caterpillar.commit_to_db in 'row' write
+    mode against 'bulk' mode at a range of batch sizes.
+    """
+
+    def __init__(self):
+        # Kafka is not needed to benchmark the database, so the Caterpillar
+        # constructor is skipped and only the Postgres side is set up.
+        CommonAppFramework.__init__(self)
+        self.log_level = LogLevel.INFO
+        self.settings = settings_from_environment(
+            caterpillar_settings.environment_variable_map,
+            caterpillar_settings.environment_variable_defaults,
+        )
+        self.settings.update(
+            settings_from_environment(
+                environment_variable_map, environment_variable_defaults
+            )
+        )
+        self.postgres = PostgresConnection(self)
+        # always unpartitioned, as a temporary table's partitions must be temporary
+        self.table = tables.heartbeat_table(self.settings["table_layout"])
+        self.latest = tables.LatestHeartbeatTable()
+        self.rollups = rollup_tables(self.settings["rollups"])
+        self.dead_letters = tables.DeadLetterTable()
+        self.offsets = tables.ConsumerOffsetTable()
+        self.watch = None
+        self.deltas = delta.DeltaDecoder()
+        self.alert_kafka = None
+        self._create_metrics()
+
+    def run(self):
+        """
+        Writes the same set of fake records once per write mode, reporting the
+        rows per second achieved by each.
+        """
+        self.postgres.connect()
+        self._create_scratch_table()
+        records = fake_records(
+            self.settings["records"],
+            self.settings["cpu_count"],
+            self.settings["producers"],
+        )
+        runs = [("row", 1)] + [("bulk", size) for size in (10, 100, 500, 5000)]
+        results = []
+        for write_mode, max_batch_size in runs:
+            self.settings["write_mode"] = write_mode
+            self.settings["max_batch_size"] = max_batch_size
+            self._truncate_scratch_table()
+            start = perf_counter()
+            if not self.commit_to_db(records):
+                self.log("Database write failed, stopping", LogLevel.CRITICAL)
+                break
+            elapsed = perf_counter() - start
+            written = len(records)
+            results.append((write_mode, max_batch_size, written, elapsed))
+        for write_mode, max_batch_size, written, elapsed in results:
+            self.log(
+                "{:<5} batch {:>5}: {:>7} rows in {:>8.3f}s = {:>10.1f} rows/sec".format(
+                    write_mode, max_batch_size, written, elapsed, written / elapsed
+                ),
+                LogLevel.INFO,
+            )
+        self.postgres.disconnect()
+
+    def _create_scratch_table(self):
+        create_scratch_tables(self)
+
+    def _truncate_scratch_table(self):
+        cursor = self.postgres.db_connection.cursor()
+        cursor.execute(
+            "TRUNCATE {};".format(
+                ", ".join(
+                    [self.table.name, self.latest.name]
+                    + [rollup.name for rollup in self.rollups]
+                )
+            )
+        )
+        self.postgres.db_connection.commit()
+        cursor.close()
+
+
+class QueryBenchmark(CommonAppFramework):
+    """
+    Compares the time taken by typical dashboard and report queries against the
+    json and typed heartbeat table layouts, holding the same records, and (where it
+    can answer them) an hourly rollup of those records.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log_level = LogLevel.INFO
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+        self.postgres = PostgresConnection(self)
+        self.tables = [
+            tables.JSONHeartbeatTable("benchmark_json"),
+            tables.TypedHeartbeatTable("benchmark_typed"),
+        ]
+        self.rollup = tables.RollupTable("hour", name="benchmark_rollup")
+
+    def run(self):
+        self.postgres.connect()
+        cursor = self.postgres.db_connection.cursor()
+        records = fake_records(
+            self.settings["records"],
+            self.settings["cpu_count"],
+            self.settings["producers"],
+        )
+        for table in self.tables:
+            table.create(cursor, temporary=True)
+            rows = [table.row(record) for record in records]
+            execute_values(cursor, table.insert_rows_sql, rows, page_size=1000)
+            cursor.execute("ANALYZE {};".format(table.name))
+            cursor.execute("SELECT pg_total_relation_size(%s);", (table.name,))
+            self.log(
+                "{:<5} layout: {} rows, {:.1f} KiB".format(
+                    table.layout, len(rows), cursor.fetchone()[0] / 1024
+                ),
+                LogLevel.INFO,
+            )
+        self.rollup.create(cursor, temporary=True)
+        cursor.execute(
+            self.rollup.rebuild_sql(self.tables[1].name, self.tables[1].layout),
+            ("-infinity",),
+        )
+        self.log("hourly rollup: {} rows".format(cursor.rowcount), LogLevel.INFO)
+        self.postgres.db_connection.commit()
+        producer = records[-1]["meta"]["kafta_id"]
+        since = tables.kafka_timestamp(records[-1]["meta"]["timestamp"])
+        since -= timedelta(seconds=len(records) // self.settings["producers"] // 10)
+        for description, queries, parameters in self._queries(producer, since):
+            for table in self.tables + [self.rollup]:
+                if table.layout not in queries:
+                    continue
+                sql = queries[table.layout].format(table=table.name)
+                elapsed = self._time_query(cursor, sql, parameters)
+                self.log(
+                    "{:<40} {:<6}: {:>9.3f} ms".format(
+                        description, table.layout, elapsed * 1000
+                    ),
+                    LogLevel.INFO,
+                )
+        cursor.close()
+        self.postgres.disconnect()
+
+    def _time_query(self, cursor, sql, parameters):
+        """
+        Returns the average time taken to run a query, after one warm up run.
+        """
+        cursor.execute(sql, parameters)
+        cursor.fetchall()
+        start = perf_counter()
+        for i in range(self.settings["query_repeats"]):
+            cursor.execute(sql, parameters)
+            cursor.fetchall()
+        return (perf_counter() - start) / self.settings["query_repeats"]
+
+    def _queries(self, producer, since):
+        """
+        Returns (description, {layout: sql}, parameters) for each query compared.
+        The json queries read the same values out of the stored json.
+        """
+        cpus = "info->'data'->'data'->'cpus'"
+        timestamp = "to_timestamp((info->'meta'->>'timestamp')::bigint / 1000.0)"
+        since_ms = since.timestamp() * 1000
+        return [
+            (
+                "latest 10% of one producer, avg user",
+                {
+                    "json": "SELECT avg(({}->'times'->>'user')::float) FROM {{table}} "
+                    "WHERE producer_id = %s "
+                    "AND (info->'meta'->>'timestamp')::bigint >= %s;".format(cpus),
+                    "typed": "SELECT avg(cpu_user) FROM {table} "
+                    "WHERE producer_id = %s AND recorded_at >= to_timestamp(%s / 1000.0);",
+                },
+                (producer, since_ms),
+            ),
+            (
+                "latest 10% of all producers, max load",
+                {
+                    "json": "SELECT producer_id, max(load::smallint) FROM {{table}}, "
+                    "json_array_elements_text({}->'load') AS load "
+                    "WHERE {} >= to_timestamp(%s / 1000.0) "
+                    "GROUP BY producer_id;".format(cpus, timestamp),
+                    "typed": "SELECT producer_id, max(load) FROM {table}, "
+                    "unnest(cpu_load) AS load "
+                    "WHERE recorded_at >= to_timestamp(%s / 1000.0) "
+                    "GROUP BY producer_id;",
+                },
+                (since_ms,),
+            ),
+            (
+                "all history, avg system per producer",
+                {
+                    "json": "SELECT producer_id, avg(({}->'times'->>'system')::float) "
+                    "FROM {{table}} GROUP BY producer_id;".format(cpus),
+                    "typed": "SELECT producer_id, avg(cpu_system) FROM {table} "
+                    "GROUP BY producer_id;",
+                    "rollup": "SELECT producer_id, sum(cpu_system_sum) / sum(samples) "
+                    "FROM {table} GROUP BY producer_id;",
+                },
+                (),
+            ),
+        ]
+
+
+class WatchBenchmark(CommonAppFramework):
+    """
+    Times the producer watch observing batches of fake records, and sweeping its
+    producers, against validating the same records as Caterpillar.conform_data
+    does, to show what the watch adds to each record.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log_level = LogLevel.INFO
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+
+    def run(self):
+        settings = self.settings
+        records = fake_records(
+            settings["records"], settings["cpu_count"], settings["producers"]
+        )
+        heartbeat = schema.compiled_colander_set()["heartbeat"]
+        start = perf_counter()
+        for record in records:
+            heartbeat.deserialize(record["raw"]["data"])
+        validate_time = perf_counter() - start
+        watch = ProducerWatch()
+        batch_size = 500
+        start = perf_counter()
+        for first in range(0, len(records), batch_size):
+            watch.observe(records[first : first + batch_size])
+        observe_time = perf_counter() - start
+        start = perf_counter()
+        watch.sweep(now=records[-1]["meta"]["timestamp"])
+        sweep_time = perf_counter() - start
+        self.log(
+            "{} record(s) from {} producer(s): validating {:.2f}us each, watching "
+            "{:.2f}us each, sweeping all producers {:.2f}ms".format(
+                len(records),
+                len(watch.states),
+                validate_time / len(records) * 1e6,
+                observe_time / len(records) * 1e6,
+                sweep_time * 1000,
+            ),
+            LogLevel.INFO,
+        )
+
+
+class PipelineCaterpillar(Caterpillar):
+    """
+    A streaming (or pipeline) Caterpillar that times each stage of its work,
+    records the time from each heartbeat being sent to its row being committed,
+    and stops once 'expected()' messages have been committed.
+    """
+
+    def __init__(self, broker, postgres_connection, scratch_tables, expected, run_mode):
+        super().__init__(
+            kafka_connection=lambda app: MemoryKafkaConnection(app, broker),
+            postgres_connection=postgres_connection,
+            run_mode=run_mode,
+        )
+        self.settings["idle_backoff_max"] = 0.05
+        # a temporary table's partitions would have to be temporary too
+        self.table = tables.heartbeat_table(self.settings["table_layout"])
+        self.scratch_tables = scratch_tables
+        self.expected = expected
+        self.timers = {"fetch": 0.0, "conform": 0.0, "write": 0.0, "commit": 0.0}
+        self.committed = 0
+        self.latencies = []
+
+    def _check_postgres(self):
+        if self.scratch_tables:
+            create_scratch_tables(self)
+
+    def fetch_batch(self):
+        start = perf_counter()
+        messages = super().fetch_batch()
+        self.timers["fetch"] += perf_counter() - start
+        expected = self.expected()
+        if expected is not None and self.committed >= expected:
+            self.stop()
+        return messages
+
+    def commit_offsets(self, messages):
+        start = perf_counter()
+        committed = super().commit_offsets(messages)
+        self.timers["commit"] += perf_counter() - start
+        return committed
+
+    def conform_data(self, data_list, rejected=None):
+        start = perf_counter()
+        results = super().conform_data(data_list, rejected)
+        self.timers["conform"] += perf_counter() - start
+        return results
+
+    def commit_to_db(
+        self, data_list, exception_passthrough=False, rejected=None, offsets=None
+    ):
+        start = perf_counter()
+        written = super().commit_to_db(
+            data_list, exception_passthrough, rejected, offsets
+        )
+        self.timers["write"] += perf_counter() - start
+        if written:
+            now = time() * 1000
+            self.latencies.extend(now - item["meta"]["timestamp"] for item in data_list)
+            self.committed += len(data_list)
+        return written
+
+
+class PipelineBenchmark(CommonAppFramework):
+    """
+    Runs Faker (in load mode, on its own thread) into an in-memory Kafka topic
+    while a Caterpillar consumes it, and reports the throughput of each stage, the
+    latency from heartbeat to committed row, and memory use, as JSON.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log_level = LogLevel.INFO
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+
+    def run(self):
+        from argus.faker.Faker import Faker
+
+        settings = self.settings
+        rss_start = _max_rss_kib()
+        broker = MemoryBroker(partitions=settings["partitions"])
+        faker = Faker(kafka_connection=lambda app: MemoryKafkaConnection(app, broker))
+        faker.log_level = LogLevel.WARNING
+        faker.kafka.env["codec"] = settings["codec"]
+        faker.kafka.env["delta_keyframes"] = settings["delta_keyframes"]
+        # Caterpillar publishes its metrics as METRICS_ sets; both can not share them
+        faker.metrics.settings.update(port=0, file="")
+        faker.settings.update(
+            mode="load",
+            hosts=settings["hosts"],
+            rate=settings["rate"],
+            duration=settings["duration"],
+        )
+        faker_report = {}
+        sender = threading.Thread(
+            target=lambda: faker_report.update(faker.run()), name="faker"
+        )
+        if settings["postgres"] == "url":
+            postgres_connection = PostgresConnection
+        else:
+            postgres_connection = MemoryPostgresConnection
+        caterpillar = PipelineCaterpillar(
+            broker,
+            postgres_connection,
+            scratch_tables=settings["postgres"] == "url",
+            expected=lambda: None if sender.is_alive() else faker_report.get("sent"),
+            run_mode=settings["run_mode"],
+        )
+        caterpillar.log_level = LogLevel.WARNING
+        self.log(
+            "Sending {rate:.0f} msg/sec from {hosts} hosts for {duration}s through "
+            "{partitions} partition(s), writing to {postgres} Postgres".format(**settings),
+            LogLevel.INFO,
+        )
+        start = monotonic()
+        sender.start()
+        caterpillar.run()
+        elapsed = monotonic() - start
+        sender.join()
+        committed = caterpillar.committed
+        timers = caterpillar.timers
+        results = {
+            "benchmark": "pipeline",
+            "started": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": dict(
+                settings,
+                write_mode=caterpillar.settings["write_mode"],
+                max_batch_size=caterpillar.settings["max_batch_size"],
+                table_layout=caterpillar.settings["table_layout"],
+                rollups=caterpillar.settings["rollups"],
+            ),
+            "faker": faker_report,
+            "stages": {
+                name: {
+                    "seconds": seconds,
+                    "msg_per_sec": committed / seconds if seconds > 0 else None,
+                }
+                for name, seconds in sorted(timers.items())
+            },
+            "end_to_end": {
+                "messages": committed,
+                "seconds": elapsed,
+                "msg_per_sec": committed / elapsed,
+                "latency_ms": percentiles(caterpillar.latencies),
+            },
+            "memory": {
+                "max_rss_kib_start": rss_start,
+                "max_rss_kib_end": _max_rss_kib(),
+            },
+        }
+        output = json.dumps(results, indent=2, sort_keys=True)
+        self.flush_logs()
+        print(output)
+        if settings["output"]:
+            with open(settings["output"], "w") as output_file:
+                output_file.write(output + "\n")
+            self.log("Results written to {}".format(settings["output"]), LogLevel.INFO)
+        return results
+
+
+def _max_rss_kib():
+    """
+    The most memory (resident set size, in KiB) this process has used so far.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
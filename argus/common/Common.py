@@ -1,4 +1,37 @@
 from enum import Enum
+import os
+import sys
+
+
+def settings_from_environment(variable_map, defaults, environ=None):
+    """
+    Builds a dictionary of settings from environment variables.
+    'variable_map' maps internal setting names to environment variable names, and
+    'defaults' holds the value used when a variable is not set. Values read from
+    the environment are converted to the type of their default.
+
+    >>> settings_from_environment(
+    ...     {"size": "X_SIZE", "mode": "X_MODE", "on": "X_ON"},
+    ...     {"size": 10, "mode": "bulk", "on": False},
+    ...     {"X_SIZE": "25", "X_ON": "yes"},
+    ... ) == {"size": 25, "mode": "bulk", "on": True}
+    True
+    """
+    if environ is None:
+        environ = os.environ
+    settings = {}
+    for internal, external in variable_map.items():
+        default = defaults.get(internal)
+        value = environ.get(external)
+        if value is None or value == "":
+            settings[internal] = default
+        elif isinstance(default, bool):
+            settings[internal] = value.strip().lower() in ("1", "true", "yes", "on")
+        elif isinstance(default, (int, float)):
+            settings[internal] = type(default)(value)
+        else:
+            settings[internal] = value
+    return settings
 
 
 class LogType(Enum):
@@ -21,8 +54,12 @@ class CommonAppFramework:
 
     def __init__(self):
         """
-        Sets up default logging options
+        Sets up default logging options, the lowest level logged being set by
+        LOG_LEVEL (see argus.common.LogWriter for the other logging settings)
         """
+        from argus.common.LogWriter import log_writer
+
+        self.log_writer = log_writer()
         self.log_output = {}
         # set debug logging options
         self.log_output[LogType.CONSOLE] = True
@@ -30,14 +67,23 @@ class CommonAppFramework:
         for level in LogLevel:
             if not level in self.log_output:
                 self.log_output[level] = False
-        self.log_level = LogLevel.VERBOSE
+        self.log_level = LogLevel[
+            (os.environ.get("LOG_LEVEL") or LogLevel.INFO.name).strip().upper()
+        ]
+        # counters and timings, see argus.common.Metrics
+        from argus.common.Metrics import Metrics
+
+        self.metrics = Metrics()
         # log that we are starting up
         self.log("Starting {}".format(self.__class__.__name__))
 
-    def log(self, content="default log message", log_level=LogLevel.VERBOSE):
+    def log(self, content="default log message", log_level=LogLevel.VERBOSE, *args):
         """
         Central logging function for an application.
-        'content' can be anything at all, and is formatted into a string via pprint.
+        'content' can be anything at all. Strings are logged as they are, anything
+        else is formatted into a string via pprint.
+        If 'args' are given, 'content' is a format string they are formatted into,
+        only once the message is known to be written.
         'log_level' needs to be a valud from the LogLevel enum
         CommonAppFramework.log_output is an array (True|False)
           that determine which output streams log output goes to.
@@ -45,13 +91,17 @@ class CommonAppFramework:
         # if the event isn't a high enough level to be logged, ignore it
         if log_level.value < self.log_level.value:
             return
-        # otherwise, lets generate a nice human readable log string
-        from pprint import pformat
-
-        as_string = "{} {}".format(log_level.name, pformat(content))
-        # for each log type, check if enabled, and if so take action
+        # for each log type, check if enabled, and if so hand it to the writer
         if self.log_output[LogType.CONSOLE]:
-            print(as_string)
+            self.log_writer.write(
+                self.__class__.__name__, log_level, content, args, sys._getframe(1)
+            )
+
+    def flush_logs(self):
+        """
+        Waits until every message logged so far has been written.
+        """
+        self.log_writer.flush()
 
     def run(self):
         pass
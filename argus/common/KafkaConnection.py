@@ -10,6 +10,47 @@
                                         the access key, and no other information
         KAFKA_ACCESS_CERT_LOCATION  file location to load the Access Cert from
         KAFKA_CA_CERT_LOCAITON      file location to load the CA Cert from
+
+    Optional producer tuning:
+
+        KAFKA_SEND_MODE             'sync' (default) flushes after every message.
+                                        'async' queues messages and returns at once,
+                                        with delivery reported by callbacks and
+                                        counters. Call close() to drain the queue.
+        KAFKA_LINGER_MS             How long the producer waits to fill a batch
+        KAFKA_BATCH_SIZE            The largest batch (in bytes) per partition
+        KAFKA_COMPRESSION           none, gzip, snappy, lz4 or zstd
+        KAFKA_CODEC                 How message values are encoded: 'json' (default)
+                                        or 'struct', a compact binary layout (see
+                                        argus.common.data.wire). Consumers read
+                                        either, whatever this is set to.
+        KAFKA_DELTA_KEYFRAMES       Sends every this many-th heartbeat from each
+                                        producer whole, and those between as deltas
+                                        of it (see argus.common.data.delta). 0
+                                        (default) sends every heartbeat whole.
+
+    Optional consumer tuning:
+
+        KAFKA_MAX_POLL_RECORDS      The most messages returned by one fetch()
+        KAFKA_FETCH_MIN_BYTES       How much data the broker waits for before answering
+        KAFKA_FETCH_MAX_BYTES       The most data the broker returns per fetch
+        KAFKA_MAX_PARTITION_FETCH_BYTES  The most data returned per partition
+        KAFKA_FETCH_MAX_WAIT_MS     How long the broker waits for FETCH_MIN_BYTES
+        KAFKA_COMMIT_MODE           How commit() sends offsets to the group: 'sync'
+                                        waits for the broker, 'async' sends them
+                                        without waiting, and 'periodic' keeps the
+                                        newest and sends them (without waiting) every
+                                        KAFKA_COMMIT_INTERVAL_MS. Defaults to 'sync',
+                                        or to 'periodic' when the consumer resumes
+                                        from offsets stored elsewhere (see
+                                        start_consumer), which makes the group's
+                                        offsets only a fallback.
+        KAFKA_COMMIT_INTERVAL_MS    How often 'periodic' commits are sent (default
+                                        5000)
+
+    fetch() returns the messages of one poll as a list. fetch_batches() yields them
+    as the consumer returned them, one list per partition, with their values still
+    the bytes received, so they can be handed to the decoder without being copied.
 """
 
 
@@ -23,18 +64,49 @@ environment_variable_map = {
     "id": "KAFKA_MY_ID",
     "group": "KAFKA_GROUP_ID",
     "timeout": "KAFKA_CLIENT_TIMEOUT",
+    "send_mode": "KAFKA_SEND_MODE",
+    "linger_ms": "KAFKA_LINGER_MS",
+    "batch_size": "KAFKA_BATCH_SIZE",
+    "compression": "KAFKA_COMPRESSION",
+    "codec": "KAFKA_CODEC",
+    "max_poll_records": "KAFKA_MAX_POLL_RECORDS",
+    "fetch_min_bytes": "KAFKA_FETCH_MIN_BYTES",
+    "fetch_max_bytes": "KAFKA_FETCH_MAX_BYTES",
+    "max_partition_fetch_bytes": "KAFKA_MAX_PARTITION_FETCH_BYTES",
+    "fetch_max_wait_ms": "KAFKA_FETCH_MAX_WAIT_MS",
+    "commit_mode": "KAFKA_COMMIT_MODE",
+    "commit_interval_ms": "KAFKA_COMMIT_INTERVAL_MS",
+    "delta_keyframes": "KAFKA_DELTA_KEYFRAMES",
 }
 
 environment_variable_defaults = {
     "topic": "default",
     "group": "default",
     "timeout": 1000,
+    "send_mode": "sync",
+    "linger_ms": 20,
+    "batch_size": 65536,
+    "compression": "none",
+    "codec": "json",
+    "max_poll_records": 500,
+    "fetch_min_bytes": 1,
+    "fetch_max_bytes": 52428800,
+    "max_partition_fetch_bytes": 1048576,
+    "fetch_max_wait_ms": 500,
+    # chosen by start_consumer()
+    "commit_mode": "",
+    "commit_interval_ms": 5000,
+    "delta_keyframes": 0,
 }
 
 import os
 from argus.common.Common import LogLevel
-from kafka import KafkaProducer, KafkaConsumer
+from argus.common.data import delta, wire
+from kafka import ConsumerRebalanceListener, KafkaProducer, KafkaConsumer
+from kafka.structs import OffsetAndMetadata, TopicPartition
 import json
+import threading
+import time
 
 
 class KafkaConnection:
@@ -45,6 +117,18 @@ class KafkaConnection:
         """
         self.env = {}
         self.app = app
+        self.producer = None
+        self.consumer = None
+        self.stored_offsets = None
+        # 'periodic' commit mode: {partition: offset} not yet sent, and when the
+        # last were sent
+        self.pending_offsets = {}
+        self.committed_at = time.monotonic()
+        self.codec = None
+        # set by start_producer() when heartbeats are sent as deltas
+        self.deltas = None
+        self.delivery = {"queued": 0, "delivered": 0, "failed": 0}
+        self._delivery_lock = threading.Lock()
         self._parse_environment_variables(os.environ)
         self._verify_secrets_files()
 
@@ -62,6 +146,8 @@ class KafkaConnection:
                     self.env[internal] = environment_variable_defaults[internal]
                 else:
                     missing_env_vars.append(external)
+            elif isinstance(environment_variable_defaults.get(internal), int):
+                self.env[internal] = int(self.env[internal])
         if len(missing_env_vars) > 0:
             issue = (
                 "A connection to Kafta cannot be formed, as the following "
@@ -90,21 +176,30 @@ class KafkaConnection:
             if not os.path.isfile(path):
                 raise FileNotFoundError(path)
 
-    def start_producer(self, exception_passthrough=False):
+    def start_producer(self, exception_passthrough=False, codec=None):
         """ 
         Connects to Kafka in a producter role.
+        'codec' names the codec messages are encoded with, overriding KAFKA_CODEC.
+        Keys are always JSON, so a producer keeps its partition when its codec
+        changes.
         If set, 'exception_passthough' will raise any exception generated to be 
         managed upstream. Default behaviour is to log and ignore.
         """
+        compression = self.env["compression"].lower()
         try:
+            self.codec = wire.get_codec(codec or self.env["codec"])
+            if self.env["delta_keyframes"] > 1:
+                self.deltas = delta.DeltaEncoder(self.env["delta_keyframes"])
             self.producer = KafkaProducer(
                 bootstrap_servers="{}:{}".format(self.env["host"], self.env["port"]),
                 security_protocol="SSL",
                 ssl_cafile=self.env["ca_cert_file"],
                 ssl_certfile=self.env["access_cert_file"],
                 ssl_keyfile=self.env["key_file"],
-                value_serializer=lambda v: json.dumps(v).encode("ascii"),
                 key_serializer=lambda v: json.dumps(v).encode("ascii"),
+                linger_ms=self.env["linger_ms"],
+                batch_size=self.env["batch_size"],
+                compression_type=None if compression == "none" else compression,
                 api_version=(2, 6, 0),
             )
         except Exception as e:
@@ -115,14 +210,23 @@ class KafkaConnection:
             if exception_passthrough:
                 raise e
 
-    def start_consumer(self, exception_passthrough=False):
+    def start_consumer(self, exception_passthrough=False, stored_offsets=None):
         """
         Connects to Kafka in a consumer role.
+        Offsets are not committed automatically. Either fetch() commits them as it
+        polls, or the caller uses commit() once the messages have been stored.
+        'stored_offsets', if given, is called as stored_offsets(topic, partitions)
+        whenever partitions are assigned to the consumer, and returns
+        {partition: offset} for those the caller has stored offsets for (such as
+        alongside the messages in a database). Those partitions are read from the
+        stored offsets, rather than the group's committed offsets.
         If set, 'exception_passthrough' will raise any exception generated upstream.
         """
+        self.stored_offsets = stored_offsets
+        if self.env["commit_mode"] == "":
+            self.env["commit_mode"] = "sync" if stored_offsets is None else "periodic"
         try:
             self.consumer = KafkaConsumer(
-                self.env["topic"],
                 auto_offset_reset="earliest",
                 bootstrap_servers="{}:{}".format(self.env["host"], self.env["port"]),
                 client_id=self.env["id"],
@@ -131,8 +235,17 @@ class KafkaConnection:
                 ssl_cafile=self.env["ca_cert_file"],
                 ssl_certfile=self.env["access_cert_file"],
                 ssl_keyfile=self.env["key_file"],
+                enable_auto_commit=False,
+                max_poll_records=self.env["max_poll_records"],
+                fetch_min_bytes=self.env["fetch_min_bytes"],
+                fetch_max_bytes=self.env["fetch_max_bytes"],
+                max_partition_fetch_bytes=self.env["max_partition_fetch_bytes"],
+                fetch_max_wait_ms=self.env["fetch_max_wait_ms"],
                 api_version=(2, 6, 0),
             )
+            self.consumer.subscribe(
+                [self.env["topic"]], listener=_SeekToStoredOffsets(self)
+            )
             self.consumer_has_had_initial_call = False
         except Exception as e:
             self.app.log(
@@ -142,54 +255,356 @@ class KafkaConnection:
             if exception_passthrough:
                 raise e
 
-    def send(self, deserializer_name, data, exception_passthrough=False):
+    def send(
+        self,
+        deserializer_name,
+        data,
+        exception_passthrough=False,
+        on_delivery=None,
+        producer_id=None,
+        timestamp_ms=None,
+    ):
         """
         Sends a packet of data to Kafka, including the deserializer_name
         that is used on the other end to verify the data recieved.
+        In 'sync' send mode this waits for the broker to accept the message. In
+        'async' send mode the message is queued, and is sent once the producer's
+        batch fills or its linger time passes.
+        'on_delivery', if given, is called as on_delivery(metadata, exception) once
+        the broker has accepted (exception is None) or failed the message. The
+        'delivery' counters are updated either way.
+        'producer_id' sends the message as another producer (by default, the id
+        set by KAFKA_MY_ID), as when one process simulates several hosts.
+        'timestamp_ms' stamps the message with when its data was taken, rather than
+        when it is sent, for messages sent some time after.
+        With KAFKA_DELTA_KEYFRAMES set, heartbeats may be sent as deltas; should one
+        fail, the producer's next heartbeat is sent whole.
         'exception_passthrough' will pass up any exception generated.
         """
+        producer_id = producer_id or self.env["id"]
+        if self.deltas is not None and deserializer_name == "heartbeat":
+            deserializer_name, data = self.deltas.encode(producer_id, data)
         msg_data = {
-            "id": self.env["id"],
+            "id": producer_id,
             "deserializer": deserializer_name,
             "data": data,
         }
-        key = {"key": self.env["id"]}
+        key = {"key": producer_id}
         try:
-            self.producer.send(self.env["topic"], msg_data, key)
-            self.producer.flush()
+            future = self.producer.send(
+                self.env["topic"],
+                self.codec.encode(msg_data),
+                key,
+                timestamp_ms=timestamp_ms,
+            )
+            self._count_delivery("queued")
+            future.add_callback(self._delivered, on_delivery)
+            future.add_errback(self._delivery_failed, on_delivery, producer_id)
+            if self.env["send_mode"] != "async":
+                self.producer.flush()
         except Exception as e:
+            if self.deltas is not None:
+                self.deltas.reset(producer_id)
             self.app.log(
                 "Error sending message to Kafka. {}".format(str(e)), LogLevel.WARNING
             )
             if exception_passthrough:
                 raise e
 
-    def fetch(self, exception_passthrough=False):
+    def _count_delivery(self, outcome):
+        with self._delivery_lock:
+            self.delivery[outcome] += 1
+
+    def _delivered(self, on_delivery, metadata):
+        """
+        Producer callback for a message the broker has accepted.
+        """
+        self._count_delivery("delivered")
+        if on_delivery is not None:
+            on_delivery(metadata, None)
+
+    def _delivery_failed(self, on_delivery, producer_id, exception):
+        """
+        Producer callback for a message that could not be delivered.
+        """
+        self._count_delivery("failed")
+        if self.deltas is not None:
+            self.deltas.reset(producer_id)
+        self.app.log(
+            "Kafka failed to deliver message. {}".format(str(exception)),
+            LogLevel.WARNING,
+        )
+        if on_delivery is not None:
+            on_delivery(None, exception)
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every queued message has been sent (or 'timeout' seconds pass).
+        """
+        if self.producer is not None:
+            self.producer.flush(timeout=timeout)
+
+    def close(self, timeout=None):
+        """
+        Drains any queued messages and closes the producer and consumer.
+        Should be called on shutdown, as messages still queued in 'async' send mode
+        are otherwise lost.
+        """
+        if self.producer is not None:
+            try:
+                self.producer.flush(timeout=timeout)
+                self.producer.close(timeout=timeout)
+            except Exception as e:
+                self.app.log(
+                    "Error while closing Kafka producer. {}".format(str(e)),
+                    LogLevel.WARNING,
+                )
+            self.producer = None
+            self.app.log(
+                "Kafka producer closed: {queued} queued, {delivered} delivered, "
+                "{failed} failed".format(**self.delivery),
+                LogLevel.INFO,
+            )
+        if self.consumer is not None:
+            try:
+                self._send_pending_offsets(wait=True)
+                self.consumer.close()
+            except Exception as e:
+                self.app.log(
+                    "Error while closing Kafka consumer. {}".format(str(e)),
+                    LogLevel.WARNING,
+                )
+            self.consumer = None
+
+    def fetch(self, exception_passthrough=False, commit=True):
+        """
+        Fetches data from Kafka and returns the result, as one list.
+        Message values are left encoded; decode() turns one into the message sent.
+        If 'commit' is set, offsets are committed as soon as the poll returns. Callers
+        that store the messages should pass commit=False, and call commit() once the
+        messages are safely stored, so a crash can not lose them.
+        'exception_passthrough' will pass up any exception generated
+        """
+        result = []
+        for batch in self.fetch_batches(exception_passthrough, commit):
+            result.extend(batch)
+        return result
+
+    def fetch_batches(self, exception_passthrough=False, commit=True):
+        """
+        Polls Kafka, and yields the messages returned as the consumer returned them:
+        one list per partition, in offset order, values left as the bytes received.
+        On the first call the consumer has no partitions until it has polled once,
+        so it polls again if that poll returned nothing.
+        If 'commit' is set, the offsets are committed once every batch has been
+        taken.
+        'exception_passthrough' will pass up any exception generated
+        """
+        last = []
+        polls = 1 if self.consumer_has_had_initial_call else 2
+        self.consumer_has_had_initial_call = True
+        for poll in range(polls):
+            try:
+                raw_msg = self.consumer.poll(timeout_ms=self.env["timeout"])
+            except Exception as e:
+                self.app.log(
+                    "Error encountered while polling Kafka for new objects. {}".format(
+                        str(e)
+                    ),
+                    LogLevel.WARNING,
+                )
+                if exception_passthrough:
+                    raise e
+                return
+            for msgs in raw_msg.values():
+                last.append(msgs[-1])
+                yield msgs
+            if len(raw_msg) > 0:
+                break
+        if commit:
+            self.commit(last, exception_passthrough)
+
+    def decode(self, message):
+        """
+        Returns the message sent (with 'id', 'deserializer' and 'data') from a
+        fetched message, in whichever codec it was encoded.
         """
-        Fetches data from Kafka and returns the result. 
-        If this is the first call, it will call itself again as documentation references
-        the first call only assigning a topic partition and not returning any of the
-        data included.
+        return wire.decode(message.value)
+
+    def commit(self, messages, exception_passthrough=False):
+        """
+        Commits the offsets that follow 'messages' (as returned by fetch()), so
+        that the consumer group resumes after them, as set by KAFKA_COMMIT_MODE.
+        Returns True if the commit succeeded (or, unless in 'sync' commit mode,
+        was queued).
         'exception_passthrough' will pass up any exception generated
         """
+        # by partition, as the consumer reads one topic; one TopicPartition each
+        newest = {}
+        for msg in messages:
+            current = newest.get(msg.partition)
+            if current is None or msg.offset >= current.offset:
+                newest[msg.partition] = msg
+        if len(newest) == 0:
+            return True
+        offsets = {
+            TopicPartition(msg.topic, msg.partition): _offset_after(msg)
+            for msg in newest.values()
+        }
         try:
-            raw_msg = self.consumer.poll(timeout_ms=self.env["timeout"])
+            if self.env["commit_mode"] == "async":
+                self.consumer.commit_async(offsets, callback=self._commit_sent)
+            elif self.env["commit_mode"] == "periodic":
+                self.pending_offsets.update(offsets)
+                self._send_pending_offsets()
+            else:
+                self.consumer.commit(offsets)
+            return True
         except Exception as e:
             self.app.log(
-                "Error encountered while polling Kafka for new objects. {}".format(
-                    str(e)
-                ),
+                "Error encountered while committing Kafka offsets. {}".format(str(e)),
                 LogLevel.WARNING,
             )
             if exception_passthrough:
                 raise e
-            return []
-        result = []
-        for topic_partition, msgs in raw_msg.items():
-            for msg in msgs:
-                result.append(msg)
-        self.consumer.commit()
-        if not self.consumer_has_had_initial_call:
-            self.consumer_has_had_initial_call = True
-            return self.fetch()
+            return False
+
+    def _send_pending_offsets(self, wait=False):
+        """
+        Sends the offsets held back in 'periodic' commit mode, if the commit
+        interval has passed (or waiting for them to be committed, if 'wait' is set).
+        """
+        if len(self.pending_offsets) == 0:
+            return
+        now = time.monotonic()
+        if wait:
+            self.consumer.commit(self.pending_offsets)
+        elif (now - self.committed_at) * 1000 >= self.env["commit_interval_ms"]:
+            self.consumer.commit_async(self.pending_offsets, callback=self._commit_sent)
+        else:
+            return
+        self.pending_offsets = {}
+        self.committed_at = now
+
+    def _commit_sent(self, offsets, response):
+        """
+        Callback for an asynchronous commit, run by the consumer during a poll.
+        """
+        if isinstance(response, Exception):
+            self.app.log(
+                "Kafka refused an offset commit. {}".format(str(response)),
+                LogLevel.WARNING,
+            )
+
+    def rewind_to_committed(self):
+        """
+        Moves the consumer back to the stored offset (see start_consumer) or else
+        the group's committed offset on every assigned partition (or to the start,
+        where there is neither), so that everything fetched but not committed is
+        fetched again.
+        """
+        assigned = self.consumer.assignment()
+        stored = self._stored_offsets(assigned)
+        for topic_partition in assigned:
+            if topic_partition.partition in stored:
+                self.consumer.seek(topic_partition, stored[topic_partition.partition])
+                continue
+            committed = self.consumer.committed(topic_partition)
+            if committed is None:
+                self.consumer.seek_to_beginning(topic_partition)
+            else:
+                self.consumer.seek(topic_partition, committed)
+
+    def seek_to_stored(self, assigned):
+        """
+        Moves the consumer to the stored offset (see start_consumer) of each newly
+        'assigned' TopicPartition that has one.
+        """
+        stored = self._stored_offsets(assigned)
+        for topic_partition in assigned:
+            if topic_partition.partition in stored:
+                self.consumer.seek(topic_partition, stored[topic_partition.partition])
+        if len(stored) > 0:
+            self.app.log(
+                "Resuming partition(s) {} from their stored offsets".format(
+                    ", ".join(str(partition) for partition in sorted(stored))
+                ),
+                LogLevel.INFO,
+            )
+
+    def _stored_offsets(self, assigned):
+        if self.stored_offsets is None or len(assigned) == 0:
+            return {}
+        try:
+            return self.stored_offsets(
+                self.env["topic"],
+                sorted(topic_partition.partition for topic_partition in assigned),
+            )
+        except Exception as e:
+            # the group's committed offsets are still safe to resume from
+            self.app.log(
+                "Unable to read stored offsets, using the group's. {}".format(str(e)),
+                LogLevel.WARNING,
+            )
+            return {}
+
+    def lag(self):
+        """
+        Returns {partition: messages not yet fetched} for each assigned partition.
+        Uses the high water marks the consumer learns from each fetch, so it costs no
+        request to the broker; partitions not fetched from yet are left out.
+        """
+        result = {}
+        try:
+            for topic_partition in self.consumer.assignment():
+                highwater = self.consumer.highwater(topic_partition)
+                if highwater is not None:
+                    result[topic_partition.partition] = max(
+                        0, highwater - self.consumer.position(topic_partition)
+                    )
+        except Exception as e:
+            self.app.log(
+                "Error encountered while checking consumer lag. {}".format(str(e)),
+                LogLevel.WARNING,
+            )
         return result
+
+    def rewind(self, messages):
+        """
+        Moves the consumer back to the earliest of 'messages' on each partition, so
+        that the next fetch() returns them again.
+        """
+        earliest = {}
+        for msg in messages:
+            topic_partition = TopicPartition(msg.topic, msg.partition)
+            earliest[topic_partition] = min(
+                msg.offset, earliest.get(topic_partition, msg.offset)
+            )
+        for topic_partition, offset in earliest.items():
+            self.consumer.seek(topic_partition, offset)
+
+
+class _SeekToStoredOffsets(ConsumerRebalanceListener):
+    """
+    Seeks newly assigned partitions to their stored offsets, if there are any.
+    Called by the consumer during poll().
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def on_partitions_revoked(self, revoked):
+        pass
+
+    def on_partitions_assigned(self, assigned):
+        self.connection.seek_to_stored(assigned)
+
+
+def _offset_after(msg):
+    """
+    Builds the commit position that follows 'msg'. OffsetAndMetadata gained a
+    leader_epoch field in kafka-python 2.1, so only the shared fields are given.
+    """
+    fields = [msg.offset + 1, ""]
+    fields += [-1] * (len(OffsetAndMetadata._fields) - len(fields))
+    return OffsetAndMetadata(*fields)
@@ -0,0 +1,228 @@
+"""
+    The backend of CommonAppFramework.log. Messages are formatted and written on a
+    background thread, fed through a bounded queue, so logging costs the caller
+    little more than the level check. One LogWriter is shared by every application
+    in a process (see log_writer()).
+
+    Messages can be given as a format string and its arguments, which are only
+    formatted if the message is written:
+
+        self.log("{} decoded from {}", LogLevel.VERBOSE, deserializer, producer)
+
+    Below CRITICAL, messages from one line of code are limited to LOG_RATE_LIMIT a
+    second; the next message written from that line says how many were suppressed.
+    This keeps a message logged per record from flooding the output.
+
+    Settings are read from environment variables:
+
+        LOG_LEVEL           The lowest level logged: VERBOSE, DEBUG, INFO (default),
+                                WARNING or CRITICAL
+        LOG_FORMAT          'text' (default) writes '<LEVEL> <message>' lines. 'json'
+                                writes one JSON object per line, with the time,
+                                level, application, message and the line of code
+                                that logged it.
+        LOG_MODE            'async' (default) writes on a background thread.
+                                'sync' writes before log() returns.
+        LOG_QUEUE_SIZE      The most messages waiting to be written (default 10000)
+        LOG_FULL_POLICY     When the queue is full, 'drop' (default) discards the
+                                message, and later reports how many were dropped.
+                                'block' waits for room.
+        LOG_RATE_LIMIT      Messages per second allowed from each line of code
+                                (default 20, 0 for no limit)
+
+    >>> import json
+    >>> writer = LogWriter({"format": "json", "mode": "sync", "queue_size": 10,
+    ...                     "full_policy": "drop", "rate_limit": 2})
+    >>> for i in range(5):
+    ...     writer.write("Test", LogLevel.INFO, "message {}", (i,), sys._getframe(0))
+    ... # doctest: +ELLIPSIS
+    {"time": "...", "level": "INFO", "app": "Test", "message": "message 0", "site": "..."}
+    {"time": "...", "level": "INFO", "app": "Test", "message": "message 1", "site": "..."}
+    >>> writer.limiter.sites[next(iter(writer.limiter.sites))][2]
+    3
+    >>> writer = LogWriter({"format": "text", "mode": "async", "queue_size": 10,
+    ...                     "full_policy": "block", "rate_limit": 0})
+    >>> writer.write("Test", LogLevel.WARNING, {"a": 1}, (), sys._getframe(0))
+    >>> writer.flush()
+    WARNING {'a': 1}
+"""
+
+from argus.common.Common import LogLevel, settings_from_environment
+from datetime import datetime, timezone
+from pprint import pformat
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+environment_variable_map = {
+    "format": "LOG_FORMAT",
+    "mode": "LOG_MODE",
+    "queue_size": "LOG_QUEUE_SIZE",
+    "full_policy": "LOG_FULL_POLICY",
+    "rate_limit": "LOG_RATE_LIMIT",
+}
+
+environment_variable_defaults = {
+    "format": "text",
+    "mode": "async",
+    "queue_size": 10000,
+    "full_policy": "drop",
+    "rate_limit": 20.0,
+}
+
+
+class RateLimiter:
+    """
+    A token bucket per call site, each holding up to a second's worth of messages.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        # per site: [tokens, time last refilled, messages suppressed since last]
+        self.sites = {}
+        self._lock = threading.Lock()
+
+    def allow(self, site, now):
+        """
+        Returns None if a message from 'site' should be suppressed, or else the
+        number suppressed since the last one allowed.
+        """
+        with self._lock:
+            state = self.sites.get(site)
+            if state is None:
+                state = self.sites[site] = [self.rate, now, 0]
+            else:
+                state[0] = min(self.rate, state[0] + (now - state[1]) * self.rate)
+                state[1] = now
+            if state[0] < 1:
+                state[2] += 1
+                return None
+            state[0] -= 1
+            suppressed = state[2]
+            state[2] = 0
+            return suppressed
+
+
+class LogWriter:
+    """
+    Formats and writes log messages, on a background thread unless 'mode' is 'sync'.
+    """
+
+    def __init__(self, settings=None):
+        if settings is None:
+            settings = settings_from_environment(
+                environment_variable_map, environment_variable_defaults
+            )
+        self.settings = settings
+        self.limiter = RateLimiter(settings["rate_limit"])
+        self.block = settings["full_policy"] == "block"
+        self.dropped = 0
+        self.pid = os.getpid()
+        self.queue = None
+        if settings["mode"] != "sync":
+            self.queue = queue.Queue(maxsize=max(1, settings["queue_size"]))
+            threading.Thread(target=self._drain, name="log-writer", daemon=True).start()
+
+    def write(self, app_name, log_level, content, args, frame):
+        """
+        Queues a message, logged at 'log_level' by the application 'app_name' from
+        the code running in 'frame'. 'content' is formatted with 'args', if there
+        are any, once it is being written.
+        """
+        now = time.time()
+        site = (frame.f_code.co_filename, frame.f_lineno)
+        suppressed = 0
+        if self.limiter.rate > 0 and log_level.value < LogLevel.CRITICAL.value:
+            suppressed = self.limiter.allow(site, now)
+            if suppressed is None:
+                return
+        record = (now, log_level, app_name, content, args, site, suppressed)
+        if self.queue is None:
+            self._output(record)
+            return
+        try:
+            self.queue.put(record, block=self.block)
+        except queue.Full:
+            # not locked: an occasional miscount is better than slowing every caller
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Waits until every queued message has been written.
+        """
+        if self.queue is not None:
+            self.queue.join()
+        sys.stdout.flush()
+
+    def _drain(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self._output(record)
+                if self.dropped > 0:
+                    dropped, self.dropped = self.dropped, 0
+                    self._output(
+                        (
+                            time.time(),
+                            LogLevel.WARNING,
+                            record[2],
+                            "{} log message(s) dropped, as the log queue was full",
+                            (dropped,),
+                            (__file__, 0),
+                            0,
+                        )
+                    )
+                if self.queue.empty():
+                    sys.stdout.flush()
+            except Exception:
+                # a message that can not be written must not stop the writer
+                pass
+            finally:
+                self.queue.task_done()
+
+    def _output(self, record):
+        moment, log_level, app_name, content, args, site, suppressed = record
+        if len(args) > 0:
+            message = content.format(*args)
+        elif isinstance(content, str):
+            message = content
+        else:
+            message = pformat(content)
+        if self.settings["format"] == "json":
+            entry = {
+                "time": datetime.fromtimestamp(moment, timezone.utc).isoformat(),
+                "level": log_level.name,
+                "app": app_name,
+                "message": message,
+                "site": "{}:{}".format(os.path.basename(site[0]), site[1]),
+            }
+            if suppressed > 0:
+                entry["suppressed"] = suppressed
+            line = json.dumps(entry)
+        else:
+            line = "{} {}".format(log_level.name, message)
+            if suppressed > 0:
+                line += " ({} similar message(s) suppressed)".format(suppressed)
+        # looked up each time, so redirecting stdout (as doctest does) is honoured
+        sys.stdout.write(line + "\n")
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def log_writer():
+    """
+    Returns the process's LogWriter, creating it on first use (and again in a
+    forked child, whose copy of the writer thread is not running).
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid():
+            _writer = LogWriter()
+            atexit.register(_writer.flush)
+        return _writer
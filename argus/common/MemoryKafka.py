@@ -0,0 +1,370 @@
+"""
+    An in-memory stand-in for Kafka, for tests and benchmarks that must run without a
+    broker or network.
+
+    MemoryBroker holds one topic split into partitions, and the consumer groups
+    reading it: their members, which partitions each member is assigned (ranges of
+    partitions, spread over the members in name order) and their committed offsets.
+    MemoryKafkaConnection has the same methods as KafkaConnection, and talks to a
+    MemoryBroker instead of Kafka.
+
+    A MemoryBroker can be used directly within one process. To share one between
+    processes, start a MemoryKafkaManager and create the broker through it:
+
+        manager = MemoryKafkaManager()
+        manager.start()
+        broker = manager.MemoryBroker(partitions=6)
+
+    >>> broker = MemoryBroker(partitions=2)
+    >>> producer = MemoryKafkaConnection(None, broker, client_id="host-1")
+    >>> producer.start_producer()
+    >>> for i in range(3):
+    ...     producer.send("heartbeat", {"n": i})
+    >>> consumer = MemoryKafkaConnection(None, broker, client_id="reader")
+    >>> consumer.start_consumer()
+    >>> messages = consumer.fetch(commit=False)
+    >>> [json.loads(m.value)["data"] for m in messages]
+    [{'n': 0}, {'n': 1}, {'n': 2}]
+    >>> consumer.rewind(messages[1:])
+    >>> [m.offset for m in consumer.fetch(commit=False)]
+    [1, 2]
+    >>> consumer.commit(messages)
+    True
+    >>> consumer.lag()
+    {0: 0, 1: 0}
+    >>> consumer.close()
+    >>> packed = MemoryKafkaConnection(None, broker, client_id="host-2")
+    >>> packed.start_producer(codec="struct")
+    >>> packed.send("cpu_load", ["7"])
+    >>> reader = MemoryKafkaConnection(None, broker, client_id="reader")
+    >>> reader.start_consumer()
+    >>> [[reader.decode(m)["data"] for m in batch] for batch in reader.fetch_batches()]
+    [[['7']]]
+    >>> reader.close()
+    >>> later = MemoryKafkaConnection(None, broker, client_id="reader")
+    >>> later.start_consumer()
+    >>> later.fetch()
+    []
+    >>> resumed = MemoryKafkaConnection(None, broker, client_id="reader", group="new")
+    >>> resumed.start_consumer(stored_offsets=lambda topic, partitions: {0: 2})
+    >>> [(m.partition, m.offset) for m in resumed.fetch()]
+    [(0, 2), (1, 0)]
+"""
+
+from argus.common.Common import LogLevel
+from argus.common.data import delta, wire
+from collections import namedtuple
+from multiprocessing.managers import SyncManager
+import json
+import threading
+import time
+import uuid
+import zlib
+
+MemoryRecord = namedtuple(
+    "MemoryRecord",
+    ["topic", "partition", "offset", "timestamp", "timestamp_type", "key", "value"],
+)
+
+
+class MemoryBroker:
+    """
+    Stores the messages of one topic, and the membership, partition assignment and
+    committed offsets of each consumer group reading it. All methods are safe to
+    call from several threads (as a MemoryKafkaManager does).
+    """
+
+    def __init__(self, partitions=1, topic="default"):
+        self.topic = topic
+        self.partitions = [[] for partition in range(partitions)]
+        self.groups = {}
+        self._lock = threading.Lock()
+
+    def produce(self, key, value, partition=None, timestamp_ms=None):
+        """
+        Appends a message (as bytes) to the topic. Without a 'partition', messages
+        with the same key always go to the same partition. Without a
+        'timestamp_ms', the message is stamped with the time now.
+        Returns the (partition, offset) the message was stored at.
+        """
+        if partition is None:
+            partition = zlib.crc32(key) % len(self.partitions)
+        if timestamp_ms is None:
+            timestamp_ms = int(time.time() * 1000)
+        with self._lock:
+            log = self.partitions[partition]
+            log.append((key, value, timestamp_ms))
+            return partition, len(log) - 1
+
+    def join(self, group, member):
+        """
+        Adds 'member' to a consumer group, which reassigns the group's partitions.
+        """
+        with self._lock:
+            state = self._group(group)
+            if member not in state["members"]:
+                state["members"].append(member)
+                state["generation"] += 1
+
+    def leave(self, group, member):
+        """
+        Removes 'member' from a consumer group, reassigning its partitions.
+        """
+        with self._lock:
+            state = self._group(group)
+            if member in state["members"]:
+                state["members"].remove(member)
+                state["generation"] += 1
+
+    def assignment(self, group, member):
+        """
+        Returns (generation, partitions) for a member of a group. The generation
+        changes every time the group's membership does.
+        """
+        with self._lock:
+            state = self._group(group)
+            return state["generation"], self._assigned(state, member)
+
+    def committed(self, group, partition):
+        """
+        Returns the group's committed offset for a partition (0 if none).
+        """
+        with self._lock:
+            return self._group(group)["offsets"].get(partition, 0)
+
+    def commit(self, group, member, generation, offsets):
+        """
+        Stores committed offsets ({partition: offset}) for a group. Like Kafka, this
+        is refused if the group has rebalanced since 'generation', or if a partition
+        is not assigned to 'member'.
+        Returns True if the offsets were stored.
+        """
+        with self._lock:
+            state = self._group(group)
+            if generation != state["generation"]:
+                return False
+            assigned = self._assigned(state, member)
+            if any(partition not in assigned for partition in offsets):
+                return False
+            state["offsets"].update(offsets)
+            return True
+
+    def fetch(self, partition, offset, max_records):
+        """
+        Returns up to 'max_records' MemoryRecords from a partition, from 'offset' on.
+        """
+        with self._lock:
+            log = self.partitions[partition][offset : offset + max_records]
+        return [
+            MemoryRecord(self.topic, partition, offset + i, timestamp, 0, key, value)
+            for i, (key, value, timestamp) in enumerate(log)
+        ]
+
+    def end_offsets(self):
+        """
+        Returns the offset the next message will get on each partition.
+        """
+        with self._lock:
+            return [len(log) for log in self.partitions]
+
+    def members(self, group):
+        with self._lock:
+            return list(self._group(group)["members"])
+
+    def _group(self, group):
+        if group not in self.groups:
+            self.groups[group] = {"members": [], "generation": 0, "offsets": {}}
+        return self.groups[group]
+
+    def _assigned(self, state, member):
+        """
+        Range assignment: partitions are split into contiguous runs, one per member
+        in name order, with earlier members taking any remainder.
+        """
+        members = sorted(state["members"])
+        if member not in members:
+            return []
+        share, extra = divmod(len(self.partitions), len(members))
+        index = members.index(member)
+        start = index * share + min(index, extra)
+        return list(range(start, start + share + (1 if index < extra else 0)))
+
+
+class MemoryKafkaManager(SyncManager):
+    """
+    A multiprocessing manager that can serve a MemoryBroker to several processes.
+    """
+
+
+MemoryKafkaManager.register("MemoryBroker", MemoryBroker)
+
+
+class MemoryKafkaConnection:
+    """
+    Stands in for KafkaConnection, using a MemoryBroker instead of Kafka.
+    Messages are serialised in the same way as KafkaConnection.
+    """
+
+    def __init__(self, app, broker, client_id="memory", group="default", max_poll_records=500):
+        self.app = app
+        self.broker = broker
+        self.env = {
+            "id": client_id,
+            "group": group,
+            "topic": "default",
+            "max_poll_records": max_poll_records,
+            "send_mode": "sync",
+            "codec": "json",
+            "delta_keyframes": 0,
+        }
+        self.codec = wire.JSONCodec()
+        self.deltas = None
+        self.delivery = {"queued": 0, "delivered": 0, "failed": 0}
+        self.member = None
+        self.generation = None
+        self.positions = {}
+        self.stored_offsets = None
+
+    def start_producer(self, exception_passthrough=False, codec=None):
+        self.codec = wire.get_codec(codec or self.env["codec"])
+        if self.env["delta_keyframes"] > 1:
+            self.deltas = delta.DeltaEncoder(self.env["delta_keyframes"])
+
+    def start_consumer(self, exception_passthrough=False, stored_offsets=None):
+        self.stored_offsets = stored_offsets
+        self.member = "{}-{}".format(self.env["id"], uuid.uuid4().hex)
+        self.broker.join(self.env["group"], self.member)
+
+    def send(
+        self,
+        deserializer_name,
+        data,
+        exception_passthrough=False,
+        on_delivery=None,
+        producer_id=None,
+        timestamp_ms=None,
+    ):
+        producer_id = producer_id or self.env["id"]
+        if self.deltas is not None and deserializer_name == "heartbeat":
+            deserializer_name, data = self.deltas.encode(producer_id, data)
+        msg_data = {
+            "id": producer_id,
+            "deserializer": deserializer_name,
+            "data": data,
+        }
+        key = json.dumps({"key": producer_id}).encode("ascii")
+        self.delivery["queued"] += 1
+        try:
+            partition, offset = self.broker.produce(
+                key, self.codec.encode(msg_data), timestamp_ms=timestamp_ms
+            )
+        except Exception as e:
+            self.delivery["failed"] += 1
+            if self.deltas is not None:
+                self.deltas.reset(producer_id)
+            self._log("Error sending message to memory broker. {}".format(str(e)))
+            if on_delivery is not None:
+                on_delivery(None, e)
+            if exception_passthrough:
+                raise e
+            return
+        self.delivery["delivered"] += 1
+        if on_delivery is not None:
+            on_delivery((partition, offset), None)
+
+    def flush(self, timeout=None):
+        pass
+
+    def fetch(self, exception_passthrough=False, commit=True):
+        """
+        Returns up to 'max_poll_records' messages from the partitions assigned to
+        this consumer, picking up from the group's committed offsets whenever the
+        group has rebalanced.
+        """
+        result = []
+        for batch in self.fetch_batches(exception_passthrough, commit):
+            result.extend(batch)
+        return result
+
+    def fetch_batches(self, exception_passthrough=False, commit=True):
+        """
+        Yields the messages fetch() would return, one list per partition.
+        """
+        self._check_assignment()
+        fetched = 0
+        last = []
+        for partition in sorted(self.positions):
+            wanted = self.env["max_poll_records"] - fetched
+            if wanted <= 0:
+                break
+            records = self.broker.fetch(partition, self.positions[partition], wanted)
+            if len(records) > 0:
+                self.positions[partition] = records[-1].offset + 1
+                fetched += len(records)
+                last.append(records[-1])
+                yield records
+        if commit:
+            self.commit(last)
+
+    def decode(self, message):
+        return wire.decode(message.value)
+
+    def commit(self, messages, exception_passthrough=False):
+        offsets = {}
+        for msg in messages:
+            offsets[msg.partition] = max(msg.offset + 1, offsets.get(msg.partition, 0))
+        if len(offsets) == 0:
+            return True
+        if self.broker.commit(self.env["group"], self.member, self.generation, offsets):
+            return True
+        self._log("Memory broker refused offset commit after a rebalance")
+        if exception_passthrough:
+            raise Exception("Offset commit refused after a rebalance")
+        return False
+
+    def rewind_to_committed(self):
+        self.positions = self._resume_positions(self.positions)
+
+    def lag(self):
+        end_offsets = self.broker.end_offsets()
+        return {
+            partition: end_offsets[partition] - position
+            for partition, position in self.positions.items()
+        }
+
+    def rewind(self, messages):
+        for msg in messages:
+            if msg.partition in self.positions:
+                self.positions[msg.partition] = min(
+                    msg.offset, self.positions[msg.partition]
+                )
+
+    def close(self, timeout=None):
+        if self.member is not None:
+            self.broker.leave(self.env["group"], self.member)
+            self.member = None
+
+    def _check_assignment(self):
+        generation, partitions = self.broker.assignment(self.env["group"], self.member)
+        if generation != self.generation:
+            self.generation = generation
+            self.positions = self._resume_positions(partitions)
+
+    def _resume_positions(self, partitions):
+        """
+        Returns {partition: offset to read from}: the stored offset, if there is
+        one (see KafkaConnection.start_consumer), or else the committed offset.
+        """
+        stored = {}
+        if self.stored_offsets is not None and len(partitions) > 0:
+            stored = self.stored_offsets(self.env["topic"], sorted(partitions))
+        return {
+            partition: stored.get(
+                partition, self.broker.committed(self.env["group"], partition)
+            )
+            for partition in partitions
+        }
+
+    def _log(self, message):
+        if self.app is not None:
+            self.app.log(message, LogLevel.WARNING)
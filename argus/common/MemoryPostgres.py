@@ -0,0 +1,170 @@
+"""
+    An in-process stand-in for a Postgres connection, for benchmarks that must run
+    without a database server.
+
+    MemoryPostgresConnection has the same methods as PostgresConnection. Its
+    connection and cursors accept the statements Caterpillar writes with (including
+    psycopg2's execute_values) but do not run them: they only count the statements
+    and rows sent to each table, and how many of those were committed. Timings taken
+    against it are of the application's own work, with none of the database's. The
+    names of the tables and indexes created are kept, so that looking one up (as
+    tables.index_exists does) finds it.
+
+    >>> from psycopg2.extras import execute_values
+    >>> postgres = MemoryPostgresConnection(None)
+    >>> postgres.connect()
+    >>> cursor = postgres.db_connection.cursor()
+    >>> execute_values(cursor, "INSERT INTO heartbeat (a, b) VALUES %s;", [(1, 2), (3, 4)])
+    >>> cursor.execute("INSERT INTO heartbeat_latest (a) VALUES (%s);", (1,))
+    >>> postgres.db_connection.commit()
+    >>> cursor.execute("INSERT INTO heartbeat (a, b) VALUES (%s, %s);", (5, 6))
+    >>> postgres.db_connection.rollback()
+    >>> postgres.db_connection.committed
+    {'heartbeat': 2, 'heartbeat_latest': 1}
+    >>> postgres.disconnect()
+    >>> cursor.execute("SELECT 1;")
+    Traceback (most recent call last):
+    ...
+    psycopg2.InterfaceError: connection already closed
+"""
+
+from contextlib import contextmanager
+import psycopg2
+
+
+class MemoryDatabase:
+    """
+    Stands in for a psycopg2 connection, counting the rows written to each table.
+    """
+
+    encoding = "UTF8"
+
+    def __init__(self):
+        self.closed = 0
+        self.pending = {}
+        self.committed = {}
+        self.statements = 0
+        self.commits = 0
+        # tables and indexes, in the order they were created
+        self.created = []
+
+    def cursor(self):
+        self._check_open()
+        return MemoryCursor(self)
+
+    def commit(self):
+        self._check_open()
+        for table, rows in self.pending.items():
+            self.committed[table] = self.committed.get(table, 0) + rows
+        self.pending = {}
+        self.commits += 1
+
+    def rollback(self):
+        self._check_open()
+        self.pending = {}
+
+    def set_session(self, **kwargs):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+    def _check_open(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("connection already closed")
+
+
+class MemoryCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.closed = False
+        self.rowcount = -1
+        self._mogrified = 0
+        self._row = None
+
+    def mogrify(self, template, args):
+        # execute_values builds one statement from many of these
+        self._mogrified += 1
+        return b"()"
+
+    def execute(self, sql, params=None):
+        self.connection._check_open()
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        words = sql.split()
+        rows = 0
+        if len(words) > 2 and words[0].upper() == "INSERT":
+            rows = self._mogrified or 1
+            table = words[2]
+            self.connection.pending[table] = self.connection.pending.get(table, 0) + rows
+        elif len(words) > 2 and words[0].upper() == "CREATE":
+            name = _created_name(words)
+            if name is not None and name not in self.connection.created:
+                self.connection.created.append(name)
+        elif "to_regclass" in sql and "IS NOT NULL" in sql:
+            self._row = (params[0] in self.connection.created,)
+        self._mogrified = 0
+        self.rowcount = rows
+        self.connection.statements += 1
+
+    def fetchone(self):
+        row, self._row = self._row, None
+        return row
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        self.closed = True
+
+
+def _created_name(words):
+    """
+    The name of the table or index a CREATE statement (split into words) makes.
+    """
+    upper = [word.upper() for word in words]
+    for kind in ("TABLE", "INDEX"):
+        if kind in upper:
+            rest = words[upper.index(kind) + 1 :]
+            if [word.upper() for word in rest[:3]] == ["IF", "NOT", "EXISTS"]:
+                rest = rest[3:]
+            return rest[0].split("(")[0] if rest else None
+    return None
+
+
+class MemoryPostgresConnection:
+    """
+    Stands in for PostgresConnection, using a MemoryDatabase.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.db_connection = None
+
+    def connect(self):
+        self.db_connection = MemoryDatabase()
+
+    def disconnect(self):
+        self.db_connection.close()
+
+    def ensure_connected(self):
+        if self.db_connection is None or self.db_connection.closed:
+            self.connect()
+        return True
+
+    def getconn(self):
+        return MemoryDatabase()
+
+    def putconn(self, connection, close=False):
+        connection.close()
+
+    @contextmanager
+    def connection(self):
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def execute_prepared(self, cursor, sql, params=()):
+        cursor.execute(sql, params)
@@ -0,0 +1,316 @@
+"""
+    Counters, gauges and histograms that an application records as it runs, shown in
+    the Prometheus text format on an optional HTTP endpoint and/or written to a file.
+
+    Every CommonAppFramework has one as 'self.metrics'. Recording a value takes a
+    dictionary lookup and a short lock, and histograms keep fixed bucket counts
+    rather than every value, so metrics are cheap enough to leave on.
+
+    Settings are read from environment variables:
+
+        METRICS_PORT            Serves the metrics at http://METRICS_HOST:<port>/metrics
+                                    (default 0, no endpoint)
+        METRICS_HOST            The address the endpoint listens on (default
+                                    127.0.0.1, this machine only)
+        METRICS_FILE            A file the metrics are written to, every
+                                    METRICS_FILE_INTERVAL seconds and on exit, such
+                                    as for node_exporter's textfile collector
+                                    (default '', no file)
+        METRICS_FILE_INTERVAL   Seconds between writes of METRICS_FILE (default 15)
+
+    >>> metrics = Metrics(prefix="test")
+    >>> fetched = metrics.counter("messages_total", "Messages read.", ["partition"])
+    >>> fetched.inc(3, ("0",))
+    >>> fetched.inc(labels=("1",))
+    >>> seconds = metrics.histogram("poll_seconds", "Time per poll.", buckets=(0.1, 1))
+    >>> for value in (0.05, 0.5, 2):
+    ...     seconds.observe(value)
+    >>> metrics.gauge("lag", "Messages behind.").set(7)
+    >>> print(metrics.exposition(), end="")
+    # HELP test_lag Messages behind.
+    # TYPE test_lag gauge
+    test_lag 7
+    # HELP test_messages_total Messages read.
+    # TYPE test_messages_total counter
+    test_messages_total{partition="0"} 3
+    test_messages_total{partition="1"} 1
+    # HELP test_poll_seconds Time per poll.
+    # TYPE test_poll_seconds histogram
+    test_poll_seconds_bucket{le="0.1"} 1
+    test_poll_seconds_bucket{le="1"} 2
+    test_poll_seconds_bucket{le="+Inf"} 3
+    test_poll_seconds_sum 2.55
+    test_poll_seconds_count 3
+    >>> metrics.counter("messages_total", "Messages read.", ["partition"]) is fetched
+    True
+    >>> percentiles([5, 1, 4, 2, 3], points=(50,))
+    {'p50': 3, 'max': 5}
+"""
+
+from argus.common.Common import settings_from_environment
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+import os
+import threading
+
+environment_variable_map = {
+    "port": "METRICS_PORT",
+    "host": "METRICS_HOST",
+    "file": "METRICS_FILE",
+    "file_interval": "METRICS_FILE_INTERVAL",
+}
+
+environment_variable_defaults = {
+    "port": 0,
+    "host": "127.0.0.1",
+    "file": "",
+    "file_interval": 15.0,
+}
+
+# in seconds, from a fast local call to a slow database write
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+# for counts of items, such as messages per batch
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Returns {"p<n>": value} for each of 'points', and the "max", of 'values'
+    (nearest rank).
+    """
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return {}
+    result = {
+        "p{}".format(point): ordered[min(len(ordered) - 1, len(ordered) * point // 100)]
+        for point in points
+    }
+    result["max"] = ordered[-1]
+    return result
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+
+class Counter:
+    """
+    A count that only goes up, such as messages read. One value is kept per set of
+    label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield self.name, _label_text(self.label_names, labels), value
+
+
+class Gauge(Counter):
+    """
+    A value that can go up and down, such as consumer lag.
+    """
+
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self.values[labels] = value
+
+
+class Histogram:
+    """
+    Counts values into buckets by size, such as the seconds taken by each poll,
+    keeping their sum and count too.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        # per set of labels: [count per bucket (the last for larger values), sum]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted(
+                (labels, (list(counts), total))
+                for labels, (counts, total) in self.values.items()
+            )
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield self.name + "_bucket", _label_text(
+                    self.label_names, labels, ("le", _format_value(bound))
+                ), cumulative
+            label_text = _label_text(self.label_names, labels)
+            yield self.name + "_sum", label_text, total
+            yield self.name + "_count", label_text, cumulative
+
+
+class Metrics:
+    """
+    Holds an application's metrics, by name, and publishes them.
+    """
+
+    def __init__(self, prefix="argus", settings=None):
+        self.prefix = prefix
+        if settings is None:
+            settings = settings_from_environment(
+                environment_variable_map, environment_variable_defaults
+            )
+        self.settings = settings
+        self.metrics = {}
+        self.server = None
+        self.written = None
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, label_names=()):
+        return self._metric(Counter, name, documentation, label_names)
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._metric(Gauge, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._metric(Histogram, name, documentation, label_names, buckets=buckets)
+
+    def _metric(self, kind, name, documentation, label_names, **kwargs):
+        """
+        Returns the metric called 'name', creating it the first time it is asked
+        for, so that several parts of an application can share one.
+        """
+        full_name = "{}_{}".format(self.prefix, name)
+        with self._lock:
+            metric = self.metrics.get(full_name)
+            if metric is None:
+                metric = kind(full_name, documentation, label_names, **kwargs)
+                self.metrics[full_name] = metric
+            elif type(metric) is not kind:
+                raise ValueError(
+                    "Metric {} is already a {}".format(full_name, metric.kind)
+                )
+        return metric
+
+    def exposition(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = sorted(self.metrics.items())
+        lines = []
+        for name, metric in metrics:
+            lines.append("# HELP {} {}".format(name, metric.documentation))
+            lines.append("# TYPE {} {}".format(name, metric.kind))
+            for sample_name, label_text, value in metric.samples():
+                lines.append(
+                    "{}{} {}".format(sample_name, label_text, _format_value(value))
+                )
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        """
+        Starts the HTTP endpoint on its own thread, if METRICS_PORT is set.
+        """
+        if self.settings["port"] <= 0 or self.server is not None:
+            return
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(
+            (self.settings["host"], self.settings["port"]), Handler
+        )
+        self.server.daemon_threads = True
+        threading.Thread(
+            target=self.server.serve_forever, name="metrics", daemon=True
+        ).start()
+
+    def publish(self, force=False):
+        """
+        Writes METRICS_FILE, if set, once every METRICS_FILE_INTERVAL seconds (or
+        now, if 'force' is set). Cheap to call as often as an application likes.
+        The file is replaced in one step, so readers never see half of it.
+        """
+        path = self.settings["file"]
+        if path == "":
+            return
+        now = monotonic()
+        if not force and self.written is not None and (
+            now - self.written < self.settings["file_interval"]
+        ):
+            return
+        self.written = now
+        partial = "{}.{}.tmp".format(path, os.getpid())
+        with open(partial, "w") as metrics_file:
+            metrics_file.write(self.exposition())
+        os.replace(partial, path)
+
+    def stop(self):
+        """
+        Writes METRICS_FILE a last time, and stops the HTTP endpoint.
+        """
+        self.publish(force=True)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
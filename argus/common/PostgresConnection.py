@@ -1,18 +1,101 @@
 """
     The PostgresConnection class connects based on one environmental variable,
       POSTGRES_URL
+
+    Connections come from a pool, which can be shared by the threads of one process.
+    'db_connection' is the application's own connection, taken from the pool by
+    connect(); other threads borrow one with 'with postgres.connection() as conn:'.
+    Connections are checked with a 'SELECT 1' when they are borrowed after sitting
+    idle, and replaced if they have been lost. Failing connection attempts are
+    retried, waiting twice as long each time.
+
+    Optional settings:
+
+        POSTGRES_POOL_MIN           Connections opened up front (default 1)
+        POSTGRES_POOL_MAX           The most connections open at once (default 4)
+        POSTGRES_POOL_TIMEOUT       Seconds to wait for a free connection when all
+                                        are in use (default 30)
+        POSTGRES_CONNECT_RETRIES    Attempts made to connect before giving up
+                                        (default 5)
+        POSTGRES_RETRY_DELAY        Seconds before the first retry (default 0.5)
+        POSTGRES_HEALTH_CHECK_INTERVAL  Seconds a connection can sit idle before it
+                                        is checked on being borrowed (default 30)
+        POSTGRES_PREPARE            'true' (default) runs the statements given to
+                                        execute_prepared() as server-side prepared
+                                        statements, so they are parsed and planned
+                                        once per connection.
+
+    Statements are prepared with their '%s' placeholders numbered:
+
+    >>> numbered_placeholders("INSERT INTO t (a, b) VALUES (%s, %s) -- 100%%")
+    'INSERT INTO t (a, b) VALUES ($1, $2) -- 100%'
 """
 
 import os
-from argus.common.Common import LogLevel
-import json
+from argus.common.Common import LogLevel, settings_from_environment
+from contextlib import contextmanager
+from time import monotonic, sleep
 import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+import re
+import threading
+import zlib
+
+environment_variable_map = {
+    "pool_min": "POSTGRES_POOL_MIN",
+    "pool_max": "POSTGRES_POOL_MAX",
+    "pool_timeout": "POSTGRES_POOL_TIMEOUT",
+    "connect_retries": "POSTGRES_CONNECT_RETRIES",
+    "retry_delay": "POSTGRES_RETRY_DELAY",
+    "health_check_interval": "POSTGRES_HEALTH_CHECK_INTERVAL",
+    "prepare": "POSTGRES_PREPARE",
+}
+
+environment_variable_defaults = {
+    "pool_min": 1,
+    "pool_max": 4,
+    "pool_timeout": 30.0,
+    "connect_retries": 5,
+    "retry_delay": 0.5,
+    "health_check_interval": 30.0,
+    "prepare": True,
+}
+
+
+def numbered_placeholders(sql):
+    """
+    Returns 'sql' with each '%s' placeholder replaced by $1, $2 ... as PREPARE
+    expects, and each '%%' by '%'.
+    """
+    count = [0]
+
+    def replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        count[0] += 1
+        return "${}".format(count[0])
+
+    return re.sub(r"%%|%s", replace, sql)
 
 
 class PostgresConnection:
     def __init__(self, app):
         self.env = {}
         self.app = app
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+        self.pool = None
+        self.db_connection = None
+        # per connection: the names of the statements prepared on it
+        self.prepared = {}
+        # per connection: when it was last returned to the pool
+        self.idle_since = {}
+        self._available = threading.BoundedSemaphore(
+            max(1, self.settings["pool_max"])
+        )
+        self._lock = threading.Lock()
         # check the url to connect with exists
         self.url = os.environ.get("POSTGRES_URL")
         if self.url is None:
@@ -22,22 +105,196 @@ class PostgresConnection:
                 LogLevel.WARNING,
             )
 
-    def connect(self):
+    def connect(self, exception_passthrough=False):
+        """
+        Opens the connection pool, and takes the application's connection from it.
+        'exception_passthrough' will pass up any exception generated
+        """
         try:
-            self.db_connection = psycopg2.connect(self.url)
+            if self.pool is None:
+                self.pool = self._retry(
+                    lambda: ThreadedConnectionPool(
+                        max(0, self.settings["pool_min"]),
+                        max(1, self.settings["pool_max"]),
+                        self.url,
+                    )
+                )
+            self.db_connection = self.getconn()
         except Exception as e:
-            app.log(
+            self.app.log(
                 "Exception encountered while connecting to Postgres: {}".format(str(e)),
                 LogLevel.WARNING,
             )
+            if exception_passthrough:
+                raise e
 
     def disconnect(self):
+        """
+        Closes every connection in the pool, including the application's.
+        """
         try:
-            self.db_connection.close()
+            if self.db_connection is not None:
+                self.putconn(self.db_connection)
+                self.db_connection = None
+            if self.pool is not None:
+                self.pool.closeall()
         except Exception as e:
-            app.log(
+            self.app.log(
                 "Exception encountered while closing connection to Postgres. {}".format(
                     str(e)
                 ),
                 LogLevel.WARNING,
             )
+        self.pool = None
+        self.prepared = {}
+        self.idle_since = {}
+
+    def ensure_connected(self):
+        """
+        Replaces the application's connection if it has been closed or no longer
+        answers, such as after the server restarts.
+        Returns True if the application has a working connection.
+        """
+        if self.pool is None:
+            self.connect()
+            return self.db_connection is not None
+        if self.db_connection is not None and self._healthy(self.db_connection):
+            return True
+        self.app.log("Reconnecting to Postgres", LogLevel.WARNING)
+        try:
+            if self.db_connection is not None:
+                self.putconn(self.db_connection, close=True)
+                self.db_connection = None
+            self.db_connection = self.getconn()
+            return True
+        except Exception as e:
+            self.app.log(
+                "Unable to reconnect to Postgres. {}".format(str(e)), LogLevel.WARNING
+            )
+            return False
+
+    def getconn(self):
+        """
+        Borrows a connection from the pool, waiting up to 'pool_timeout' seconds for
+        one to be free. A connection that has been idle longer than
+        'health_check_interval' is checked first, and replaced if it has been lost.
+        Every connection borrowed must be handed back with putconn().
+        """
+        if not self._available.acquire(timeout=self.settings["pool_timeout"]):
+            raise PoolError("No Postgres connection became free in time")
+        try:
+            return self._retry(self._checked_connection)
+        except Exception:
+            self._available.release()
+            raise
+
+    def putconn(self, connection, close=False):
+        """
+        Hands a connection back to the pool. Connections that have been lost, or
+        that 'close' is set for, are closed rather than reused.
+        """
+        close = close or connection.closed or (
+            connection.info.transaction_status == TRANSACTION_STATUS_UNKNOWN
+        )
+        try:
+            with self._lock:
+                if close:
+                    # a closed session's prepared statements are gone with it
+                    self.prepared.pop(connection, None)
+                else:
+                    self.idle_since[connection] = monotonic()
+            self.pool.putconn(connection, close=close)
+        finally:
+            self._available.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for the length of a 'with' block.
+        """
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def execute_prepared(self, cursor, sql, params=()):
+        """
+        Runs 'sql' (with '%s' placeholders) with 'params' on 'cursor', as a
+        server-side prepared statement, preparing it the first time it is used on
+        the cursor's connection. With POSTGRES_PREPARE off, runs it as plain text.
+        """
+        if not self.settings["prepare"]:
+            cursor.execute(sql, params)
+            return
+        connection = cursor.connection
+        name = "argus_{:08x}".format(zlib.crc32(sql.encode("utf-8")))
+        with self._lock:
+            prepared = self.prepared.setdefault(connection, set())
+            ready = name in prepared
+        if not ready:
+            # prepared statements belong to the session, and outlive a rollback
+            cursor.execute("PREPARE {} AS {}".format(name, numbered_placeholders(sql)))
+            with self._lock:
+                prepared.add(name)
+        if len(params) == 0:
+            cursor.execute("EXECUTE {};".format(name))
+        else:
+            cursor.execute(
+                "EXECUTE {} ({});".format(name, ", ".join(["%s"] * len(params))), params
+            )
+
+    def _checked_connection(self):
+        connection = self.pool.getconn()
+        with self._lock:
+            idle_since = self.idle_since.pop(connection, None)
+        if connection.closed or (
+            idle_since is not None
+            and monotonic() - idle_since >= self.settings["health_check_interval"]
+            and not self._healthy(connection)
+        ):
+            with self._lock:
+                self.prepared.pop(connection, None)
+            self.pool.putconn(connection, close=True)
+            raise psycopg2.OperationalError("Postgres connection was lost")
+        return connection
+
+    def _healthy(self, connection):
+        """
+        Returns True if 'connection' answers a 'SELECT 1'. Only checks connections
+        not inside a transaction, so as not to disturb one.
+        """
+        if connection.closed:
+            return False
+        if connection.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            if not connection.autocommit:
+                connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _retry(self, attempt):
+        """
+        Calls 'attempt' until it succeeds, retrying on connection errors up to
+        'connect_retries' times, waiting twice as long before each retry.
+        """
+        delay = self.settings["retry_delay"]
+        for remaining in range(max(1, self.settings["connect_retries"]) - 1, -1, -1):
+            try:
+                return attempt()
+            except psycopg2.OperationalError as e:
+                if remaining == 0:
+                    raise e
+                self.app.log(
+                    "Unable to connect to Postgres, retrying in {:.1f}s. {}".format(
+                        delay, str(e)
+                    ),
+                    LogLevel.WARNING,
+                )
+                sleep(delay)
+                delay *= 2
@@ -0,0 +1,302 @@
+"""
+Benchmarks for the code shared between applications. These need no Kafka or
+Postgres connection.
+
+    BENCHMARK_RECORDS       How many fake records each benchmark uses (default 5000)
+"""
+
+from argus.common.Common import CommonAppFramework, LogLevel, settings_from_environment
+from argus.common.data import archive, delta, schema, wire
+from argus.common.data.compiler import differences
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+import random
+import shutil
+import tempfile
+
+environment_variable_map = {
+    "records": "BENCHMARK_RECORDS",
+}
+
+environment_variable_defaults = {
+    "records": 5000,
+}
+
+CPU_COUNTS = [2, 4, 6, 8, 12, 16, 24, 32, 48, 64]
+# one heartbeat in this many is a keyframe, in the delta comparison
+DELTA_KEYFRAMES = 10
+
+
+def fake_heartbeats(count, broken_ratio=0.0):
+    """
+    Builds 'count' heartbeat cstructs, as they arrive from Kafka, with random CPU
+    counts. 'broken_ratio' of them have one value replaced with something that
+    fails validation.
+    """
+    time_fields = [child.name for child in schema.CPUTimes().children]
+    broken_values = ["", None, "-1", "101", "x", [], "1.5"]
+    heartbeats = []
+    for i in range(count):
+        load = [str(random.randint(0, 100)) for cpu in range(random.choice(CPU_COUNTS))]
+        times = {
+            field: "{:.2f}".format(random.randrange(0, 100000) / 100)
+            for field in time_fields
+        }
+        if random.random() < broken_ratio:
+            if random.random() < 0.5:
+                load[random.randrange(len(load))] = random.choice(broken_values)
+            else:
+                times[random.choice(time_fields)] = random.choice(broken_values)
+        heartbeats.append({"cpus": {"load": load, "times": times}})
+    return heartbeats
+
+
+class ValidatorBenchmark(CommonAppFramework):
+    """
+    Compares colander's deserialize and serialize with the compiled schemas, after
+    checking the two agree on every record used (including deliberately broken
+    ones).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log_level = LogLevel.INFO
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+
+    def run(self):
+        records = fake_heartbeats(self.settings["records"], broken_ratio=0.1)
+        mismatches = differences(schema.full_colander_set(), {"heartbeat": records})
+        if len(mismatches) > 0:
+            for mismatch in mismatches[:10]:
+                self.log(mismatch, LogLevel.CRITICAL)
+            raise Exception(
+                "Compiled schema disagrees with colander on {} record(s)".format(
+                    len(mismatches)
+                )
+            )
+        self.log(
+            "Compiled and colander schemas agree on all {} record(s)".format(
+                len(records)
+            ),
+            LogLevel.INFO,
+        )
+        records = fake_heartbeats(self.settings["records"])
+        appstructs = [schema.Heartbeat().deserialize(record) for record in records]
+        implementations = [
+            ("colander", schema.full_colander_set()["heartbeat"]),
+            ("compiled", schema.compiled_colander_set()["heartbeat"]),
+        ]
+        for method, inputs in (("deserialize", records), ("serialize", appstructs)):
+            for name, node in implementations:
+                function = getattr(node, method)
+                start = perf_counter()
+                for value in inputs:
+                    function(value)
+                elapsed = perf_counter() - start
+                self.log(
+                    "{:<11} {:<8}: {:>9.1f} records/sec, {:>7.2f} us/record".format(
+                        method,
+                        name,
+                        len(inputs) / elapsed,
+                        elapsed / len(inputs) * 1000000,
+                    ),
+                    LogLevel.INFO,
+                )
+
+
+class CodecBenchmark(CommonAppFramework):
+    """
+    Compares the message codecs: the bytes each message takes, and how many
+    messages per second each encodes and decodes, for heartbeats from hosts with
+    a range of CPU counts. Then compares sending each host's heartbeats whole with
+    sending them as deltas, a keyframe in every DELTA_KEYFRAMES.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log_level = LogLevel.INFO
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+
+    def run(self):
+        codecs = [wire.get_codec(name) for name in wire.codecs]
+        for cpu_count in (None, 2, 16, 64):
+            if cpu_count is None:
+                title = "mixed CPU counts"
+                records = fake_heartbeats(self.settings["records"])
+            else:
+                title = "{} CPUs".format(cpu_count)
+                records = [
+                    record
+                    for record in fake_heartbeats(self.settings["records"] * 3)
+                    if len(record["cpus"]["load"]) == cpu_count
+                ] or fake_heartbeats(1)
+            messages = [
+                {"id": "host-{}".format(i % 100), "deserializer": "heartbeat", "data": record}
+                for i, record in enumerate(records)
+            ]
+            for codec in codecs:
+                start = perf_counter()
+                encoded = [codec.encode(message) for message in messages]
+                encode_time = perf_counter() - start
+                start = perf_counter()
+                decoded = [wire.decode(payload) for payload in encoded]
+                decode_time = perf_counter() - start
+                if decoded != messages:
+                    raise Exception("The '{}' codec changed a message".format(codec.name))
+                self.log(
+                    "{:<16} {:<6}: {:>7.1f} bytes/msg, encode {:>9.1f} msg/sec, "
+                    "decode {:>9.1f} msg/sec".format(
+                        title,
+                        codec.name,
+                        sum(len(payload) for payload in encoded) / len(encoded),
+                        len(messages) / encode_time,
+                        len(messages) / decode_time,
+                    ),
+                    LogLevel.INFO,
+                )
+        for cpu_count in (2, 16, 64):
+            self._compare_deltas(codecs, cpu_count)
+
+    def _compare_deltas(self, codecs, cpu_count):
+        """
+        Sends a second's heartbeats at a time from 100 hosts whose CPU times grow,
+        as a producer would, whole and as deltas, and times rebuilding the deltas.
+        """
+        hosts = 100
+        fields = delta.CPU_TIME_FIELDS
+        totals = [
+            [random.randrange(10 ** 8) for field in fields] for host in range(hosts)
+        ]
+        messages = []
+        for second in range(max(1, self.settings["records"] // hosts)):
+            for host, times in enumerate(totals):
+                for index in range(len(times)):
+                    times[index] += random.randrange(0, 100 // len(fields) * 2)
+                load = [str(random.randint(0, 100)) for cpu in range(cpu_count)]
+                data = {
+                    "cpus": {
+                        "load": load,
+                        "times": {
+                            field: "%d.%02d" % divmod(time, 100)
+                            for field, time in zip(fields, times)
+                        },
+                    }
+                }
+                messages.append(
+                    {
+                        "id": "host-{}".format(host),
+                        "deserializer": "heartbeat",
+                        "data": data,
+                    }
+                )
+        encoder = delta.DeltaEncoder(DELTA_KEYFRAMES)
+        deltas = []
+        for message in messages:
+            deserializer, data = encoder.encode(message["id"], message["data"])
+            deltas.append(dict(message, deserializer=deserializer, data=data))
+        for codec in codecs:
+            whole = sum(len(codec.encode(message)) for message in messages)
+            encoded = [codec.encode(message) for message in deltas]
+            decoder = delta.DeltaDecoder()
+            start = perf_counter()
+            for payload in encoded:
+                message = wire.decode(payload)
+                if message["deserializer"] == delta.DELTA:
+                    message = decoder.rebuild(message)
+                else:
+                    decoder.keyframe(message)
+            rebuild_time = perf_counter() - start
+            if message != messages[-1]:
+                raise Exception("A delta was rebuilt wrongly")
+            self.log(
+                "{:>2} CPUs, {:<6} whole {:>6.1f} bytes/msg, as deltas {:>6.1f} "
+                "bytes/msg ({:.0%}), decoded and rebuilt {:>9.1f} msg/sec".format(
+                    cpu_count,
+                    codec.name,
+                    whole / len(messages),
+                    sum(len(payload) for payload in encoded) / len(messages),
+                    sum(len(payload) for payload in encoded) / whole,
+                    len(messages) / rebuild_time,
+                ),
+                LogLevel.INFO,
+            )
+
+
+class ArchiveBenchmark(CommonAppFramework):
+    """
+    Writes a month of one host's heartbeats (one every 10 seconds, from 16 CPUs) to
+    a scratch archive, then times reading it back: mapping the files and finding
+    the range, and copying it into one array per column.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.log_level = LogLevel.INFO
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+
+    def run(self):
+        root = tempfile.mkdtemp(prefix="argus-archive-")
+        try:
+            self._run(root)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+    def _run(self, root):
+        interval = 10
+        cores = 16
+        first = datetime(2021, 10, 1, tzinfo=timezone.utc)
+        days = 30
+        start = perf_counter()
+        rows = 0
+        for day in range(days):
+            moment = first + timedelta(days=day)
+            heartbeats = [
+                (
+                    moment + timedelta(seconds=second),
+                    0,
+                    rows + index,
+                    [random.randint(0, 100) for cpu in range(cores)],
+                )
+                + tuple(random.randrange(0, 100000) / 100 for field in range(10))
+                for index, second in enumerate(range(0, 86400, interval))
+            ]
+            path = archive.day_path(root, "host-1", moment)
+            rows += archive.write_day(path, heartbeats)
+        self.log(
+            "Wrote {} heartbeat(s) over {} days in {:.2f}s".format(
+                rows, days, perf_counter() - start
+            ),
+            LogLevel.INFO,
+        )
+        end = first + timedelta(days=days)
+        # the second pass finds the files' pages already cached
+        for attempt in ("first", "second"):
+            reader = archive.ArchiveReader(root)
+            start = perf_counter()
+            parts = list(reader.scan("host-1", first, end))
+            scan_time = perf_counter() - start
+            start = perf_counter()
+            history = reader.read("host-1", first, end)
+            read_time = perf_counter() - start
+            if len(history["recorded_at"]) != rows:
+                raise Exception("The archive read back the wrong number of rows")
+            del parts
+            reader.close()
+            self.log(
+                "{}: mapped and ranged {} day(s) in {:.2f}ms, read {} rows of {} "
+                "load values in {:.2f}ms".format(
+                    attempt,
+                    days,
+                    scan_time * 1000,
+                    rows,
+                    len(history["cpu_load"]),
+                    read_time * 1000,
+                ),
+                LogLevel.INFO,
+            )
@@ -0,0 +1,285 @@
+"""
+The columnar archive keeps old heartbeats out of Postgres, one file per producer
+per (UTC) day, laid out as '<root>/<producer id>/<YYYY-MM-DD>.col'. The Archiver
+writes them; ArchiveReader reads them back.
+
+Each file holds a header, a directory of columns, and then each column as one
+packed little-endian array, starting on an 8 byte boundary:
+
+    recorded_at     'q'  microseconds since the epoch, in order
+    kafka_partition 'i'
+    kafka_offset    'q'
+    cpu_load        'h'  'cores' values per record, -1 for a core a record lacks
+    cpu_<field>     'd'  one column for each of the CPU times
+
+Files are memory-mapped, so reading one costs no more than the pages touched, and
+each column is handed out as a memoryview of the mapping rather than a copy. A time
+range is found by bisecting recorded_at. The views can be used as they are, or by
+numpy.frombuffer() without copying.
+
+    >>> import tempfile
+    >>> from datetime import datetime, timedelta, timezone
+    >>> day = datetime(2021, 10, 18, tzinfo=timezone.utc)
+    >>> times = [1.5] * len(CPU_TIME_FIELDS)
+    >>> rows = [(day + timedelta(hours=hour), 0, hour, [hour, 2 * hour], *times)
+    ...         for hour in range(24)]
+    >>> root = tempfile.mkdtemp()
+    >>> rows[-1] = rows[-1][:3] + ([9],) + rows[-1][4:]
+    >>> write_day(day_path(root, "web/1", day), rows)
+    24
+    >>> reader = ArchiveReader(root)
+    >>> reader.producers(), [str(day) for day in reader.days("web/1")]
+    (['web/1'], ['2021-10-18'])
+    >>> history = reader.read("web/1", day + timedelta(hours=20),
+    ...                       day + timedelta(hours=30))
+    >>> history["cores"], list(history["kafka_offset"]), list(history["cpu_load"])
+    (2, [20, 21, 22, 23], [20, 40, 21, 42, 22, 44, 9, -1])
+    >>> parts = reader.scan("web/1", day, day + timedelta(hours=6))
+    >>> [len(part["recorded_at"]) for part in parts]
+    [6]
+    >>> reader.close()
+"""
+
+from argus.common.data.tables import CPU_TIME_FIELDS
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import quote, unquote
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b"ARGUSCOL"
+VERSION = 1
+SUFFIX = ".col"
+# magic, version, column count, cores, rows
+HEADER = struct.Struct("<8sHHIQ")
+# name, typecode, offset
+COLUMN = struct.Struct("<24sc7xQ")
+ALIGNMENT = 8
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+COLUMNS = [
+    ("recorded_at", "q"),
+    ("kafka_partition", "i"),
+    ("kafka_offset", "q"),
+    ("cpu_load", "h"),
+] + [("cpu_" + field, "d") for field in CPU_TIME_FIELDS]
+
+# files are little-endian, so on a big-endian host columns are copied and swapped
+SWAP = sys.byteorder != "little"
+
+
+def microseconds(moment):
+    """
+    Returns the datetime 'moment' as microseconds since the epoch.
+    """
+    return (moment - EPOCH) // timedelta(microseconds=1)
+
+
+def day_path(root, producer_id, day):
+    """
+    Returns the path of the file holding 'producer_id's heartbeats on 'day' (a date,
+    or a datetime in that UTC day). Producer ids are quoted, so any id is one
+    directory.
+    """
+    if isinstance(day, datetime):
+        day = day.astimezone(timezone.utc).date()
+    return os.path.join(root, quote(producer_id, safe=""), day.isoformat() + SUFFIX)
+
+
+def write_day(path, rows):
+    """
+    Writes the typed heartbeat 'rows' (recorded_at, kafka_partition, kafka_offset,
+    cpu_load and then each CPU time, in time order) to the file at 'path',
+    replacing it whole, so a reader never sees a half written file.
+    Returns the number of rows written.
+    """
+    cores = max((len(row[3]) for row in rows), default=0)
+    columns = {name: array(typecode) for name, typecode in COLUMNS}
+    for row in rows:
+        columns["recorded_at"].append(microseconds(row[0]))
+        columns["kafka_partition"].append(row[1] if row[1] is not None else -1)
+        columns["kafka_offset"].append(row[2] if row[2] is not None else -1)
+        load = row[3]
+        columns["cpu_load"].extend(load)
+        if len(load) < cores:
+            columns["cpu_load"].extend([-1] * (cores - len(load)))
+        for (name, typecode), value in zip(COLUMNS[4:], row[4:]):
+            columns[name].append(value)
+    offset = _aligned(HEADER.size + COLUMN.size * len(COLUMNS))
+    directory = []
+    for name, typecode in COLUMNS:
+        directory.append(
+            COLUMN.pack(name.encode("ascii"), typecode.encode("ascii"), offset)
+        )
+        offset = _aligned(offset + len(columns[name]) * columns[name].itemsize)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as output:
+        output.write(HEADER.pack(MAGIC, VERSION, len(COLUMNS), cores, len(rows)))
+        output.write(b"".join(directory))
+        for name, typecode in COLUMNS:
+            output.write(b"\0" * (_aligned(output.tell()) - output.tell()))
+            column = columns[name]
+            if SWAP:
+                column.byteswap()
+            column.tofile(output)
+    os.replace(temporary, path)
+    return len(rows)
+
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class ArchiveFile:
+    """
+    One memory-mapped day of one producer's heartbeats. Each column is a read-only
+    memoryview of the file (cpu_load being 'cores' values per row).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as source:
+            self.mapping = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, column_count, self.cores, self.rows = HEADER.unpack_from(
+            self.mapping, 0
+        )
+        if magic != MAGIC or version != VERSION:
+            self.mapping.close()
+            raise ValueError(
+                "{} is not a version {} archive file".format(path, VERSION)
+            )
+        self.view = memoryview(self.mapping)
+        self.columns = {}
+        for index in range(column_count):
+            name, typecode, offset = COLUMN.unpack_from(
+                self.mapping, HEADER.size + COLUMN.size * index
+            )
+            name = name.rstrip(b"\0").decode("ascii")
+            typecode = typecode.decode("ascii")
+            count = self.rows * (self.cores if name == "cpu_load" else 1)
+            size = struct.calcsize(typecode)
+            column = self.view[offset : offset + count * size]
+            if SWAP:
+                swapped = array(typecode)
+                swapped.frombytes(column)
+                swapped.byteswap()
+                self.columns[name] = memoryview(swapped)
+            else:
+                self.columns[name] = column.cast(typecode)
+
+    def between(self, start, end):
+        """
+        Returns the range of rows recorded at or after 'start' and before 'end'.
+        """
+        recorded_at = self.columns["recorded_at"]
+        return range(
+            bisect_left(recorded_at, microseconds(start)),
+            bisect_left(recorded_at, microseconds(end)),
+        )
+
+    def slice(self, rows):
+        """
+        Returns every column of the 'rows' (a range), as memoryviews of the file.
+        """
+        part = {"cores": self.cores}
+        for name, column in self.columns.items():
+            width = self.cores if name == "cpu_load" else 1
+            part[name] = column[rows.start * width : rows.stop * width]
+        return part
+
+    def close(self):
+        """
+        Unmaps the file. Views handed out must be released first.
+        """
+        for column in self.columns.values():
+            column.release()
+        self.view.release()
+        self.mapping.close()
+
+
+class ArchiveReader:
+    """
+    Reads the archive under 'root'. Files are mapped the first time they are read,
+    and stay mapped until close(), so scanning the same range again only costs
+    the bisecting.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+
+    def producers(self):
+        """
+        Returns the ids of the producers with archived heartbeats.
+        """
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(unquote(name) for name in os.listdir(self.root))
+
+    def days(self, producer_id):
+        """
+        Returns the dates archived for 'producer_id', oldest first.
+        """
+        directory = os.path.join(self.root, quote(producer_id, safe=""))
+        if not os.path.isdir(directory):
+            return []
+        return sorted(
+            date.fromisoformat(name[: -len(SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SUFFIX)
+        )
+
+    def open(self, producer_id, day):
+        path = day_path(self.root, producer_id, day)
+        archive_file = self.files.get(path)
+        if archive_file is None:
+            archive_file = self.files[path] = ArchiveFile(path)
+        return archive_file
+
+    def scan(self, producer_id, start, end):
+        """
+        Yields, for each archived day, the columns of 'producer_id's heartbeats
+        recorded at or after 'start' and before 'end', as memoryviews of the files
+        (see ArchiveFile.slice). Nothing is copied.
+        """
+        first = start.astimezone(timezone.utc).date()
+        last = end.astimezone(timezone.utc).date()
+        for day in self.days(producer_id):
+            if first <= day <= last:
+                archive_file = self.open(producer_id, day)
+                rows = archive_file.between(start, end)
+                if len(rows) > 0:
+                    yield archive_file.slice(rows)
+
+    def read(self, producer_id, start, end):
+        """
+        Returns 'producer_id's heartbeats recorded at or after 'start' and before
+        'end' as one array per column, joining the days in the range. cpu_load
+        holds 'cores' values per row, the most cores of any day, so days with fewer
+        cores are padded with -1.
+        """
+        parts = list(self.scan(producer_id, start, end))
+        cores = max((part["cores"] for part in parts), default=0)
+        history = {"cores": cores}
+        for name, typecode in COLUMNS:
+            column = history[name] = array(typecode)
+            for part in parts:
+                if name == "cpu_load" and part["cores"] < cores:
+                    padding = [-1] * (cores - part["cores"])
+                    for row in range(0, len(part[name]), part["cores"]):
+                        column.extend(part[name][row : row + part["cores"]])
+                        column.extend(padding)
+                else:
+                    # a straight copy of the mapped bytes
+                    column.frombytes(part[name].cast("B"))
+        return history
+
+    def close(self):
+        for archive_file in self.files.values():
+            archive_file.close()
+        self.files = {}
@@ -0,0 +1,430 @@
+"""
+Compiles colander schemas into plain Python functions for the hot path.
+
+colander walks a schema node by node on every call, going through SchemaNode,
+its type, and the type's callbacks for each value. compile_schema() does that walk
+once, and returns a CompiledSchema whose 'deserialize' and 'serialize' methods are
+closures with each node's type, quantisation, missing value and validator already
+looked up.
+
+The compiled functions only decide whether a value is accepted. When they reject
+one, the original colander node is run on the same value, so the colander.Invalid
+raised (and its error messages) are exactly colander's own. Node types, preparers
+or validators the compiler does not know are called through colander unchanged.
+
+    >>> from argus.common.data import schema
+    >>> compiled = compile_schema(schema.CPUTimes())
+    >>> compiled.deserialize({"user": "1.239", "nice": 0, "system": "2",
+    ...     "idle": 7.5, "iowait": "0", "irq": "0", "softirq": "0", "steal": "0",
+    ...     "guest": "0", "guest_nice": "0", "unknown": "ignored"})["user"]
+    Decimal('1.24')
+    >>> compile_schema(schema.CPULoad()).deserialize(["5", "101"])
+    Traceback (most recent call last):
+    ...
+    colander.Invalid: {'1': '101 is greater than maximum value 100'}
+
+Every sample below must give the same result, or the same error, from both
+implementations:
+
+    >>> times = {name: "12.345" for name in ("user", "nice", "system", "idle",
+    ...     "iowait", "irq", "softirq", "steal", "guest", "guest_nice")}
+    >>> samples = {
+    ...     "cpu_load": [[], ["0", "100"], [0, 50.9, True], ["-1"], ["1.5"], [""],
+    ...         [None], ["7", None], "12", {"a": 1}, None, 7, [[1]], (1, 2),
+    ...         [" 42 "], [b"3"]],
+    ...     "cpu_times": [times, dict(times, user=""), dict(times, user=None),
+    ...         dict(times, user="nan"), dict(times, user="1e400"),
+    ...         dict(times, user=0), dict(times, user=False), dict(times, extra=1),
+    ...         {k: v for k, v in times.items() if k != "idle"}, [], "x", None,
+    ...         dict(times, user="Infinity"), dict(times, user=[1])],
+    ...     "cpus": [{"load": ["1"], "times": times}, {"load": ["1"]},
+    ...         {"load": "1", "times": times}, {"times": times}, {}, None, []],
+    ...     "heartbeat": [{"cpus": {"load": ["3", "4"], "times": times}},
+    ...         {"cpus": {"load": [], "times": times}, "timestamp": "now"},
+    ...         {"cpus": None}, {}, [("cpus", {"load": [], "times": times})]],
+    ... }
+    >>> differences(schema.full_colander_set(), samples)
+    []
+    >>> differences(schema.full_colander_set(), {
+    ...     "cpu_load": [[3, 4.2], [], None],
+    ...     "cpu_times": [{k: 1.005 for k in times}, {k: "3" for k in times}, {}],
+    ...     "cpus": [{"load": [1], "times": {k: 2 for k in times}}],
+    ... }, method="serialize")
+    []
+"""
+
+import colander
+import copy
+import decimal
+
+null = colander.null
+drop = colander.drop
+required = colander.required
+
+
+class _Reject(Exception):
+    """
+    Raised inside compiled functions when a value is not accepted. The caller
+    re-runs colander to build the matching colander.Invalid.
+    """
+
+
+class CompiledSchema:
+    """
+    A colander schema node with precomputed deserialize and serialize functions.
+    Can be used anywhere the schema node's deserialize / serialize are used.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self._deserialize = _compile_deserialize(node)
+        self._serialize = _compile_serialize(node)
+
+    def deserialize(self, cstruct=null):
+        try:
+            return self._deserialize(cstruct)
+        except (_Reject, colander.Invalid):
+            # the compiled path only says no; colander raises the detailed error
+            return self.node.deserialize(cstruct)
+
+    def serialize(self, appstruct=null):
+        try:
+            return self._serialize(appstruct)
+        except (_Reject, colander.Invalid):
+            return self.node.serialize(appstruct)
+
+
+def compile_schema(node):
+    """
+    Returns a CompiledSchema for a colander schema node instance.
+    """
+    return CompiledSchema(node)
+
+
+def differences(schemas, samples, method="deserialize"):
+    """
+    Runs every sample through both colander and the compiled schema of the same
+    name, returning a list of (name, sample, colander outcome, compiled outcome)
+    for each sample where the two disagree.
+    'schemas' is a dictionary of schema nodes (such as schema.full_colander_set()),
+    and 'samples' a dictionary of lists of values to try against each schema.
+    """
+    mismatches = []
+    for name, values in samples.items():
+        node = schemas[name]
+        compiled = compile_schema(node)
+        for value in values:
+            expected = _outcome(getattr(node, method), value)
+            actual = _outcome(getattr(compiled, method), value)
+            if expected != actual:
+                mismatches.append((name, value, expected, actual))
+    return mismatches
+
+
+def _outcome(function, value):
+    """
+    Describes the result of calling 'function' on a copy of 'value' in a form that
+    can be compared exactly; repr() keeps dictionary order and Decimal exponents.
+    """
+    try:
+        return ("accepted", repr(function(copy.deepcopy(value))))
+    except colander.Invalid as e:
+        return ("rejected", repr(e.asdict()))
+
+
+def _compile_deserialize(node):
+    """
+    Builds the deserialize function for one schema node, mirroring
+    colander.SchemaNode.deserialize.
+    """
+    if type(node).deserialize is not colander.SchemaNode.deserialize:
+        return node.deserialize
+    if isinstance(node.missing, colander.deferred) or isinstance(
+        node.validator, colander.deferred
+    ):
+        return node.deserialize
+    preparers = _preparers(node)
+    if len(preparers) == 0 and _is_stock_number(node.typ, "deserialize"):
+        return _compile_number_deserialize(node)
+    convert = _compile_type_deserialize(node)
+    check = _compile_validator(node)
+    missing = node.missing
+    is_required = missing is required
+
+    def deserialize(cstruct=null):
+        appstruct = convert(cstruct)
+        for preparer in preparers:
+            appstruct = preparer(appstruct)
+        if appstruct is null:
+            if is_required:
+                raise _Reject()
+            return missing
+        if check is not None:
+            check(appstruct)
+        return appstruct
+
+    return deserialize
+
+
+def _compile_number_deserialize(node):
+    """
+    Builds the deserialize function for a number node without preparers, with
+    the type conversion, missing value and validator folded into one call, as
+    these are the bulk of the nodes in a heartbeat.
+    """
+    num = _number_function(node.typ)
+    missing = node.missing
+    is_required = missing is required
+    validator = node.validator
+    if validator is None or type(validator) is colander.Range:
+        minimum = None if validator is None else validator.min
+        maximum = None if validator is None else validator.max
+        check = None
+    else:
+        minimum = maximum = None
+        check = _compile_validator(node)
+
+    def deserialize(cstruct=null):
+        if cstruct != 0 and not cstruct:
+            if is_required:
+                raise _Reject()
+            return missing
+        try:
+            value = num(cstruct)
+        except Exception:
+            raise _Reject()
+        if minimum is not None and value < minimum:
+            raise _Reject()
+        if maximum is not None and value > maximum:
+            raise _Reject()
+        if check is not None:
+            check(value)
+        return value
+
+    return deserialize
+
+
+def _compile_type_deserialize(node):
+    """
+    Builds the function that stands in for node.typ.deserialize(node, cstruct).
+    """
+    typ = node.typ
+    kind = type(typ)
+    if _is_stock_number(typ, "deserialize"):
+        num = _number_function(typ)
+
+        def number(cstruct):
+            if cstruct != 0 and not cstruct:
+                return null
+            try:
+                return num(cstruct)
+            except Exception:
+                raise _Reject()
+
+        return number
+    if isinstance(typ, colander.Mapping) and _is_stock(kind, colander.Mapping):
+        return _compile_mapping(node, _compile_deserialize, null_result=null)
+    if isinstance(typ, colander.Sequence) and _is_stock(kind, colander.Sequence):
+        return _compile_sequence(node, _compile_deserialize)
+    return lambda cstruct: typ.deserialize(node, cstruct)
+
+
+def _compile_serialize(node):
+    """
+    Builds the serialize function for one schema node, mirroring
+    colander.SchemaNode.serialize.
+    """
+    if type(node).serialize is not colander.SchemaNode.serialize:
+        return node.serialize
+    typ = node.typ
+    kind = type(typ)
+    default = node.default
+    if _is_stock_number(typ, "serialize"):
+        num = _number_function(typ)
+
+        def convert(appstruct):
+            if appstruct in (null, None):
+                return null
+            try:
+                return str(num(appstruct))
+            except Exception:
+                raise _Reject()
+
+    elif isinstance(typ, colander.Mapping) and _is_stock(kind, colander.Mapping):
+        convert = _compile_mapping(node, _compile_serialize, null_result={})
+    elif isinstance(typ, colander.Sequence) and _is_stock(kind, colander.Sequence):
+        convert = _compile_sequence(node, _compile_serialize)
+    else:
+        convert = lambda appstruct: typ.serialize(node, appstruct)
+
+    def serialize(appstruct=null):
+        if appstruct is null:
+            appstruct = default
+        if isinstance(appstruct, colander.deferred):
+            appstruct = null
+        return convert(appstruct)
+
+    return serialize
+
+
+def _is_stock_number(typ, method):
+    """
+    True if 'typ' is a colander Number type using Number's own 'method'.
+    """
+    return isinstance(typ, colander.Number) and getattr(
+        type(typ), method
+    ) is getattr(colander.Number, method)
+
+
+def _is_stock(kind, base):
+    """
+    True if a Mapping or Sequence type has not overridden how it walks its values.
+    """
+    return (
+        kind._impl is base._impl
+        and kind._validate is base._validate
+        and kind.serialize is base.serialize
+        and kind.deserialize is base.deserialize
+    )
+
+
+def _number_function(typ):
+    """
+    Returns the conversion a colander Number type applies (its 'num'), with the
+    quantisation of a Decimal type looked up ahead of time.
+    """
+    if not isinstance(typ, colander.Decimal) or type(typ).num is not colander.Decimal.num:
+        return typ.num
+    to_decimal = decimal.Decimal
+    quant = typ.quant
+    rounding = typ.rounding
+    if typ.normalize:
+        return typ.num
+    if quant is None:
+        return lambda value: to_decimal(str(value))
+    if rounding is None:
+        return lambda value: to_decimal(str(value)).quantize(quant)
+    return lambda value: to_decimal(str(value)).quantize(quant, rounding)
+
+
+def _compile_mapping(node, compile_child, null_result):
+    """
+    Mirrors colander.Mapping deserialize / serialize for 'node'. 'null_result' is
+    what a null value becomes: null when deserializing, {} when serializing.
+    """
+    unknown = node.typ.unknown
+    children = [
+        (child.name, compile_child(child), child.default is drop)
+        for child in node.children
+    ]
+
+    def mapping(value):
+        if value is null:
+            if null_result is null:
+                return null
+            value = {}
+        if not hasattr(value, "items"):
+            raise _Reject()
+        if type(value) is dict and unknown == "ignore":
+            # nothing is removed from or kept of the input, so skip the copy
+            get = value.get
+        else:
+            try:
+                value = dict(value)
+            except Exception:
+                raise _Reject()
+            get = value.pop
+        result = {}
+        for name, child, default_is_drop in children:
+            subvalue = get(name, null)
+            if subvalue is drop or (subvalue is null and default_is_drop):
+                continue
+            subresult = child(subvalue)
+            if subresult is not drop:
+                result[name] = subresult
+        if unknown == "raise":
+            if value:
+                raise _Reject()
+        elif unknown == "preserve":
+            result.update(copy.deepcopy(value))
+        return result
+
+    return mapping
+
+
+def _compile_sequence(node, compile_child):
+    """
+    Mirrors colander.Sequence deserialize / serialize for 'node'.
+    """
+    accept_scalar = node.typ.accept_scalar
+    child_node = node.children[0]
+    child = compile_child(child_node)
+    default_is_drop = child_node.default is drop
+    # plain number items can never come back as drop, so the loop can be simpler
+    plain_numbers = (
+        _is_stock_number(child_node.typ, "deserialize")
+        and _is_stock_number(child_node.typ, "serialize")
+        and child_node.preparer is None
+        and child_node.missing is not drop
+        and not default_is_drop
+    )
+
+    def sequence(value):
+        if value is null:
+            return null
+        if (
+            hasattr(value, "__iter__")
+            and not hasattr(value, "get")
+            and not isinstance(value, str)
+        ):
+            value = list(value)
+        elif accept_scalar:
+            value = [value]
+        else:
+            raise _Reject()
+        if plain_numbers:
+            return [child(subvalue) for subvalue in value if subvalue is not drop]
+        result = []
+        for subvalue in value:
+            if subvalue is drop or (subvalue is null and default_is_drop):
+                continue
+            subresult = child(subvalue)
+            if subresult is not drop:
+                result.append(subresult)
+        return result
+
+    return sequence
+
+
+def _preparers(node):
+    preparer = node.preparer
+    if preparer is None:
+        return ()
+    if hasattr(preparer, "__call__"):
+        return (preparer,)
+    if colander.is_nonstr_iter(preparer):
+        return tuple(preparer)
+    return ()
+
+
+def _compile_validator(node):
+    """
+    Returns a function that checks a deserialized value against the node's
+    validator, with colander.Range inlined. Other validators are called as they
+    are, and any colander.Invalid they raise is treated as a rejection.
+    """
+    validator = node.validator
+    if validator is None:
+        return None
+    if type(validator) is colander.Range:
+        minimum = validator.min
+        maximum = validator.max
+
+        def in_range(value):
+            if minimum is not None and value < minimum:
+                raise _Reject()
+            if maximum is not None and value > maximum:
+                raise _Reject()
+
+        return in_range
+    return lambda appstruct: validator(node, appstruct)
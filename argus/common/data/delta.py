@@ -0,0 +1,205 @@
+"""
+Delta encoding sends most of a producer's heartbeats as the change since its last
+full one. Every KAFKA_DELTA_KEYFRAMES-th heartbeat from a producer is sent whole,
+as a keyframe, and those in between as 'heartbeat_delta' messages:
+
+    base    A checksum of the keyframe's CPU times, naming the keyframe
+    load    The load of each CPU, as sent in a heartbeat
+    times   How much each CPU time has grown since the keyframe, in hundredths,
+                comma separated in the schema's order ("45,0,12,...")
+
+The CPU times only ever grow, so the increases are short numbers where the times
+themselves grow long, and no field names are sent for them. A keyframe is an
+ordinary heartbeat, so consumers that know nothing of deltas still read those.
+
+Each delta is taken against its keyframe rather than the message before it, so a
+delta fetched again, or out of order, is rebuilt the same way. DeltaDecoder keeps
+the last KEPT_KEYFRAMES heartbeats of each producer, and a delta whose keyframe it
+has not seen (such as one read just after a restart) raises MissingKeyframe, to be
+rejected, until the producer's next keyframe. A producer that fails to deliver a
+message sends a keyframe next, in case it was the one lost.
+
+    >>> times = dict.fromkeys(CPU_TIME_FIELDS, "100.00")
+    >>> encoder = DeltaEncoder(keyframe_interval=3)
+    >>> sent = []
+    >>> for second in range(4):
+    ...     times = dict(times, user="%d.25" % (100 + second),
+    ...                  idle="1234567.%02d" % second)
+    ...     sent.append(encoder.encode("host-1", {"cpus": {"load": ["7", "93"],
+    ...                                                   "times": dict(times)}}))
+    >>> [deserializer for deserializer, data in sent]
+    ['heartbeat', 'heartbeat_delta', 'heartbeat_delta', 'heartbeat']
+    >>> sent[2][1]["times"]
+    '200,0,0,2,0,0,0,0,0,0'
+    >>> decoder = DeltaDecoder()
+    >>> decoder.keyframe({"id": "host-1", "deserializer": "heartbeat",
+    ...                   "data": sent[0][1]})
+    >>> rebuilt = decoder.rebuild({"id": "host-1", "deserializer": "heartbeat_delta",
+    ...                            "data": sent[2][1]})
+    >>> rebuilt["deserializer"], rebuilt["data"]["cpus"]["times"]["user"]
+    ('heartbeat', '102.25')
+    >>> rebuilt["data"]["cpus"]["times"]["idle"]
+    '1234567.02'
+    >>> try:  # doctest: +ELLIPSIS
+    ...     DeltaDecoder().rebuild({"id": "host-1", "deserializer": DELTA,
+    ...                             "data": sent[2][1]})
+    ... except MissingKeyframe as e:
+    ...     print(e)
+    No keyframe 0x... from host-1
+"""
+
+from argus.common.data import schema
+from collections import deque
+import zlib
+
+DELTA = "heartbeat_delta"
+# keyframes kept for each producer, so deltas fetched again after a rewind still
+# find theirs
+KEPT_KEYFRAMES = 4
+
+CPU_TIME_FIELDS = [child.name for child in schema.CPUTimes().children]
+
+
+class MissingKeyframe(ValueError):
+    """
+    Raised for a delta whose keyframe has not been seen.
+    """
+
+
+def keyframe_id(times):
+    """
+    Names a keyframe by a checksum of its CPU times (as sent), which grow with
+    every heartbeat, so differ between one keyframe and the next.
+    """
+    text = ",".join(times[field] for field in CPU_TIME_FIELDS)
+    return zlib.crc32(text.encode("ascii"))
+
+
+def _hundredths(text):
+    """
+    The CPU time 'text' (such as '123.45') as a whole number of hundredths.
+    """
+    whole, point, fraction = text.partition(".")
+    if len(fraction) != 2 and (point or fraction):
+        raise ValueError("Not a time in hundredths: {!r}".format(text))
+    return int(whole + (fraction or "00"))
+
+
+def _time_text(hundredths):
+    whole, fraction = divmod(abs(hundredths), 100)
+    return "%s%d.%02d" % ("-" if hundredths < 0 else "", whole, fraction)
+
+
+class DeltaEncoder:
+    """
+    Turns each producer's heartbeats into a keyframe every 'keyframe_interval'
+    messages, and deltas in between.
+    """
+
+    def __init__(self, keyframe_interval):
+        self.keyframe_interval = keyframe_interval
+        # producer id: [keyframe id, keyframe times in hundredths, deltas sent]
+        self.producers = {}
+
+    def encode(self, producer_id, data):
+        """
+        Returns the (deserializer, data) to send for the heartbeat 'data'. Data a
+        delta can not be taken of, such as a heartbeat that will fail validation,
+        is sent whole (and becomes the keyframe).
+        """
+        state = self.producers.get(producer_id)
+        try:
+            cpus = data["cpus"]
+            times = cpus["times"]
+            if state is not None and state[2] < self.keyframe_interval - 1:
+                increases = [
+                    str(_hundredths(times[field]) - base)
+                    for field, base in zip(CPU_TIME_FIELDS, state[1])
+                ]
+                state[2] += 1
+                return DELTA, {
+                    "base": str(state[0]),
+                    "load": cpus["load"],
+                    "times": ",".join(increases),
+                }
+            self.producers[producer_id] = [
+                keyframe_id(times),
+                [_hundredths(times[field]) for field in CPU_TIME_FIELDS],
+                0,
+            ]
+        except (KeyError, TypeError, ValueError, AttributeError):
+            self.producers.pop(producer_id, None)
+        return "heartbeat", data
+
+    def reset(self, producer_id):
+        """
+        Sends the producer's next heartbeat as a keyframe, as when one may have
+        been lost.
+        """
+        self.producers.pop(producer_id, None)
+
+
+class DeltaDecoder:
+    """
+    Rebuilds whole heartbeats from deltas, remembering each producer's latest
+    heartbeats as the keyframes they may refer to.
+    """
+
+    def __init__(self):
+        # producer id: deque of [heartbeat data, keyframe id, times in hundredths],
+        # the last two worked out only once a delta refers to the keyframe
+        self.keyframes = {}
+
+    def keyframe(self, message):
+        """
+        Remembers a (valid) heartbeat message as a possible keyframe.
+        """
+        kept = self.keyframes.get(message["id"])
+        if kept is None:
+            kept = self.keyframes[message["id"]] = deque(maxlen=KEPT_KEYFRAMES)
+        kept.append([message["data"], None, None])
+
+    def rebuild(self, message):
+        """
+        Returns the whole heartbeat message a delta message stands for. Raises
+        MissingKeyframe if its keyframe has not been seen, or ValueError if the
+        delta is malformed.
+        """
+        producer_id = message["id"]
+        data = message["data"]
+        try:
+            base = int(data["base"])
+            increases = [int(increase) for increase in data["times"].split(",")]
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise ValueError("Malformed delta from {}. {}".format(producer_id, e))
+        if len(increases) != len(CPU_TIME_FIELDS):
+            raise ValueError(
+                "Delta from {} has {} time(s), expected {}".format(
+                    producer_id, len(increases), len(CPU_TIME_FIELDS)
+                )
+            )
+        # newest first, as a delta almost always refers to the latest keyframe
+        for kept in reversed(self.keyframes.get(producer_id, ())):
+            if kept[1] is None:
+                try:
+                    times = kept[0]["cpus"]["times"]
+                    kept[1] = keyframe_id(times)
+                    kept[2] = [_hundredths(times[field]) for field in CPU_TIME_FIELDS]
+                except (KeyError, TypeError, ValueError, AttributeError):
+                    # never sent as a keyframe
+                    kept[1] = -1
+            if kept[1] == base:
+                times = {
+                    field: _time_text(start + increase)
+                    for field, start, increase in zip(
+                        CPU_TIME_FIELDS, kept[2], increases
+                    )
+                }
+                return {
+                    "id": producer_id,
+                    "deserializer": "heartbeat",
+                    "data": {"cpus": {"load": data.get("load"), "times": times}},
+                }
+        raise MissingKeyframe(
+            "No keyframe {:#010x} from {}".format(base, producer_id)
+        )
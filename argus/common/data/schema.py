@@ -32,10 +32,32 @@ class Heartbeat(colander.MappingSchema):
     cpus = CPUs()
 
 
+class HeartbeatDelta(colander.MappingSchema):
+    """
+    A heartbeat sent as the change since its producer's last full one, the
+    keyframe 'base' (see argus.common.data.delta)
+    """
+
+    base = colander.SchemaNode(colander.Int(), validator=colander.Range(0, 0xFFFFFFFF))
+    load = CPULoad()
+    times = colander.SchemaNode(colander.String())
+
+
 def full_colander_set():
     return {
         "cpu_load": CPULoad(),
         "cpu_times": CPUTimes(),
         "cpus": CPUs(),
         "heartbeat": Heartbeat(),
+        "heartbeat_delta": HeartbeatDelta(),
     }
+
+
+def compiled_colander_set():
+    """
+    The same schemas as full_colander_set(), compiled for faster deserialize and
+    serialize calls (see argus.common.data.compiler).
+    """
+    from argus.common.data.compiler import compile_schema
+
+    return {name: compile_schema(node) for name, node in full_colander_set().items()}
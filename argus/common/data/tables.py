@@ -0,0 +1,968 @@
+"""
+The Postgres tables heartbeats are stored in.
+
+Two layouts are available for the 'heartbeat' table:
+
+    json    The original layout. Each row holds the producer id and the whole Kafka
+                message, with Caterpillar's metadata, as one json value.
+    typed   One column per value: the heartbeat (Kafka) timestamp, Kafka coordinates,
+                the CPU loads as a smallint[] and each CPU time as a double. Indexed
+                on (producer_id, recorded_at), so time range and per-metric queries
+                need not parse any json.
+
+Each layout class knows how to create its table, and how to turn one conformed
+record (from Caterpillar.conform_data) into the parameters of its INSERT.
+
+Either layout has a unique index on each record's Kafka partition and offset, and
+records are inserted with ON CONFLICT DO NOTHING, so writing a record a second time
+(such as a batch fetched again after a crash) leaves it stored once. A table holds
+the records of one topic, so the topic itself is not part of the index. The offsets
+following each topic partition's newest stored records are kept in the
+'kafka_offsets' table, updated in the transaction that finishes each batch, and
+Caterpillar resumes from them (see ConsumerOffsetTable):
+
+    >>> from collections import namedtuple
+    >>> offsets = ConsumerOffsetTable()
+    >>> Message = namedtuple("Message", ["topic", "partition", "offset"])
+    >>> offsets.rows([Message("default", 1, 8), Message("default", 0, 3),
+    ...               Message("default", 1, 9)])
+    [('default', 0, 4), ('default', 1, 10)]
+
+A typed table can also be partitioned by time, 'daily' or 'hourly', on recorded_at.
+Each period is then its own table (such as heartbeat_p20211018), created ahead of
+time by Caterpillar, and old data is removed by dropping whole partitions (see
+argus.janitor). Records outside every period land in a default partition.
+
+    >>> table = TypedHeartbeatTable()
+    >>> row = table.row({
+    ...     "meta": {"kafta_id": "host-1", "timestamp": 1634515200000,
+    ...              "kafka_partition": 0, "kafka_offset": 7, "data_type": "heartbeat"},
+    ...     "conformed": {"cpus": {"load": [3, 4],
+    ...                   "times": {name: 1 for name in CPU_TIME_FIELDS}}}})
+    >>> row[:5]
+    ('host-1', datetime.datetime(2021, 10, 18, 0, 0, tzinfo=datetime.timezone.utc), 0, 7, [3, 4])
+    >>> hourly = TypedHeartbeatTable(partitioning="hourly")
+    >>> hourly.partition_name(row[1])
+    'heartbeat_p2021101800'
+    >>> hourly.partition_period("heartbeat_p2021101800")
+    (datetime.datetime(2021, 10, 18, 0, 0, tzinfo=datetime.timezone.utc), datetime.timedelta(seconds=3600))
+
+Alongside the history, whichever its layout, the 'heartbeat_latest' table holds only
+the newest heartbeat from each producer. Within a batch only the newest row for each
+producer is kept, as one upsert can not change the same row twice:
+
+    >>> latest = LatestHeartbeatTable()
+    >>> rows = [("a", 2, 0, 5, "{}"), ("b", 1, 0, 6, "{}"), ("a", 3, 0, 7, "{}"),
+    ...         ("a", 1, 0, 8, "{}")]
+    >>> latest.newest(rows)
+    [('a', 3, 0, 7, '{}'), ('b', 1, 0, 6, '{}')]
+
+Rollup tables hold the count, sum, min and max of every value per producer and
+minute (or hour). These merge, so a batch's partial aggregates are added to any
+already stored, and late records simply join the bucket they belong in:
+
+    >>> minutes = RollupTable("minute")
+    >>> minutes.name
+    'heartbeat_rollup_1m'
+    >>> times = tuple(range(len(CPU_TIME_FIELDS)))
+    >>> start = datetime(2021, 10, 18, 0, 0, tzinfo=timezone.utc)
+    >>> samples = [("a", start + timedelta(seconds=50), [10, 30], times),
+    ...            ("a", start + timedelta(seconds=70), [90], times),
+    ...            ("a", start + timedelta(seconds=5), [20, 40], times)]
+    >>> [row[:7] for row in minutes.aggregate(samples)]
+    [('a', datetime.datetime(2021, 10, 18, 0, 0, tzinfo=datetime.timezone.utc), 2, 4, 100, 10, 40), ('a', datetime.datetime(2021, 10, 18, 0, 1, tzinfo=datetime.timezone.utc), 1, 1, 90, 90, 90)]
+
+Records Caterpillar rejects are kept in the 'heartbeat_rejected' dead-letter table,
+with why they were rejected, where they came from and the message as it arrived, so
+they can be replayed once the cause is fixed:
+
+    >>> rejected = DeadLetterTable()
+    >>> record = rejected.record("schema", "cpus: Required", b'{"id": "host-1"}',
+    ...                          "default", 2, 41, 1634515200000, "host-1", "heartbeat")
+    >>> record[:8]
+    ('schema', 'cpus: Required', 'host-1', 'heartbeat', 'default', 2, 41, 1634515200000)
+"""
+
+from argus.common.data import schema
+from datetime import datetime, timedelta, timezone
+import json
+
+# the channel Caterpillar NOTIFYs (with a producer id) after committing new records
+NOTIFY_CHANNEL = "heartbeat_inserted"
+
+# the length of each rollup bucket, and the suffix of its table's name
+rollup_periods = {
+    "minute": (timedelta(minutes=1), "1m"),
+    "hour": (timedelta(hours=1), "1h"),
+}
+
+# how long each partition covers, and the date format used in its name
+partition_periods = {
+    "daily": (timedelta(days=1), "%Y%m%d"),
+    "hourly": (timedelta(hours=1), "%Y%m%d%H"),
+}
+
+CPU_TIME_FIELDS = [child.name for child in schema.CPUTimes().children]
+
+
+class JSONHeartbeatTable:
+    """
+    The original heartbeat table, one json value per record.
+    """
+
+    layout = "json"
+    # json tables are never partitioned
+    partitioning = "none"
+    partitioned = False
+
+    def __init__(self, name="heartbeat"):
+        self.name = name
+        self.columns = ["producer_id", "info"]
+        self.insert_row_sql = (
+            "INSERT INTO {} (producer_id, info) VALUES (%s, %s) "
+            "ON CONFLICT DO NOTHING;".format(name)
+        )
+        self.insert_rows_sql = (
+            "INSERT INTO {} (producer_id, info) VALUES %s "
+            "ON CONFLICT DO NOTHING;".format(name)
+        )
+        self.kafka_index = "{}_kafka_index".format(name)
+
+    def create(self, cursor, temporary=False):
+        cursor.execute(
+            "CREATE {}TABLE {} ("
+            "id serial NOT NULL PRIMARY KEY, "
+            "producer_id VARCHAR(200),"
+            "info json NOT NULL);".format("TEMP " if temporary else "", self.name)
+        )
+        cursor.execute(
+            "CREATE INDEX {} ON {} ( producer_id );".format(
+                self._index_name("producer_index"), self.name
+            )
+        )
+        self.create_kafka_index(cursor)
+
+    def create_kafka_index(self, cursor):
+        """
+        Creates the unique index on each record's Kafka coordinates. Fails if
+        the table already holds a record twice.
+        """
+        cursor.execute(
+            "CREATE UNIQUE INDEX {} ON {} ("
+            "((info->'meta'->>'kafka_partition')::integer), "
+            "((info->'meta'->>'kafka_offset')::bigint));".format(
+                self.kafka_index, self.name
+            )
+        )
+
+    def row(self, item):
+        """
+        Returns the INSERT parameters for one conformed record.
+        """
+        # We can combine some of the data here, and make a new json string
+        as_json = json.dumps({"data": item["raw"], "meta": item["meta"]})
+        return (item["meta"]["kafta_id"], as_json)
+
+    def _index_name(self, index):
+        # the original table's index was simply named 'producer_index'
+        if self.name == "heartbeat":
+            return index
+        return "{}_{}".format(self.name, index)
+
+
+class TypedHeartbeatTable:
+    """
+    A heartbeat table with a typed column for each value. Only 'heartbeat'
+    records can be stored in it.
+    """
+
+    layout = "typed"
+
+    def __init__(self, name="heartbeat", partitioning="none"):
+        """
+        'partitioning' is 'none', or one of the partition_periods.
+        """
+        if partitioning != "none" and partitioning not in partition_periods:
+            raise ValueError("Unknown partitioning '{}'".format(partitioning))
+        self.name = name
+        self.partitioning = partitioning
+        self.partitioned = partitioning != "none"
+        self.columns = [
+            "producer_id",
+            "recorded_at",
+            "kafka_partition",
+            "kafka_offset",
+            "cpu_load",
+        ] + ["cpu_" + field for field in CPU_TIME_FIELDS]
+        self.insert_row_sql = (
+            "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT DO NOTHING;".format(
+                name, ", ".join(self.columns), ", ".join(["%s"] * len(self.columns))
+            )
+        )
+        self.insert_rows_sql = (
+            "INSERT INTO {} ({}) VALUES %s ON CONFLICT DO NOTHING;".format(
+                name, ", ".join(self.columns)
+            )
+        )
+        self.kafka_index = "{}_kafka_index".format(name)
+
+    def create(self, cursor, temporary=False):
+        """
+        Creates the table (and, if partitioned, its default partition). Partitions
+        for each period are made by create_partitions().
+        """
+        cursor.execute(
+            "CREATE {}TABLE {} ("
+            "id bigserial NOT NULL, "
+            "producer_id VARCHAR(200) NOT NULL, "
+            "recorded_at timestamptz NOT NULL, "
+            "kafka_partition integer, "
+            "kafka_offset bigint, "
+            "cpu_load smallint[] NOT NULL, "
+            "{}, "
+            "PRIMARY KEY ({})){};".format(
+                "TEMP " if temporary else "",
+                self.name,
+                ", ".join(
+                    "cpu_{} double precision NOT NULL".format(field)
+                    for field in CPU_TIME_FIELDS
+                ),
+                # a partitioned table's key has to include the partition column
+                "id, recorded_at" if self.partitioned else "id",
+                " PARTITION BY RANGE (recorded_at)" if self.partitioned else "",
+            )
+        )
+        cursor.execute(
+            "CREATE INDEX {0}_producer_time_index ON {0} "
+            "( producer_id, recorded_at );".format(self.name)
+        )
+        self.create_kafka_index(cursor)
+        if self.partitioned:
+            cursor.execute(
+                "CREATE TABLE {0}_default PARTITION OF {0} DEFAULT;".format(self.name)
+            )
+
+    def create_kafka_index(self, cursor):
+        """
+        Creates the unique index on each record's Kafka coordinates. Fails if
+        the table already holds a record twice.
+        """
+        cursor.execute(
+            "CREATE UNIQUE INDEX {} ON {} (kafka_partition, kafka_offset{});".format(
+                self.kafka_index,
+                self.name,
+                # a partitioned table's unique indexes have to include the partition
+                # column; a record's recorded_at never changes, so this is as strict
+                ", recorded_at" if self.partitioned else "",
+            )
+        )
+
+    def create_partitions(self, cursor, start, end):
+        """
+        Creates any missing partitions covering 'start' to 'end' (datetimes).
+        Returns the names of the partitions created.
+        """
+        period, name_format = partition_periods[self.partitioning]
+        existing = {name for name, begins, length in self.partitions(cursor)}
+        created = []
+        begins = self.period_start(start)
+        while begins <= end:
+            name = self.partition_name(begins)
+            if name not in existing:
+                cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} "
+                    "FOR VALUES FROM (%s) TO (%s);".format(name, self.name),
+                    # literals rather than timestamps, as before Postgres 12 the
+                    # bounds could not be cast expressions
+                    (begins.isoformat(), (begins + period).isoformat()),
+                )
+                created.append(name)
+            begins += period
+        return created
+
+    def partitions(self, cursor):
+        """
+        Returns (name, start, length) for each period partition of the table, oldest
+        first. The default partition is not included.
+        """
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(%s);",
+            (self.name,),
+        )
+        found = []
+        for (name,) in cursor.fetchall():
+            period = self.partition_period(name)
+            if period is not None:
+                found.append((name,) + period)
+        return sorted(found, key=lambda partition: partition[1])
+
+    def drop_partition(self, cursor, name):
+        """
+        Detaches a partition and drops it, removing all its rows at once.
+        """
+        cursor.execute("ALTER TABLE {} DETACH PARTITION {};".format(self.name, name))
+        cursor.execute("DROP TABLE {};".format(name))
+
+    def period_start(self, moment):
+        """
+        Returns the start of the partition period 'moment' falls in (in UTC).
+        """
+        moment = moment.astimezone(timezone.utc)
+        if self.partitioning == "hourly":
+            return moment.replace(minute=0, second=0, microsecond=0)
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def partition_name(self, moment):
+        period, name_format = partition_periods[self.partitioning]
+        return "{}_p{}".format(self.name, self.period_start(moment).strftime(name_format))
+
+    def partition_period(self, name):
+        """
+        Returns the (start, length) of the period a partition name covers, or None
+        if 'name' is not a period partition of this table. Works for either
+        partitioning, whatever this table is currently set to.
+        """
+        prefix = "{}_p".format(self.name)
+        if not name.startswith(prefix):
+            return None
+        for period, name_format in partition_periods.values():
+            try:
+                start = datetime.strptime(name[len(prefix) :], name_format)
+            except ValueError:
+                continue
+            return start.replace(tzinfo=timezone.utc), period
+        return None
+
+    def row(self, item):
+        """
+        Returns the INSERT parameters for one conformed record, or None if the
+        record is not a heartbeat.
+        """
+        meta = item["meta"]
+        if meta["data_type"] != "heartbeat":
+            return None
+        cpus = item["conformed"]["cpus"]
+        times = cpus["times"]
+        return (
+            meta["kafta_id"],
+            kafka_timestamp(meta["timestamp"]),
+            meta.get("kafka_partition"),
+            meta["kafka_offset"],
+            cpus["load"],
+        ) + tuple(times[field] for field in CPU_TIME_FIELDS)
+
+    def copy_from_typed_sql(self, source):
+        """
+        Returns an INSERT ... SELECT that copies every row of the typed layout table
+        'source' into this table.
+        """
+        return (
+            "INSERT INTO {0} ({1}) SELECT {1} FROM {2} ORDER BY id "
+            "ON CONFLICT DO NOTHING;".format(self.name, ", ".join(self.columns), source)
+        )
+
+    def copy_from_json_sql(self, source):
+        """
+        Returns an INSERT ... SELECT that copies every heartbeat in the json layout
+        table 'source' into this table.
+        """
+        return (
+            "INSERT INTO {0} ({1}) SELECT {1} FROM ({2}) AS typed ORDER BY id "
+            "ON CONFLICT DO NOTHING;".format(
+                self.name,
+                ", ".join(self.columns),
+                typed_select_sql(source, JSONHeartbeatTable.layout),
+            )
+        )
+
+
+class LatestHeartbeatTable:
+    """
+    The newest heartbeat from each producer, keyed by producer id. Rows are upserted,
+    and a record older than the one already stored (by Kafka timestamp, then offset)
+    is ignored, so records arriving out of order never replace newer ones.
+    The record is stored as json, in the same shape as the json layout's 'info'.
+    """
+
+    def __init__(self, name="heartbeat_latest"):
+        self.name = name
+        self.columns = [
+            "producer_id",
+            "recorded_at",
+            "kafka_partition",
+            "kafka_offset",
+            "info",
+        ]
+        upsert = (
+            "INSERT INTO {0} ({1}) VALUES {{}} "
+            "ON CONFLICT (producer_id) DO UPDATE SET {2} "
+            "WHERE ({0}.recorded_at, {0}.kafka_offset) "
+            "< (EXCLUDED.recorded_at, EXCLUDED.kafka_offset);".format(
+                name,
+                ", ".join(self.columns),
+                ", ".join(
+                    "{0} = EXCLUDED.{0}".format(column) for column in self.columns[1:]
+                ),
+            )
+        )
+        self.upsert_row_sql = upsert.format(
+            "({})".format(", ".join(["%s"] * len(self.columns)))
+        )
+        self.upsert_rows_sql = upsert.format("%s")
+
+    def create(self, cursor, temporary=False):
+        cursor.execute(
+            "CREATE {}TABLE {} ("
+            "producer_id VARCHAR(200) NOT NULL PRIMARY KEY, "
+            "recorded_at timestamptz NOT NULL, "
+            "kafka_partition integer, "
+            "kafka_offset bigint, "
+            "info json NOT NULL);".format("TEMP " if temporary else "", self.name)
+        )
+
+    def row(self, item):
+        """
+        Returns the upsert parameters for one conformed record, or None if the
+        record is not a heartbeat.
+        """
+        meta = item["meta"]
+        if meta["data_type"] != "heartbeat":
+            return None
+        return (
+            meta["kafta_id"],
+            kafka_timestamp(meta["timestamp"]),
+            meta.get("kafka_partition"),
+            meta["kafka_offset"],
+            json.dumps({"data": item["raw"], "meta": meta}),
+        )
+
+    def newest(self, rows):
+        """
+        Returns the newest of 'rows' for each producer, in producer order.
+        """
+        newest = {}
+        for row in rows:
+            current = newest.get(row[0])
+            if current is None or (row[1], row[3]) > (current[1], current[3]):
+                newest[row[0]] = row
+        return [newest[producer] for producer in sorted(newest)]
+
+    def fill_sql(self, source, layout):
+        """
+        Returns an INSERT ... SELECT that fills this (empty) table with the newest
+        heartbeat of each producer in the history table 'source', which is in the
+        given layout.
+        """
+        if layout == JSONHeartbeatTable.layout:
+            return (
+                "INSERT INTO {0} ({1}) "
+                "SELECT DISTINCT ON (producer_id) producer_id, "
+                "to_timestamp((info->'meta'->>'timestamp')::bigint / 1000.0), "
+                "(info->'meta'->>'kafka_partition')::integer, "
+                "(info->'meta'->>'kafka_offset')::bigint, info "
+                "FROM {2} WHERE info->'meta'->>'data_type' = 'heartbeat' "
+                "ORDER BY producer_id, id DESC;".format(
+                    self.name, ", ".join(self.columns), source
+                )
+            )
+        # the typed layout does not keep the original message, so it is rebuilt
+        return (
+            "INSERT INTO {0} ({1}) "
+            "SELECT DISTINCT ON (producer_id) producer_id, recorded_at, "
+            "kafka_partition, kafka_offset, json_build_object("
+            "'data', json_build_object('id', producer_id, "
+            "'deserializer', 'heartbeat', 'data', json_build_object("
+            "'cpus', json_build_object('load', to_json(cpu_load), "
+            "'times', json_build_object({3})))), "
+            "'meta', json_build_object("
+            "'timestamp', (extract(epoch FROM recorded_at) * 1000)::bigint, "
+            "'kafka_offset', kafka_offset, 'kafka_partition', kafka_partition, "
+            "'kafta_id', producer_id, 'data_type', 'heartbeat')) "
+            "FROM {2} ORDER BY producer_id, recorded_at DESC, kafka_offset DESC;".format(
+                self.name,
+                ", ".join(self.columns),
+                source,
+                ", ".join("'{0}', cpu_{0}".format(field) for field in CPU_TIME_FIELDS),
+            )
+        )
+
+
+class RollupTable:
+    """
+    Per producer aggregates of heartbeats over a fixed period ('minute' or 'hour').
+    For each bucket it holds the number of samples, and the count, sum, min and
+    max of the CPU loads and the min, max and sum of each CPU time. Averages are
+    sum / count. Rows are merged with an upsert, so partial aggregates from any
+    number of batches, arriving in any order, add up to the same result.
+    """
+
+    layout = "rollup"
+
+    def __init__(self, period, name="heartbeat_rollup"):
+        if period not in rollup_periods:
+            raise ValueError("Unknown rollup period '{}'".format(period))
+        self.period = period
+        self.length, suffix = rollup_periods[period]
+        self.name = "{}_{}".format(name, suffix)
+        self.columns = [
+            "producer_id",
+            "bucket",
+            "samples",
+            "load_count",
+            "load_sum",
+            "load_min",
+            "load_max",
+        ]
+        for field in CPU_TIME_FIELDS:
+            self.columns += ["cpu_{}_{}".format(field, part) for part in ("min", "max", "sum")]
+        upsert = (
+            "INSERT INTO {0} ({1}) VALUES {{}} "
+            "ON CONFLICT (producer_id, bucket) DO UPDATE SET {2};".format(
+                self.name,
+                ", ".join(self.columns),
+                ", ".join(
+                    "{0} = {1}".format(column, self._merge(column))
+                    for column in self.columns[2:]
+                ),
+            )
+        )
+        self.upsert_row_sql = upsert.format(
+            "({})".format(", ".join(["%s"] * len(self.columns)))
+        )
+        self.upsert_rows_sql = upsert.format("%s")
+
+    def _merge(self, column):
+        """
+        The expression merging one column of an existing row with a new partial
+        aggregate.
+        """
+        if column.endswith("_min"):
+            return "LEAST({0}.{1}, EXCLUDED.{1})".format(self.name, column)
+        if column.endswith("_max"):
+            return "GREATEST({0}.{1}, EXCLUDED.{1})".format(self.name, column)
+        return "{0}.{1} + EXCLUDED.{1}".format(self.name, column)
+
+    def create(self, cursor, temporary=False):
+        cursor.execute(
+            "CREATE {}TABLE {} ("
+            "producer_id VARCHAR(200) NOT NULL, "
+            "bucket timestamptz NOT NULL, "
+            "samples bigint NOT NULL, "
+            "load_count bigint NOT NULL, "
+            "load_sum bigint NOT NULL, "
+            "load_min smallint, "
+            "load_max smallint, "
+            "{}, "
+            "PRIMARY KEY (producer_id, bucket));".format(
+                "TEMP " if temporary else "",
+                self.name,
+                ", ".join(
+                    "{} double precision NOT NULL".format(column)
+                    for column in self.columns[7:]
+                ),
+            )
+        )
+
+    def bucket(self, moment):
+        """
+        Returns the start of the bucket 'moment' falls in (in UTC).
+        """
+        seconds = self.length.total_seconds()
+        epoch = moment.timestamp()
+        return datetime.fromtimestamp(epoch - epoch % seconds, tz=timezone.utc)
+
+    def aggregate(self, samples):
+        """
+        Returns upsert parameters holding the partial aggregates of 'samples' (see
+        rollup_sample), one row per producer and bucket, sorted so that concurrent
+        writers always lock rows in the same order.
+        """
+        buckets = {}
+        for producer_id, recorded_at, load, times in samples:
+            key = (producer_id, self.bucket(recorded_at))
+            current = buckets.get(key)
+            if current is None:
+                current = buckets[key] = [0, 0, 0, None, None] + [
+                    [time, time, 0] for time in times
+                ]
+            current[0] += 1
+            current[1] += len(load)
+            current[2] += sum(load)
+            if len(load) > 0:
+                low, high = min(load), max(load)
+                if current[3] is None or low < current[3]:
+                    current[3] = low
+                if current[4] is None or high > current[4]:
+                    current[4] = high
+            for total, time in zip(current[5:], times):
+                if time < total[0]:
+                    total[0] = time
+                if time > total[1]:
+                    total[1] = time
+                total[2] += time
+        rows = []
+        for key in sorted(buckets):
+            current = buckets[key]
+            row = key + tuple(current[:5])
+            for total in current[5:]:
+                row += tuple(total)
+            rows.append(row)
+        return rows
+
+    def rebuild_sql(self, source, layout):
+        """
+        Returns an INSERT ... SELECT that aggregates the heartbeats in history table
+        'source' (in the given layout) recorded at or after its one parameter into
+        this table, which should hold no rows from then on.
+        """
+        seconds = int(self.length.total_seconds())
+        return (
+            "INSERT INTO {table} ({columns}) "
+            "SELECT producer_id, "
+            "to_timestamp(floor(extract(epoch FROM recorded_at) / {seconds}) * {seconds}) "
+            "AS bucket, count(*), sum(loads.count), coalesce(sum(loads.sum), 0), "
+            "min(loads.min), max(loads.max), {times} "
+            "FROM ({history}) AS history, LATERAL ("
+            "SELECT count(load), sum(load), min(load), max(load) "
+            "FROM unnest(history.cpu_load) AS load) AS loads "
+            "WHERE recorded_at >= %s "
+            "GROUP BY producer_id, bucket;".format(
+                table=self.name,
+                columns=", ".join(self.columns),
+                seconds=seconds,
+                times=", ".join(
+                    "{0}(cpu_{1})".format(function, field)
+                    for field in CPU_TIME_FIELDS
+                    for function in ("min", "max", "sum")
+                ),
+                history=typed_select_sql(source, layout),
+            )
+        )
+
+    def merge_from_sql(self, source):
+        """
+        Returns an INSERT ... SELECT that merges the rows of the finer grained rollup
+        table 'source', from the time given as its one parameter on, into this table
+        (such as minutes into hours), which should hold no rows from then on.
+        """
+        seconds = int(self.length.total_seconds())
+        aggregates = []
+        for column in self.columns[2:]:
+            if column.endswith("_min"):
+                aggregates.append("min({})".format(column))
+            elif column.endswith("_max"):
+                aggregates.append("max({})".format(column))
+            else:
+                aggregates.append("sum({})".format(column))
+        return (
+            "INSERT INTO {table} ({columns}) "
+            "SELECT producer_id, "
+            "to_timestamp(floor(extract(epoch FROM bucket) / {seconds}) * {seconds}) "
+            "AS merged_bucket, {aggregates} FROM {source} WHERE bucket >= %s "
+            "GROUP BY producer_id, merged_bucket;".format(
+                table=self.name,
+                columns=", ".join(self.columns),
+                seconds=seconds,
+                aggregates=", ".join(aggregates),
+                source=source,
+            )
+        )
+
+
+class DeadLetterTable:
+    """
+    Records rejected by Caterpillar, one row each. 'payload' is the Kafka message
+    value as received (or, for records rejected after validation, the decoded
+    message re-encoded as JSON), so it can be decoded and validated again.
+    'replayed_at' is set once a record has been replayed successfully.
+    """
+
+    def __init__(self, name="heartbeat_rejected"):
+        self.name = name
+        self.columns = [
+            "reason",
+            "detail",
+            "producer_id",
+            "deserializer",
+            "kafka_topic",
+            "kafka_partition",
+            "kafka_offset",
+            "kafka_timestamp",
+            "payload",
+        ]
+        self.insert_rows_sql = "INSERT INTO {} ({}) VALUES %s;".format(
+            name, ", ".join(self.columns)
+        )
+
+    def create(self, cursor, temporary=False):
+        cursor.execute(
+            "CREATE {}TABLE {} ("
+            "id BIGSERIAL PRIMARY KEY, "
+            "rejected_at timestamptz NOT NULL DEFAULT now(), "
+            "reason VARCHAR(50) NOT NULL, "
+            "detail text, "
+            "producer_id VARCHAR(200), "
+            "deserializer VARCHAR(200), "
+            "kafka_topic VARCHAR(250), "
+            "kafka_partition integer, "
+            "kafka_offset bigint, "
+            "kafka_timestamp bigint, "
+            "payload bytea NOT NULL, "
+            "replayed_at timestamptz);".format("TEMP " if temporary else "", self.name)
+        )
+        cursor.execute(
+            "CREATE INDEX {0}_pending_index ON {0} (reason, id) "
+            "WHERE replayed_at IS NULL;".format(self.name)
+        )
+
+    def record(
+        self,
+        reason,
+        detail,
+        payload,
+        topic=None,
+        partition=None,
+        offset=None,
+        timestamp=None,
+        producer_id=None,
+        deserializer=None,
+    ):
+        """
+        Returns the INSERT parameters for one rejected record. Details are cut
+        short, as a flood of bad records should not mean a flood of text.
+        """
+        return (
+            reason,
+            None if detail is None else str(detail)[:1000],
+            None if producer_id is None else str(producer_id)[:200],
+            None if deserializer is None else str(deserializer)[:200],
+            topic,
+            partition,
+            offset,
+            timestamp,
+            bytes(payload),
+        )
+
+
+class ConsumerOffsetTable:
+    """
+    The offset following the newest record stored from each Kafka topic partition,
+    so Caterpillar can resume from the database rather than the consumer group. Only
+    ever moves forward.
+    """
+
+    def __init__(self, name="kafka_offsets"):
+        self.name = name
+        self.columns = ["kafka_topic", "kafka_partition", "next_offset"]
+        self.upsert_rows_sql = (
+            "INSERT INTO {0} ({1}) VALUES %s "
+            "ON CONFLICT (kafka_topic, kafka_partition) DO UPDATE SET "
+            "next_offset = EXCLUDED.next_offset, updated_at = now() "
+            "WHERE {0}.next_offset < EXCLUDED.next_offset;".format(
+                name, ", ".join(self.columns)
+            )
+        )
+        self.select_sql = (
+            "SELECT kafka_partition, next_offset FROM {} "
+            "WHERE kafka_topic = %s AND kafka_partition = ANY(%s);".format(name)
+        )
+
+    def create(self, cursor, temporary=False):
+        cursor.execute(
+            "CREATE {}TABLE {} ("
+            "kafka_topic VARCHAR(250) NOT NULL, "
+            "kafka_partition integer NOT NULL, "
+            "next_offset bigint NOT NULL, "
+            "updated_at timestamptz NOT NULL DEFAULT now(), "
+            "PRIMARY KEY (kafka_topic, kafka_partition));".format(
+                "TEMP " if temporary else "", self.name
+            )
+        )
+
+    def rows(self, messages):
+        """
+        Returns the upsert parameters for the offsets that follow 'messages' (as
+        fetched from Kafka), one row per topic partition.
+        """
+        following = {}
+        for message in messages:
+            key = (message.topic, message.partition)
+            following[key] = max(message.offset + 1, following.get(key, 0))
+        return [key + (offset,) for key, offset in sorted(following.items())]
+
+
+class AlertTable:
+    """
+    Alerts raised and cleared by Caterpillar's producer watch (see
+    argus.caterpillar.ProducerWatch), one row for each change. 'recorded_at' is the
+    time of the heartbeat (or, for a missed heartbeat, the time it was missed).
+    """
+
+    def __init__(self, name="heartbeat_alerts"):
+        self.name = name
+        self.columns = [
+            "producer_id",
+            "kind",
+            "state",
+            "value",
+            "threshold",
+            "recorded_at",
+        ]
+        self.insert_rows_sql = "INSERT INTO {} ({}) VALUES %s;".format(
+            name, ", ".join(self.columns)
+        )
+
+    def create(self, cursor, temporary=False):
+        cursor.execute(
+            "CREATE {}TABLE {} ("
+            "id BIGSERIAL PRIMARY KEY, "
+            "producer_id VARCHAR(200) NOT NULL, "
+            "kind VARCHAR(20) NOT NULL, "
+            "state VARCHAR(10) NOT NULL, "
+            "value double precision, "
+            "threshold double precision, "
+            "recorded_at timestamptz NOT NULL, "
+            "created_at timestamptz NOT NULL DEFAULT now());".format(
+                "TEMP " if temporary else "", self.name
+            )
+        )
+        cursor.execute(
+            "CREATE INDEX {0}_producer_index ON {0} "
+            "(producer_id, id);".format(self.name)
+        )
+
+
+class ProducerStatsTable:
+    """
+    Checkpoints of the producer watch's statistics, one json value per producer,
+    so a restarted Caterpillar carries on from them.
+    """
+
+    def __init__(self, name="producer_stats"):
+        self.name = name
+        self.upsert_rows_sql = (
+            "INSERT INTO {0} (producer_id, state) VALUES %s "
+            "ON CONFLICT (producer_id) DO UPDATE SET "
+            "state = EXCLUDED.state, updated_at = now();".format(name)
+        )
+        self.select_sql = "SELECT producer_id, state FROM {};".format(name)
+
+    def create(self, cursor, temporary=False):
+        cursor.execute(
+            "CREATE {}TABLE {} ("
+            "producer_id VARCHAR(200) NOT NULL PRIMARY KEY, "
+            "state json NOT NULL, "
+            "updated_at timestamptz NOT NULL DEFAULT now());".format(
+                "TEMP " if temporary else "", self.name
+            )
+        )
+
+
+def rollup_sample(item):
+    """
+    Returns (producer_id, recorded_at, loads, times) for one conformed record, as
+    used by RollupTable.aggregate, or None if the record is not a heartbeat.
+    """
+    meta = item["meta"]
+    if meta["data_type"] != "heartbeat":
+        return None
+    cpus = item["conformed"]["cpus"]
+    return (
+        meta["kafta_id"],
+        kafka_timestamp(meta["timestamp"]),
+        cpus["load"],
+        tuple(cpus["times"][field] for field in CPU_TIME_FIELDS),
+    )
+
+
+heartbeat_tables = {
+    JSONHeartbeatTable.layout: JSONHeartbeatTable,
+    TypedHeartbeatTable.layout: TypedHeartbeatTable,
+}
+
+
+def heartbeat_table(layout, partitioning="none", name="heartbeat"):
+    """
+    Returns the table object for a layout, and (for the typed layout) partitioning.
+    """
+    if layout not in heartbeat_tables:
+        raise ValueError("Unknown heartbeat table layout '{}'".format(layout))
+    if layout == TypedHeartbeatTable.layout:
+        return TypedHeartbeatTable(name, partitioning)
+    if partitioning != "none":
+        raise ValueError("Only the typed table layout can be partitioned")
+    return heartbeat_tables[layout](name)
+
+
+def typed_select_sql(source, layout):
+    """
+    Returns a SELECT of the id and typed layout columns of every heartbeat in the
+    history table 'source', which is in the given layout.
+    """
+    if layout == TypedHeartbeatTable.layout:
+        return "SELECT * FROM {}".format(source)
+    data = "info->'data'->'data'->'cpus'"
+    return (
+        "SELECT id, producer_id, "
+        "to_timestamp((info->'meta'->>'timestamp')::bigint / 1000.0) AS recorded_at, "
+        "(info->'meta'->>'kafka_partition')::integer AS kafka_partition, "
+        "(info->'meta'->>'kafka_offset')::bigint AS kafka_offset, "
+        "ARRAY(SELECT json_array_elements_text({data}->'load')::smallint) AS cpu_load, "
+        "{times} "
+        "FROM {source} "
+        "WHERE info->'meta'->>'data_type' = 'heartbeat'".format(
+            data=data,
+            times=", ".join(
+                "({}->'times'->>'{}')::double precision AS cpu_{}".format(
+                    data, field, field
+                )
+                for field in CPU_TIME_FIELDS
+            ),
+            source=source,
+        )
+    )
+
+
+def kafka_timestamp(milliseconds):
+    """
+    Converts a Kafka message timestamp (milliseconds since the epoch) to a datetime.
+    """
+    return datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc)
+
+
+def existing_layout(cursor, name="heartbeat"):
+    """
+    Returns the layout of the table 'name' in the database, or None if there is
+    no such table.
+    """
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_name = %s AND table_schema = ANY(current_schemas(false));",
+        (name,),
+    )
+    columns = {row[0] for row in cursor.fetchall()}
+    if len(columns) == 0:
+        return None
+    if "info" in columns:
+        return JSONHeartbeatTable.layout
+    return TypedHeartbeatTable.layout
+
+
+def index_exists(cursor, name):
+    """
+    True if the index 'name' exists.
+    """
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+    row = cursor.fetchone()
+    return row is not None and row[0]
+
+
+def is_partitioned(cursor, name="heartbeat"):
+    """
+    True if the table 'name' exists and is partitioned.
+    """
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (name,))
+    row = cursor.fetchone()
+    return row is not None and row[0] == "p"
@@ -0,0 +1,444 @@
+"""
+Codecs turn the messages sent through Kafka ({"id", "deserializer", "data"}) into
+bytes and back.
+
+    json    The original format, the message as ASCII JSON with no header. Every
+                version of Caterpillar can read it.
+    struct  A binary layout generated from the colander schema named by the
+                message's deserializer. Numbers are packed as fixed size integers
+                (Decimals as scaled integers), and no field names are sent.
+
+Binary messages start with a four byte header: a marker byte that can never start a
+JSON document, the codec id, and the schema version - a checksum of the layout
+generated from the schema, so a consumer with a different schema refuses a message
+rather than misreading it. decode() looks at the first byte, so JSON and binary
+producers can run side by side while a new codec is rolled out.
+
+The struct codec only packs a message when unpacking it gives back exactly the
+same message. Anything else, such as a value that will fail validation or a
+deserializer with no schema, is sent as JSON instead, so Caterpillar sees the same
+data (and rejects the same records) whichever codec a producer uses.
+
+    >>> from argus.common.data import schema
+    >>> codec = StructCodec(schema.full_colander_set())
+    >>> times = {child.name: "12.34" for child in schema.CPUTimes().children}
+    >>> message = {"id": "host-1", "deserializer": "heartbeat",
+    ...            "data": {"cpus": {"load": ["3", "100"], "times": times}}}
+    >>> encoded = codec.encode(message)
+    >>> len(encoded), len(JSONCodec().encode(message))
+    (105, 282)
+    >>> decode(encoded) == message
+    True
+    >>> broken = dict(message, data={"cpus": {"load": ["3", "x"], "times": times}})
+    >>> decode(codec.encode(broken)) == broken, codec.encode(broken)[:1]
+    (True, b'{')
+    >>> other = StructCodec({"heartbeat": schema.CPULoad()})
+    >>> other.decode(encoded)
+    Traceback (most recent call last):
+    ...
+    ValueError: Message for 'heartbeat' has schema version 0x344a, expected 0x188d
+"""
+
+import colander
+import decimal
+import json
+import struct
+import zlib
+
+# the first byte of every binary message. JSON documents start with '{' (or space)
+MARKER = 0xA7
+# marker, codec id, schema version
+HEADER = struct.Struct(">BBH")
+LENGTH = struct.Struct("<B")
+COUNT = struct.Struct("<H")
+
+
+class _Unpackable(Exception):
+    """
+    Raised while packing a value that could not be unpacked back to itself.
+    """
+
+
+class JSONCodec:
+    """
+    The original encoding: the whole message as ASCII JSON.
+    """
+
+    name = "json"
+
+    def __init__(self, schemas=None):
+        pass
+
+    def encode(self, message):
+        return json.dumps(message).encode("ascii")
+
+    def decode(self, payload):
+        return _json_loads(payload)
+
+
+class StructCodec:
+    """
+    Packs the data of each message with a layout generated from the colander schema
+    named by its deserializer. 'schemas' maps deserializer names to schema nodes.
+    """
+
+    name = "struct"
+    codec_id = 1
+
+    def __init__(self, schemas):
+        self.json = JSONCodec()
+        self.layouts = {}
+        for name, node in schemas.items():
+            try:
+                layout = _compile(node)
+            except TypeError:
+                # a node type with no packed form; sent as JSON instead
+                continue
+            version = zlib.crc32(layout.description.encode()) & 0xFFFF
+            self.layouts[name] = (layout, version)
+
+    def encode(self, message):
+        """
+        Returns 'message' as bytes, packed if its data fits its schema's layout
+        exactly, and as JSON if not.
+        """
+        found = self.layouts.get(message.get("deserializer"))
+        if found is None or len(message) != 3 or not isinstance(message.get("id"), str):
+            return self.json.encode(message)
+        layout, version = found
+        parts = [
+            HEADER.pack(MARKER, self.codec_id, version),
+            _pack_string(message["id"]),
+            _pack_string(message["deserializer"]),
+        ]
+        try:
+            layout.encode(message["data"], parts)
+        except (_Unpackable, struct.error, KeyError):
+            return self.json.encode(message)
+        return b"".join(parts)
+
+    def decode(self, payload):
+        """
+        Unpacks a binary message, which must use this codec and the schema version
+        this codec generated.
+        """
+        marker, codec_id, version = HEADER.unpack_from(payload)
+        if marker != MARKER or codec_id != self.codec_id:
+            raise ValueError("Not a '{}' codec message".format(self.name))
+        producer_id, offset = _unpack_string(payload, HEADER.size)
+        deserializer, offset = _unpack_string(payload, offset)
+        if deserializer not in self.layouts:
+            raise ValueError("No packed layout for '{}' messages".format(deserializer))
+        layout, expected = self.layouts[deserializer]
+        if version != expected:
+            raise ValueError(
+                "Message for '{}' has schema version {:#06x}, expected {:#06x}".format(
+                    deserializer, version, expected
+                )
+            )
+        data, offset = layout.decode(payload, offset)
+        if offset != len(payload):
+            raise ValueError("{} unexpected byte(s) after message".format(
+                len(payload) - offset
+            ))
+        return {"id": producer_id, "deserializer": deserializer, "data": data}
+
+
+codecs = {
+    JSONCodec.name: JSONCodec,
+    StructCodec.name: StructCodec,
+}
+
+_decoders = {}
+
+
+def get_codec(name, schemas=None):
+    """
+    Returns the codec called 'name', for the given schemas (by default the full
+    colander set).
+    """
+    if name not in codecs:
+        raise ValueError("Unknown codec '{}'".format(name))
+    if schemas is None:
+        from argus.common.data import schema
+
+        schemas = schema.full_colander_set()
+    return codecs[name](schemas)
+
+
+def decode(payload):
+    """
+    Decodes a message in any codec, telling them apart by their first byte.
+    """
+    if len(payload) == 0 or payload[0] != MARKER:
+        return _json_loads(payload)
+    codec_id = payload[1]
+    if codec_id not in _decoders:
+        for codec in codecs.values():
+            if getattr(codec, "codec_id", None) == codec_id:
+                _decoders[codec_id] = get_codec(codec.name)
+        if codec_id not in _decoders:
+            raise ValueError("Unknown codec id {}".format(codec_id))
+    return _decoders[codec_id].decode(payload)
+
+
+def _json_loads(payload):
+    # json.loads takes bytes in any UTF itself; only a memoryview, such as a bytea
+    # column read back from Postgres, has to be copied first
+    if isinstance(payload, memoryview):
+        payload = payload.tobytes()
+    return json.loads(payload)
+
+
+def _pack_string(value):
+    encoded = value.encode("utf-8")
+    if len(encoded) > 255:
+        raise _Unpackable()
+    return LENGTH.pack(len(encoded)) + encoded
+
+
+def _unpack_string(payload, offset):
+    (length,) = LENGTH.unpack_from(payload, offset)
+    offset += LENGTH.size
+    # decoded straight from the slice, so a memoryview payload is not copied first
+    return str(payload[offset : offset + length], "utf-8"), offset + length
+
+
+class _Scalar:
+    """
+    A number packed with one struct format character. 'to_wire' turns the cstruct
+    value into the number packed, raising _Unpackable if 'from_wire' would not give
+    the same value back.
+    """
+
+    def __init__(self, format, to_wire, from_wire, description):
+        self.format = format
+        self.to_wire = to_wire
+        self.from_wire = from_wire
+        self.packer = struct.Struct("<" + format)
+        self.description = description
+
+    def encode(self, value, parts):
+        parts.append(self.packer.pack(self.to_wire(value)))
+
+    def decode(self, payload, offset):
+        (value,) = self.packer.unpack_from(payload, offset)
+        return self.from_wire(value), offset + self.packer.size
+
+
+class _String:
+    def __init__(self):
+        self.description = "s"
+
+    def encode(self, value, parts):
+        if not isinstance(value, str):
+            raise _Unpackable()
+        parts.append(_pack_string(value))
+
+    def decode(self, payload, offset):
+        return _unpack_string(payload, offset)
+
+
+class _Mapping:
+    """
+    The children of a mapping, in schema order. A mapping of numbers is packed
+    with a single struct.
+    """
+
+    def __init__(self, children):
+        self.children = children
+        self.names = [name for name, child in children]
+        self.description = "{{{}}}".format(
+            ",".join("{}:{}".format(name, child.description) for name, child in children)
+        )
+        self.packer = None
+        if all(isinstance(child, _Scalar) for name, child in children):
+            self.packer = struct.Struct(
+                "<" + "".join(child.format for name, child in children)
+            )
+
+    def encode(self, value, parts):
+        if not isinstance(value, dict) or len(value) != len(self.names):
+            raise _Unpackable()
+        if self.packer is not None:
+            parts.append(
+                self.packer.pack(
+                    *[child.to_wire(value[name]) for name, child in self.children]
+                )
+            )
+            return
+        for name, child in self.children:
+            child.encode(value[name], parts)
+
+    def decode(self, payload, offset):
+        if self.packer is not None:
+            values = self.packer.unpack_from(payload, offset)
+            return (
+                {
+                    name: child.from_wire(value)
+                    for (name, child), value in zip(self.children, values)
+                },
+                offset + self.packer.size,
+            )
+        result = {}
+        for name, child in self.children:
+            result[name], offset = child.decode(payload, offset)
+        return result, offset
+
+
+class _Sequence:
+    """
+    A count, then each item. A sequence of numbers is packed with one struct call.
+    """
+
+    def __init__(self, child):
+        self.child = child
+        self.description = "[{}]".format(child.description)
+
+    def encode(self, value, parts):
+        if not isinstance(value, list):
+            raise _Unpackable()
+        child = self.child
+        if isinstance(child, _Scalar):
+            to_wire = child.to_wire
+            parts.append(
+                struct.pack(
+                    "<H{}{}".format(len(value), child.format),
+                    len(value),
+                    *[to_wire(item) for item in value]
+                )
+            )
+            return
+        parts.append(COUNT.pack(len(value)))
+        for item in value:
+            child.encode(item, parts)
+
+    def decode(self, payload, offset):
+        (count,) = COUNT.unpack_from(payload, offset)
+        offset += COUNT.size
+        child = self.child
+        if isinstance(child, _Scalar):
+            packer = struct.Struct("<{}{}".format(count, child.format))
+            from_wire = child.from_wire
+            values = packer.unpack_from(payload, offset)
+            return list(map(from_wire, values)), offset + packer.size
+        result = []
+        for i in range(count):
+            item, offset = child.decode(payload, offset)
+            result.append(item)
+        return result, offset
+
+
+def _compile(node):
+    """
+    Returns the packed layout for a colander schema node, or raises TypeError if
+    some node type has no packed form.
+    """
+    typ = node.typ
+    if isinstance(typ, colander.Mapping):
+        return _Mapping([(child.name, _compile(child)) for child in node.children])
+    if isinstance(typ, colander.Sequence):
+        if len(node.children) != 1:
+            raise TypeError("Sequence with {} children".format(len(node.children)))
+        return _Sequence(_compile(node.children[0]))
+    if isinstance(typ, colander.Int):
+        return _int_scalar(node)
+    if isinstance(typ, colander.Decimal) and typ.quant is not None:
+        return _decimal_scalar(typ)
+    if isinstance(typ, colander.Float):
+        return _Scalar("d", _float_to_wire, repr, "d")
+    if isinstance(typ, colander.String):
+        return _String()
+    raise TypeError("No packed form for {}".format(type(typ).__name__))
+
+
+def _int_scalar(node):
+    """
+    Integers as their decimal text; one byte if a Range validator keeps them in
+    0 to 255, and eight otherwise.
+    """
+    validator = node.validator
+    small = (
+        isinstance(validator, colander.Range)
+        and validator.min is not None
+        and validator.max is not None
+        and 0 <= validator.min
+        and validator.max <= 255
+    )
+    format = "B" if small else "q"
+
+    def to_wire(value):
+        if not isinstance(value, str):
+            raise _Unpackable()
+        try:
+            number = int(value)
+        except ValueError:
+            raise _Unpackable()
+        if str(number) != value or (small and not 0 <= number <= 255):
+            raise _Unpackable()
+        return number
+
+    return _Scalar(format, to_wire, str, format)
+
+
+def _decimal_scalar(typ):
+    """
+    Decimals with a fixed quantum, as their text, packed as a count of quanta.
+    """
+    exponent = decimal.Decimal(typ.quant).as_tuple().exponent
+    if exponent >= 0:
+
+        def from_wire(number):
+            return str(decimal.Decimal(number).scaleb(exponent))
+
+        def to_wire(value):
+            if not isinstance(value, str):
+                raise _Unpackable()
+            try:
+                number = decimal.Decimal(value).scaleb(-exponent)
+            except decimal.InvalidOperation:
+                raise _Unpackable()
+            if not number.is_finite() or number != number.to_integral_value():
+                raise _Unpackable()
+            number = int(number)
+            if from_wire(number) != value:
+                raise _Unpackable()
+            return number
+
+        return _Scalar("q", to_wire, from_wire, "q" + str(typ.quant))
+
+    # text such as '123.45' is read and written without building Decimals
+    digits = -exponent
+    scale = 10 ** digits
+
+    def from_wire(number):
+        whole, fraction = divmod(abs(number), scale)
+        return "%s%d.%0*d" % ("-" if number < 0 else "", whole, digits, fraction)
+
+    def to_wire(value):
+        if not isinstance(value, str):
+            raise _Unpackable()
+        whole, point, fraction = value.partition(".")
+        if len(fraction) != digits:
+            raise _Unpackable()
+        try:
+            number = int(whole + fraction)
+        except ValueError:
+            raise _Unpackable()
+        if from_wire(number) != value:
+            raise _Unpackable()
+        return number
+
+    return _Scalar("q", to_wire, from_wire, "q" + str(typ.quant))
+
+
+def _float_to_wire(value):
+    if not isinstance(value, str):
+        raise _Unpackable()
+    try:
+        number = float(value)
+    except ValueError:
+        raise _Unpackable()
+    if repr(number) != value:
+        raise _Unpackable()
+    return number
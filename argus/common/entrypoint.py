@@ -4,14 +4,18 @@
 Argus Entrypoint
 
 Usage:
-  entrypoint.py run <module>
+  entrypoint.py run <module> [--workers=<n>] [--pipeline]
   entrypoint.py test <module>
+  entrypoint.py bench <module>
   entrypoint.py -h | --help
   entrypoint.py --version
 
 Options:
-  -h --help    Show this screen
-  --version    Show version
+  -h --help      Show this screen
+  --version      Show version
+  --workers=<n>  Run caterpillar as <n> supervised worker processes, one per core
+  --pipeline     Run caterpillar as an asyncio pipeline, fetching, validating and
+                 writing batches at the same time (CATERPILLAR_RUN_MODE=pipeline)
 """
 
 from docopt import docopt
@@ -24,15 +28,37 @@ class Entrypoint:
         self.module_run_map = {
             "caterpillar": self._run_caterpillar,
             "faker": self._run_faker,
+            "reporter": self._run_reporter,
+            "migrate": self._run_migrate,
+            "janitor": self._run_janitor,
+            "rollup": self._run_rollup,
+            "replay": self._run_replay,
+            "archive": self._run_archive,
         }
         self.module_test_map = {
             "common": self._test_common,
+            "schema": self._test_schema,
             "caterpillar": self._test_caterpillar,
             "faker": self._test_faker,
+            "reporter": self._test_reporter,
+            "janitor": self._test_janitor,
+        }
+        self.module_bench_map = {
+            "insert": self._bench_insert,
+            "validator": self._bench_validator,
+            "query": self._bench_query,
+            "codec": self._bench_codec,
+            "pipeline": self._bench_pipeline,
+            "archive": self._bench_archive,
+            "watch": self._bench_watch,
         }
         self.app = None
 
     def run(self):
+        if self.args["bench"]:
+            module_name = self.args["<module>"].lower()
+            assert module_name in self.module_bench_map
+            self.module_bench_map[module_name]()
         if self.args["test"] or self.args["run"]:
             assert "<module>" in self.args
             module_name = self.args["<module>"].lower()
@@ -44,9 +70,17 @@ class Entrypoint:
                 self.module_run_map[module_name]()
 
     def _run_caterpillar(self):
-        from argus.caterpillar.Caterpillar import Caterpillar
+        run_mode = "pipeline" if self.args["--pipeline"] else None
+        if self.args["--workers"] is not None:
+            from argus.caterpillar.Supervisor import Supervisor
 
-        self.app = Caterpillar()
+            self.app = Supervisor(
+                int(self.args["--workers"]), worker_kwargs={"run_mode": run_mode}
+            )
+        else:
+            from argus.caterpillar.Caterpillar import Caterpillar
+
+            self.app = Caterpillar(run_mode=run_mode)
         self.app.run()
 
     def _run_faker(self):
@@ -55,21 +89,144 @@ class Entrypoint:
         self.app = Faker()
         self.app.run()
 
+    def _run_reporter(self):
+        from argus.reporter.Reporter import Reporter
+
+        self.app = Reporter()
+        self.app.run()
+
+    def _run_migrate(self):
+        from argus.caterpillar.Migration import Migration
+
+        self.app = Migration()
+        self.app.run()
+
+    def _run_janitor(self):
+        from argus.janitor.Janitor import Janitor
+
+        self.app = Janitor()
+        self.app.run()
+
+    def _run_rollup(self):
+        from argus.caterpillar.Rollup import Rollup
+
+        self.app = Rollup()
+        self.app.run()
+
+    def _run_replay(self):
+        from argus.caterpillar.Replay import Replay
+
+        self.app = Replay()
+        self.app.run()
+
+    def _run_archive(self):
+        from argus.janitor.Archiver import Archiver
+
+        self.app = Archiver()
+        self.app.run()
+
+    def _bench_insert(self):
+        from argus.caterpillar.benchmarks import InsertBenchmark
+
+        self.app = InsertBenchmark()
+        self.app.run()
+
+    def _bench_query(self):
+        from argus.caterpillar.benchmarks import QueryBenchmark
+
+        self.app = QueryBenchmark()
+        self.app.run()
+
+    def _bench_validator(self):
+        from argus.common.benchmarks import ValidatorBenchmark
+
+        self.app = ValidatorBenchmark()
+        self.app.run()
+
+    def _bench_pipeline(self):
+        from argus.caterpillar.benchmarks import PipelineBenchmark
+
+        self.app = PipelineBenchmark()
+        self.app.run()
+
+    def _bench_codec(self):
+        from argus.common.benchmarks import CodecBenchmark
+
+        self.app = CodecBenchmark()
+        self.app.run()
+
+    def _bench_watch(self):
+        from argus.caterpillar.benchmarks import WatchBenchmark
+
+        self.app = WatchBenchmark()
+        self.app.run()
+
+    def _bench_archive(self):
+        from argus.common.benchmarks import ArchiveBenchmark
+
+        self.app = ArchiveBenchmark()
+        self.app.run()
+
     def _test_common(self):
         import doctest
+        import argus.common.Common
+        import argus.common.LogWriter
+        import argus.common.MemoryKafka
+        import argus.common.MemoryPostgres
+        import argus.common.Metrics
+        import argus.common.data.archive
+        import argus.common.data.delta
+        import argus.common.data.tables
+        import argus.common.data.wire
 
         doctest.testmod(argus.common.Common)
+        doctest.testmod(argus.common.LogWriter)
+        doctest.testmod(argus.common.MemoryKafka)
+        doctest.testmod(argus.common.MemoryPostgres)
+        doctest.testmod(argus.common.Metrics)
+        doctest.testmod(argus.common.data.archive)
+        doctest.testmod(argus.common.data.delta)
+        doctest.testmod(argus.common.data.tables)
+        doctest.testmod(argus.common.data.wire)
+
+    def _test_schema(self):
+        import doctest
+        import argus.common.data.compiler
+
+        doctest.testmod(argus.common.data.compiler)
 
     def _test_caterpillar(self):
         import doctest
+        import argus.caterpillar.Caterpillar
+        import argus.caterpillar.Pipeline
+        import argus.caterpillar.ProducerWatch
+        import argus.caterpillar.Supervisor
 
         doctest.testmod(argus.caterpillar.Caterpillar)
+        doctest.testmod(argus.caterpillar.Pipeline)
+        doctest.testmod(argus.caterpillar.ProducerWatch)
+        doctest.testmod(argus.caterpillar.Supervisor)
 
     def _test_faker(self):
         import doctest
+        import argus.faker.Faker
 
         doctest.testmod(argus.faker.Faker)
 
+    def _test_reporter(self):
+        import doctest
+        import argus.reporter.Reporter
+
+        doctest.testmod(argus.reporter.Reporter)
+
+    def _test_janitor(self):
+        import doctest
+        import argus.janitor.Archiver
+        import argus.janitor.Janitor
+
+        doctest.testmod(argus.janitor.Archiver)
+        doctest.testmod(argus.janitor.Janitor)
+
 
 if __name__ == "__main__":
     import sys
@@ -1,30 +1,173 @@
 """
     Faker generates fake records of data and submits those records to Kafta
+
+    Settings are read from environment variables:
+
+        FAKER_MODE          'single' (default) sends a heartbeat a second from one
+                                fake host for a minute. 'load' simulates many hosts
+                                sending at a set total rate, to find how much the
+                                pipeline can take.
+        FAKER_HOSTS         In 'load' mode, how many hosts are simulated (default 100).
+                                Each sends as KAFKA_MY_ID-<n>, with its own CPU count.
+        FAKER_RATE          In 'load' mode, the total messages per second to send
+                                (default 1000)
+        FAKER_DURATION      In 'load' mode, how many seconds to send for (default 60)
+
+    In 'load' mode the rate achieved and the send latency percentiles (from send()
+    to the broker accepting the message) are logged at the end. In either mode the
+    messages sent, delivered and failed, and the send latency, are kept in the
+    application's metrics (see argus.common.Metrics). KAFKA_SEND_MODE=async
+    is needed for high rates, as 'sync' waits for each message in turn.
+
+    >>> from argus.common.MemoryKafka import MemoryBroker, MemoryKafkaConnection
+    >>> hosts = virtual_hosts("load", 3)
+    >>> [host.producer_id for host in hosts]
+    ['load-0000', 'load-0001', 'load-0002']
+    >>> batch = fake_heartbeat_batch(hosts)
+    >>> heartbeat = schema.compiled_colander_set()["heartbeat"]
+    >>> all(len(heartbeat.deserialize(data)["cpus"]["load"]) == host.cpu_count
+    ...     for host, data in zip(hosts, batch))
+    True
+    >>> broker = MemoryBroker(partitions=4)
+    >>> faker = Faker(kafka_connection=lambda app: MemoryKafkaConnection(app, broker))
+    >>> faker.log_level = LogLevel.CRITICAL
+    >>> faker.settings.update(mode="load", hosts=20, rate=2000, duration=0.25)
+    >>> report = faker.run()
+    >>> report["sent"] == report["delivered"] == sum(broker.end_offsets())
+    True
+    >>> report["sent"] > 0 and sorted(report["latency_ms"])
+    ['max', 'p50', 'p90', 'p99']
 """
 
-from argus.common.Common import CommonAppFramework, LogLevel
+from argus.common.Common import CommonAppFramework, LogLevel, settings_from_environment
 from argus.common.data import schema
 from argus.common.KafkaConnection import KafkaConnection
+from argus.common.Metrics import percentiles
 
 import sys
 import random
+from collections import namedtuple
 from datetime import datetime
-from time import sleep
+from time import monotonic, perf_counter, sleep
+
+environment_variable_map = {
+    "mode": "FAKER_MODE",
+    "hosts": "FAKER_HOSTS",
+    "rate": "FAKER_RATE",
+    "duration": "FAKER_DURATION",
+}
+
+environment_variable_defaults = {
+    "mode": "single",
+    "hosts": 100,
+    "rate": 1000.0,
+    "duration": 60.0,
+}
+
+CPU_COUNTS = [2, 4, 6, 8, 12, 16, 24, 32, 48, 64]
+# in 'load' mode, messages are generated and sent in a batch this often (seconds)
+LOAD_TICK = 0.02
+# seconds between progress reports in 'load' mode
+LOAD_REPORT_INTERVAL = 10
+
+CPU_TIME_FIELDS = [child.name for child in schema.CPUTimes().children]
+# every value a serialized load or time can take, so that a batch of values is
+# picked with one random.choices() call rather than formatted one at a time
+LOAD_TEXT = [str(load) for load in range(101)]
+TIME_TEXT = ["%d.%02d" % divmod(time, 100) for time in range(100000)]
+
+VirtualHost = namedtuple("VirtualHost", ["producer_id", "cpu_count"])
+
+
+def virtual_hosts(base_id, count):
+    """
+    Returns 'count' VirtualHosts, named after 'base_id', each with a random
+    CPU count.
+    """
+    return [
+        VirtualHost("{}-{:04d}".format(base_id, index), random.choice(CPU_COUNTS))
+        for index in range(count)
+    ]
+
+
+def fake_heartbeat_batch(hosts):
+    """
+    Returns one serialized heartbeat (as Faker.fake_heartbeat_data) for each host
+    in 'hosts'. All the values for the batch are drawn at once.
+    """
+    loads = random.choices(LOAD_TEXT, k=sum(host.cpu_count for host in hosts))
+    times = random.choices(TIME_TEXT, k=len(CPU_TIME_FIELDS) * len(hosts))
+    field_count = len(CPU_TIME_FIELDS)
+    batch = []
+    position = 0
+    for index, host in enumerate(hosts):
+        start = index * field_count
+        batch.append(
+            {
+                "cpus": {
+                    "load": loads[position : position + host.cpu_count],
+                    "times": dict(
+                        zip(CPU_TIME_FIELDS, times[start : start + field_count])
+                    ),
+                }
+            }
+        )
+        position += host.cpu_count
+    return batch
 
 
 class Faker(CommonAppFramework):
-    def __init__(self):
+    def __init__(self, kafka_connection=KafkaConnection):
         """
         Establishes a connection to Kafka (based on environmental vars)
         Chooses a random number from a list to represent the number of CPU's 
         for the fake system.
+        'kafka_connection' is called with the application to build the Kafka
+        connection, and can be replaced by a stand-in for testing.
         """
         super().__init__()
-        self.kafka = KafkaConnection(self)
-        self.set_limits(cpu_count=random.choice([2, 4, 6, 8, 12, 16, 24, 32, 48, 64]))
-        self.schema = schema.full_colander_set()
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+        self.kafka = kafka_connection(self)
+        self.cpu_count = random.choice(CPU_COUNTS)
+        self.schema = schema.compiled_colander_set()
+        self.messages = self.metrics.counter(
+            "faker_messages_total", "Messages sent, delivered and failed.", ["outcome"]
+        )
+        self.send_seconds = self.metrics.histogram(
+            "faker_send_seconds",
+            "Seconds from send() to the broker accepting a message.",
+        )
 
     def run(self):
+        """
+        Sends heartbeats in the configured mode. In 'load' mode, returns the
+        report that is logged.
+        """
+        self.metrics.start()
+        try:
+            if self.settings["mode"] == "load":
+                return self.run_load()
+            self.run_single()
+        finally:
+            self.metrics.stop()
+
+    def _delivered(self, metadata, exception, sent_at):
+        """
+        Counts a message the broker has accepted or failed, 'sent_at' (a
+        perf_counter() time) being when it was sent.
+        Returns the send latency, or None if the message failed.
+        """
+        if exception is not None:
+            self.messages.inc(labels=("failed",))
+            return None
+        latency = perf_counter() - sent_at
+        self.messages.inc(labels=("delivered",))
+        self.send_seconds.observe(latency)
+        return latency
+
+    def run_single(self):
         """
         This will generate 60 'heartbeat' objects and submit those to Kafta 
         with a second between each.
@@ -33,11 +176,114 @@ class Faker(CommonAppFramework):
         # run for a minute, then terminate
         for i in range(60):
             self.log("Generating a fake record to send to Kafka")
+            sent_at = perf_counter()
             self.kafka.send(
-                data=self.fake_heartbeat_data(), deserializer_name="heartbeat"
+                data=self.fake_heartbeat_data(),
+                deserializer_name="heartbeat",
+                on_delivery=lambda metadata, exception, sent_at=sent_at: (
+                    self._delivered(metadata, exception, sent_at)
+                ),
             )
+            self.messages.inc(labels=("sent",))
+            self.metrics.publish()
             sys.stdout.flush()
             sleep(1)
+        self.kafka.close()
+
+    def run_load(self):
+        """
+        Sends heartbeats from 'hosts' virtual hosts, in turn, at 'rate' messages a
+        second in total for 'duration' seconds. Every LOAD_TICK seconds the number
+        of messages due by then is generated as a batch and sent; if sending falls
+        behind, it carries on as fast as it can until the time is up.
+        Returns a report of the rates achieved and the send latencies.
+        """
+        hosts = virtual_hosts(self.kafka.env["id"], self.settings["hosts"])
+        rate = self.settings["rate"]
+        duration = self.settings["duration"]
+        latencies = []
+        failures = []
+
+        def delivered(metadata, exception, sent_at):
+            latency = self._delivered(metadata, exception, sent_at)
+            if latency is None:
+                failures.append(exception)
+            else:
+                latencies.append(latency)
+
+        self.kafka.start_producer()
+        self.log(
+            "Sending {:.1f} msg/sec from {} virtual hosts for {}s".format(
+                rate, len(hosts), duration
+            ),
+            LogLevel.INFO,
+        )
+        sent = 0
+        start = monotonic()
+        next_report = start + LOAD_REPORT_INTERVAL
+        while True:
+            now = monotonic()
+            elapsed = now - start
+            if elapsed >= duration:
+                break
+            # at most a second's worth at once, should sending fall behind
+            due = min(int(rate * elapsed) - sent, max(1, int(rate)))
+            if due > 0:
+                batch_hosts = [hosts[(sent + i) % len(hosts)] for i in range(due)]
+                for host, data in zip(batch_hosts, fake_heartbeat_batch(batch_hosts)):
+                    sent_at = perf_counter()
+                    self.kafka.send(
+                        "heartbeat",
+                        data,
+                        on_delivery=lambda metadata, exception, sent_at=sent_at: (
+                            delivered(metadata, exception, sent_at)
+                        ),
+                        producer_id=host.producer_id,
+                    )
+                sent += due
+                self.messages.inc(due, ("sent",))
+            self.metrics.publish()
+            if now >= next_report:
+                self.log(
+                    "Sent {} message(s), {:.1f} msg/sec".format(sent, sent / elapsed),
+                    LogLevel.INFO,
+                )
+                sys.stdout.flush()
+                next_report += LOAD_REPORT_INTERVAL
+            sleep(max(0, LOAD_TICK - (monotonic() - now)))
+        send_time = monotonic() - start
+        self.kafka.flush()
+        total_time = monotonic() - start
+        self.kafka.close()
+        report = {
+            "hosts": len(hosts),
+            "target_rate": rate,
+            "sent": sent,
+            "delivered": len(latencies),
+            "failed": len(failures),
+            "send_rate": sent / send_time,
+            "delivered_rate": len(latencies) / total_time,
+            "latency_ms": {
+                name: value * 1000 for name, value in percentiles(latencies).items()
+            },
+        }
+        self.log(
+            "Target {target_rate:.1f} msg/sec, sent {send_rate:.1f} msg/sec, "
+            "delivered {delivered_rate:.1f} msg/sec ({delivered} delivered, "
+            "{failed} failed)".format(**report),
+            LogLevel.INFO,
+        )
+        self.log(
+            "Send latency: {}".format(
+                ", ".join(
+                    "{} {:.2f}ms".format(name, value)
+                    for name, value in report["latency_ms"].items()
+                )
+            ),
+            LogLevel.INFO,
+        )
+        sys.stdout.flush()
+        return report
 
     def fake_CPU_Load_data(self):
         """
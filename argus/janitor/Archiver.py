@@ -0,0 +1,164 @@
+"""
+The Archiver copies heartbeats out of Postgres into the columnar archive (see
+argus.common.data.archive), one file per producer per UTC day, so they can still
+be read once the Janitor has dropped them. Run it more often than the Janitor's
+retention, such as daily from a scheduler.
+
+Rows are streamed through a server-side cursor, sorted by producer and time, so
+only one producer's day is held in memory at once. Whole days are archived, and a
+day archived again replaces its file, so a run can safely be repeated.
+
+Settings are read from environment variables:
+
+    ARCHIVE_PATH        Where the archive is kept (default '/app/cache/archive')
+    ARCHIVE_DAYS        How many whole days before today to archive (default 1).
+                            0 archives every day in the heartbeat table.
+    ARCHIVE_FETCH_SIZE  Rows fetched from the cursor at a time (default 10000)
+
+    >>> import tempfile
+    >>> from argus.common.data.archive import ArchiveReader
+    >>> from argus.common.MemoryPostgres import MemoryPostgresConnection
+    >>> archiver = Archiver(MemoryPostgresConnection)
+    >>> archiver.settings["path"] = tempfile.mkdtemp()
+    >>> day = datetime(2021, 10, 18, 23, tzinfo=timezone.utc)
+    >>> times = [0.0] * 10
+    >>> rows = [("a", day, 0, 1, [5], *times),
+    ...         ("a", day + timedelta(hours=2), 0, 2, [6], *times),
+    ...         ("b", day, 1, 1, [7, 8], *times)]
+    >>> archiver.archive_rows(rows)
+    (3, 3)
+    >>> reader = ArchiveReader(archiver.settings["path"])
+    >>> [(producer, [str(day) for day in reader.days(producer)])
+    ...  for producer in reader.producers()]
+    [('a', ['2021-10-18', '2021-10-19']), ('b', ['2021-10-18'])]
+"""
+
+from argus.common.Common import (
+    CommonAppFramework,
+    LogLevel,
+    settings_from_environment,
+)
+from argus.common.data import archive, tables
+from argus.common.PostgresConnection import PostgresConnection
+from datetime import datetime, timedelta, timezone
+
+environment_variable_map = {
+    "path": "ARCHIVE_PATH",
+    "days": "ARCHIVE_DAYS",
+    "fetch_size": "ARCHIVE_FETCH_SIZE",
+}
+
+environment_variable_defaults = {
+    "path": "/app/cache/archive",
+    "days": 1,
+    "fetch_size": 10000,
+}
+
+
+class Archiver(CommonAppFramework):
+    def __init__(self, postgres_connection=PostgresConnection):
+        """
+        'postgres_connection' is called with the application to make its Postgres
+        connection, so tests can pass an in-memory one.
+        """
+        super().__init__()
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+        self.table = tables.TypedHeartbeatTable()
+        self.postgres = postgres_connection(self)
+
+    def run(self, exception_passthrough=False):
+        """
+        Archives the whole days before today chosen by ARCHIVE_DAYS.
+        'exception_passthrough' will pass any exceptions up the chain
+        """
+        end = datetime.now(timezone.utc).replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        start = None
+        if self.settings["days"] > 0:
+            start = end - timedelta(days=self.settings["days"])
+        self.postgres.connect()
+        try:
+            rows, files = self.archive(start, end)
+            self.log(
+                "Archived {} heartbeat(s) into {} file(s) in {}".format(
+                    rows, files, self.settings["path"]
+                ),
+                LogLevel.INFO,
+            )
+        except Exception as e:
+            self.log(
+                "Error while archiving heartbeats. {}".format(str(e)), LogLevel.WARNING
+            )
+            if exception_passthrough:
+                raise e
+        self.postgres.disconnect()
+
+    def archive(self, start, end):
+        """
+        Archives the heartbeats recorded from 'start' (or the first, if None) up to
+        'end'. Returns the number of heartbeats and of files written.
+        """
+        connection = self.postgres.db_connection
+        cursor = connection.cursor()
+        layout = tables.existing_layout(cursor, self.table.name)
+        cursor.close()
+        if layout is None:
+            connection.rollback()
+            return 0, 0
+        # a named cursor is kept on the server, and read 'fetch_size' rows at a time
+        cursor = connection.cursor(name="argus_archive")
+        cursor.itersize = max(1, self.settings["fetch_size"])
+        cursor.execute(
+            "SELECT {} FROM ({}) AS heartbeats WHERE recorded_at < %s{} "
+            "ORDER BY producer_id, recorded_at;".format(
+                ", ".join(self.table.columns),
+                tables.typed_select_sql(self.table.name, layout),
+                "" if start is None else " AND recorded_at >= %s",
+            ),
+            (end,) if start is None else (end, start),
+        )
+        try:
+            return self.archive_rows(cursor)
+        finally:
+            cursor.close()
+            connection.rollback()
+
+    def archive_rows(self, rows):
+        """
+        Writes the typed heartbeat 'rows' (producer_id first, sorted by producer and
+        time) to the archive, one file for each producer's UTC day.
+        Returns the number of rows and of files written.
+        """
+        written = 0
+        files = 0
+        day_rows = []
+        current = None
+        for row in rows:
+            day = (row[0], row[1].astimezone(timezone.utc).date())
+            if day != current:
+                if len(day_rows) > 0:
+                    written += self._write(current, day_rows)
+                    files += 1
+                current = day
+                day_rows = []
+            day_rows.append(row[1:])
+        if len(day_rows) > 0:
+            written += self._write(current, day_rows)
+            files += 1
+        return written, files
+
+    def _write(self, day, rows):
+        producer_id, date = day
+        self.log(
+            "Archiving {} heartbeat(s) from {} on {}",
+            LogLevel.DEBUG,
+            len(rows),
+            producer_id,
+            date,
+        )
+        return archive.write_day(
+            archive.day_path(self.settings["path"], producer_id, date), rows
+        )
@@ -0,0 +1,140 @@
+"""
+The Janitor removes heartbeats older than the retention period. It relies on the
+heartbeat table being partitioned by time (CATERPILLAR_PARTITIONING), so that old
+data is removed by detaching and dropping whole partitions. This costs the same
+however many rows a partition holds, and leaves no dead rows behind for vacuum.
+
+Settings are read from environment variables:
+
+    JANITOR_RETENTION_HOURS  How long heartbeats are kept, in hours (default 720)
+    JANITOR_INTERVAL         Seconds between clean ups. 0 (the default) cleans up
+                                 once and exits, for running from a scheduler.
+
+A partition is only dropped once every heartbeat it could hold is past retention:
+
+    >>> from argus.common.data import tables
+    >>> table = tables.TypedHeartbeatTable(partitioning="daily")
+    >>> partitions = [(name,) + table.partition_period(name) for name in
+    ...               ["heartbeat_p20211016", "heartbeat_p20211017", "heartbeat_p20211018"]]
+    >>> cutoff = datetime(2021, 10, 18, 0, 0, tzinfo=timezone.utc)
+    >>> expired_partitions(partitions, cutoff)
+    ['heartbeat_p20211016', 'heartbeat_p20211017']
+    >>> expired_partitions(partitions, cutoff - timedelta(seconds=1))
+    ['heartbeat_p20211016']
+"""
+
+from argus.common.Common import (
+    CommonAppFramework,
+    LogLevel,
+    settings_from_environment,
+)
+from argus.common.data import tables
+from argus.common.PostgresConnection import PostgresConnection
+from datetime import datetime, timedelta, timezone
+from time import sleep
+import sys
+
+environment_variable_map = {
+    "retention_hours": "JANITOR_RETENTION_HOURS",
+    "interval": "JANITOR_INTERVAL",
+}
+
+environment_variable_defaults = {
+    "retention_hours": 720,
+    "interval": 0,
+}
+
+
+def expired_partitions(partitions, cutoff):
+    """
+    Returns the names of the (name, start, length) partitions that end at or
+    before 'cutoff'.
+    """
+    return [name for name, start, length in partitions if start + length <= cutoff]
+
+
+class Janitor(CommonAppFramework):
+    def __init__(self):
+        super().__init__()
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+        # partitions are found by name, so either period can be cleaned up
+        self.table = tables.TypedHeartbeatTable(partitioning="daily")
+        self.postgres = PostgresConnection(self)
+
+    def run(self):
+        """
+        Cleans up once, or every 'interval' seconds if an interval is set.
+        """
+        self.postgres.connect()
+        try:
+            while True:
+                self.clean()
+                sys.stdout.flush()
+                if self.settings["interval"] <= 0:
+                    break
+                sleep(self.settings["interval"])
+        except KeyboardInterrupt:
+            pass
+        self.postgres.disconnect()
+
+    def clean(self, exception_passthrough=False):
+        """
+        Drops every heartbeat partition that is entirely past retention, then
+        deletes any old rows that landed in the default partition.
+        Returns the names of the partitions dropped.
+        'exception_passthrough' will pass any exceptions up the chain
+        """
+        cutoff = datetime.now(timezone.utc) - timedelta(
+            hours=self.settings["retention_hours"]
+        )
+        dropped = []
+        try:
+            cursor = self.postgres.db_connection.cursor()
+            if not tables.is_partitioned(cursor, self.table.name):
+                self.log(
+                    "The heartbeat table is not partitioned, so the Janitor has "
+                    "nothing it can drop. Set CATERPILLAR_PARTITIONING and run "
+                    "'entrypoint.py run migrate'.",
+                    LogLevel.WARNING,
+                )
+                self.postgres.db_connection.rollback()
+                return dropped
+            for name in expired_partitions(self.table.partitions(cursor), cutoff):
+                self.table.drop_partition(cursor, name)
+                # commit each drop, so the lock on the parent table is held briefly
+                self.postgres.db_connection.commit()
+                dropped.append(name)
+            # the default partition only catches records outside every period,
+            # so should be small enough to clean row by row
+            cursor.execute(
+                "DELETE FROM {}_default WHERE recorded_at < %s;".format(self.table.name),
+                (cutoff,),
+            )
+            deleted = cursor.rowcount
+            self.postgres.db_connection.commit()
+            cursor.close()
+        except Exception as e:
+            self.log(
+                "Error while removing old heartbeats. {}".format(str(e)),
+                LogLevel.WARNING,
+            )
+            try:
+                self.postgres.db_connection.rollback()
+            except Exception:
+                pass
+            if exception_passthrough:
+                raise e
+            return dropped
+        self.log(
+            "Janitor dropped {} partition(s){} and {} row(s) from the default "
+            "partition, older than {}".format(
+                len(dropped),
+                " ({})".format(", ".join(dropped)) if len(dropped) > 0 else "",
+                deleted,
+                cutoff.isoformat(),
+            ),
+            LogLevel.INFO,
+        )
+        return dropped
@@ -0,0 +1,405 @@
+"""
+    Watches every producer at once in a curses display (terminal-monitor.py --all),
+    one line per host with its CPU load and how long ago it last reported.
+
+    Only the hosts that fit on the screen are fetched, in one query against the
+    heartbeat_latest table, which works out each host's load and does the sorting
+    and filtering. The screen is kept as a set of cells, and only the cells whose
+    text has changed since the last redraw are written, so a redraw of hundreds of
+    hosts writes little more than the ages and loads that moved.
+
+    Redraws follow Caterpillar's notifications as TerminalMonitor's do, but for any
+    producer, and at most every TERMINAL_MIN_REFRESH seconds however many arrive.
+
+    Keys:
+
+      s             Sort by the next column (load, host or age)
+      r             Reverse the sort
+      + / -         Raise or lower the lowest load shown, by 10%
+      arrows, PgUp, PgDn, Home
+                    Scroll through the hosts
+      q             Quit
+
+    Each cell is a (text, attribute) pair keyed by its row and column; a redraw
+    writes the cells that differ, and blanks the ones that are gone:
+
+    >>> previous = host_cells([("web-1", 12.0, 30, 4, 2.0, 10)], 60, 0)
+    >>> current = host_cells([("web-1", 12.0, 95, 4, 65.0, 10)], 60, 0)
+    >>> [(x, text) for row, x, text, attribute in changed_cells(previous, current)]
+    [(26, '     95'), (40, '1m     ')]
+    >>> [(x, text) for row, x, text, attribute in changed_cells(current, {})][:2]
+    [(0, '                 '), (18, '       ')]
+"""
+
+from TerminalMonitor import TerminalMonitor
+from time import monotonic, perf_counter
+import curses
+import select
+import shutil
+import sys
+
+# the columns after the host name: heading, width, and how each value is shown
+COLUMNS = [
+    ("LOAD %", 7, "{:.0f}"),
+    ("PEAK %", 7, "{:.0f}"),
+    ("CORES", 5, "{}"),
+    ("AGE", 7, None),
+    ("OFFSET", 12, "{}"),
+]
+
+# the fewest characters given to the host name
+HOST_WIDTH = 8
+
+# hosts with a core at or above this load are highlighted
+HIGH_LOAD = 90
+
+# the rows above the hosts: a status line and the column headings
+HEADER_ROWS = 2
+
+# what each sort orders by, and whether it starts descending
+SORTS = {
+    "load": ("load", True),
+    "host": ("producer_id", False),
+    "age": ("recorded_at", False),
+}
+
+LOAD_STEP = 10
+
+
+def format_age(seconds):
+    """
+    Returns 'seconds' as a short age, such as '42s', '7m' or '3h'.
+    """
+    if seconds is None:
+        return ""
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size:
+            return "{:.0f}{}".format(seconds // size, unit)
+    return "{:.0f}s".format(max(0, seconds))
+
+
+def host_cells(hosts, width, first_row, high_attribute=0):
+    """
+    Returns the cells showing 'hosts' (rows of producer id, load, peak, cores, age
+    and offset) on a screen 'width' wide, starting at 'first_row'. Hosts with a
+    core at HIGH_LOAD or above have their load cells drawn with 'high_attribute'.
+    Cells are keyed by (row, x), padded to their column's width, and cut off at
+    the edge of the screen.
+    """
+    host_width = max(HOST_WIDTH, width - sum(size + 1 for _, size, _ in COLUMNS))
+    cells = {}
+    for row, host in enumerate(hosts, first_row):
+        producer_id, load, peak, cores, age, offset = host
+        high = high_attribute if peak is not None and peak >= HIGH_LOAD else 0
+        cells[(row, 0)] = (producer_id[:host_width].ljust(host_width)[:width], 0)
+        x = host_width + 1
+        for (heading, size, shown), value in zip(COLUMNS, host[1:]):
+            if x >= width:
+                break
+            if shown is None:
+                text = format_age(value).ljust(size)
+            else:
+                text = ("" if value is None else shown.format(value)).rjust(size)
+            attribute = high if heading in ("LOAD %", "PEAK %") else 0
+            cells[(row, x)] = (text[: width - x], attribute)
+            x += size + 1
+    return cells
+
+
+def changed_cells(previous, current):
+    """
+    Returns the (row, x, text, attribute) writes that turn the screen 'previous'
+    into 'current': the cells that are new or different, and blanks over the
+    cells of 'previous' that are gone. Blanks come first, so a cell that has
+    moved is not wiped out after being written.
+    """
+    writes = [
+        (row, x, " " * len(text), 0)
+        for (row, x), (text, attribute) in previous.items()
+        if (row, x) not in current or len(current[(row, x)][0]) < len(text)
+    ]
+    writes.extend(
+        (row, x, text, attribute)
+        for (row, x), (text, attribute) in current.items()
+        if previous.get((row, x)) != (text, attribute)
+    )
+    return sorted(writes, key=lambda write: (write[0], write[1], write[2].strip() != ""))
+
+
+class HostsMonitor(TerminalMonitor):
+    def __init__(self, args):
+        """
+        Sets up to watch every producer, sorted and filtered as the command line
+        asks (--sort, --min_load and --match)
+        """
+        super().__init__(args)
+        sort = (args.get("--sort") or "load").lower()
+        if sort not in SORTS:
+            sort = "load"
+        self.sort = sort
+        self.descending = SORTS[sort][1]
+        self.min_load = float(args.get("--min_load") or 0)
+        self.match = args.get("--match") or ""
+        self.scroll = 0
+        # the hosts matching the filters, of which 'hosts' are on the screen
+        self.total = 0
+        self.hosts = []
+        self.screen = None
+        # the cells on the screen, as drawn by the last redraw
+        self.cells = {}
+        self.running = True
+
+    def run(self, exception_passthrough=False):
+        """
+        Connects to postgres, and then either prints the hosts that fit in the
+        terminal once ('run_once'), or watches them in a curses display until 'q'
+        is pressed.
+        """
+        self.metrics.start()
+        self.postgres.connect()
+        if self.args["--run_once"]:
+            width, height = shutil.get_terminal_size()
+            self.fetch_hosts(max(1, height - HEADER_ROWS), exception_passthrough)
+            self.print_hosts(width)
+            self.metrics.stop()
+            exit(0)
+        self.listen(exception_passthrough)
+        try:
+            curses.wrapper(self._watch)
+        except KeyboardInterrupt:
+            pass
+        self.metrics.stop()
+
+    def _watch(self, screen):
+        self.screen = screen
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            # not every terminal can hide the cursor
+            pass
+        screen.nodelay(True)
+        screen.keypad(True)
+        while self.running:
+            self.fetch_hosts(self._visible_rows())
+            self.update_display()
+            self.metrics.publish()
+            self.wait_for_update()
+
+    def _visible_rows(self):
+        height, width = self.screen.getmaxyx()
+        return max(1, height - HEADER_ROWS)
+
+    def hosts_sql(self):
+        """
+        Returns the query for one screen of hosts, in the current sort order. Each
+        host's load is the average of its cores' loads, and its peak the highest.
+        """
+        column = SORTS[self.sort][0]
+        direction = "DESC NULLS LAST" if self.descending else "ASC NULLS FIRST"
+        return (
+            "SELECT producer_id, load, peak, cores, "
+            "extract(epoch FROM now() - recorded_at), kafka_offset, count(*) OVER () "
+            "FROM (SELECT producer_id, recorded_at, kafka_offset, cpus.load, "
+            "cpus.peak, cpus.cores FROM heartbeat_latest LEFT JOIN LATERAL ("
+            "SELECT avg(value::numeric) AS load, max(value::numeric) AS peak, "
+            "count(*) AS cores FROM json_array_elements_text("
+            "info->'data'->'data'->'cpus'->'load') AS loads(value)) AS cpus ON true"
+            ") AS hosts WHERE coalesce(load, 0) >= %s AND strpos(producer_id, %s) > 0 "
+            "ORDER BY {} {}, producer_id LIMIT %s OFFSET %s;".format(column, direction)
+        )
+
+    def fetch_hosts(self, rows, exception_passthrough=False):
+        """
+        Fetches the 'rows' hosts from the current scroll position, and how many
+        hosts match the filters, in one query.
+        'exception_passthrough' will pass any exceptions generated up the chain
+        """
+        start = perf_counter()
+        try:
+            cursor = self.postgres.db_connection.cursor()
+            # prepared once per sort order, as it is run on every redraw
+            self.postgres.execute_prepared(
+                cursor,
+                self.hosts_sql(),
+                (self.min_load, self.match, rows, self.scroll),
+            )
+            results = cursor.fetchall()
+            cursor.close()
+            self.query_seconds.observe(perf_counter() - start)
+        except Exception as e:
+            self.log("Error encountered while fetching data {}".format(str(e)))
+            if exception_passthrough:
+                raise e
+            return
+        if len(results) == 0 and self.scroll > 0:
+            # the hosts scrolled to have gone, so go back to the start
+            self.scroll = 0
+            self.fetch_hosts(rows, exception_passthrough)
+            return
+        self.total = results[0][6] if len(results) > 0 else 0
+        self.hosts = [
+            (
+                producer_id,
+                None if load is None else float(load),
+                None if peak is None else float(peak),
+                cores,
+                None if age is None else float(age),
+                offset,
+            )
+            for producer_id, load, peak, cores, age, offset, total in results
+        ]
+
+    def status_line(self):
+        """
+        Returns the line above the hosts, saying which are shown and how.
+        """
+        shown = "{}-{} of {}".format(
+            min(self.total, self.scroll + 1), self.scroll + len(self.hosts), self.total
+        )
+        filters = ""
+        if self.min_load > 0:
+            filters += ", load >= {:.0f}%".format(self.min_load)
+        if self.match != "":
+            filters += ", matching '{}'".format(self.match)
+        error = " - {}".format(self.log_buffer[-1]) if self.log_buffer else ""
+        return "Argus - hosts {} by {}{}{}{}  [s]ort [r]everse [+/-] load [q]uit".format(
+            shown,
+            self.sort,
+            " (reversed)" if self.descending != SORTS[self.sort][1] else "",
+            filters,
+            error,
+        )
+
+    def heading_line(self, width):
+        host_width = max(HOST_WIDTH, width - sum(size + 1 for _, size, _ in COLUMNS))
+        line = "HOST".ljust(host_width)
+        for heading, size, shown in COLUMNS:
+            line += " " + (heading.ljust(size) if heading == "AGE" else heading.rjust(size))
+        return line.ljust(width)[:width]
+
+    def screen_cells(self, width):
+        """
+        Returns every cell of the display: the status line, the headings and the
+        hosts.
+        """
+        cells = host_cells(self.hosts, width, HEADER_ROWS, curses.A_BOLD)
+        cells[(0, 0)] = (self.status_line().ljust(width)[:width], curses.A_REVERSE)
+        cells[(1, 0)] = (self.heading_line(width), curses.A_UNDERLINE)
+        return cells
+
+    def update_display(self):
+        """
+        Writes the cells that have changed since the last redraw.
+        """
+        self.last_refresh = monotonic()
+        self.events.inc(labels=("redraw",))
+        height, width = self.screen.getmaxyx()
+        # the last column is left empty, as writing to the bottom right corner fails
+        cells = self.screen_cells(max(1, width - 1))
+        writes = changed_cells(self.cells, cells)
+        for row, x, text, attribute in writes:
+            if row < height:
+                try:
+                    self.screen.addstr(row, x, text, attribute)
+                except curses.error:
+                    pass
+        self.events.inc(len(writes), ("cell",))
+        self.cells = cells
+        self.screen.noutrefresh()
+        curses.doupdate()
+
+    def print_hosts(self, width):
+        """
+        Prints the hosts once, without curses.
+        """
+        print(self.status_line()[:width])
+        print(self.heading_line(width).rstrip())
+        lines = [""] * len(self.hosts)
+        for (row, x), (text, attribute) in sorted(host_cells(self.hosts, width, 0).items()):
+            lines[row] = lines[row].ljust(x) + text
+        for line in lines:
+            print(line.rstrip())
+        sys.stdout.flush()
+
+    def wait_for_update(self):
+        """
+        Blocks until any producer has new records, a key changes what is shown, or
+        'refresh_interval' seconds have passed since the last redraw. Notifications
+        never bring a redraw sooner than 'min_refresh' seconds after the last one,
+        however many hosts are reporting; keys are answered at once.
+        """
+        connection = self.postgres.db_connection
+        deadline = self.last_refresh + self.settings["refresh_interval"]
+        earliest = self.last_refresh + self.settings["min_refresh"]
+        updated = False
+        lost = False
+        while self.running:
+            now = monotonic()
+            if now >= deadline or (updated and now >= earliest):
+                break
+            # once an update is due, only keys are watched until it can be shown
+            watched = [sys.stdin]
+            if not updated and not lost:
+                watched.append(connection)
+            try:
+                readable = select.select(
+                    watched, [], [], (earliest if updated else deadline) - now
+                )[0]
+                if sys.stdin in readable and self.read_keys():
+                    break
+                if connection in readable:
+                    connection.poll()
+                    self.events.inc(len(connection.notifies), ("notification",))
+                    updated = len(connection.notifies) > 0
+                    del connection.notifies[:]
+            except Exception as e:
+                self.log("Error encountered while waiting for updates {}".format(str(e)))
+                # keys are still answered until the connection is tried again
+                lost = True
+        if lost:
+            self._reconnect()
+
+    def read_keys(self):
+        """
+        Handles the keys pressed since the last call, all at once so that a held key
+        only costs one redraw. Returns True if what is shown has changed.
+        """
+        changed = False
+        rows = self._visible_rows()
+        while True:
+            key = self.screen.getch()
+            if key == -1:
+                return changed
+            changed = True
+            if key in (ord("q"), ord("Q"), 27):
+                self.running = False
+            elif key == ord("s"):
+                sorts = list(SORTS)
+                self.sort = sorts[(sorts.index(self.sort) + 1) % len(sorts)]
+                self.descending = SORTS[self.sort][1]
+                self.scroll = 0
+            elif key == ord("r"):
+                self.descending = not self.descending
+                self.scroll = 0
+            elif key in (ord("+"), ord("=")):
+                self.min_load = min(100, self.min_load + LOAD_STEP)
+                self.scroll = 0
+            elif key in (ord("-"), ord("_")):
+                self.min_load = max(0, self.min_load - LOAD_STEP)
+                self.scroll = 0
+            elif key == curses.KEY_DOWN:
+                self.scroll = min(max(0, self.total - rows), self.scroll + 1)
+            elif key == curses.KEY_UP:
+                self.scroll = max(0, self.scroll - 1)
+            elif key == curses.KEY_NPAGE:
+                self.scroll = min(max(0, self.total - rows), self.scroll + rows)
+            elif key == curses.KEY_PPAGE:
+                self.scroll = max(0, self.scroll - rows)
+            elif key == curses.KEY_HOME:
+                self.scroll = 0
+            elif key == curses.KEY_RESIZE:
+                # everything moves, so start again from a blank screen
+                self.screen.clear()
+                self.cells = {}
+            else:
+                changed = False
@@ -2,87 +2,199 @@
 
 """
     Argus Terminal Monitor 0.1
-    Monitor a single set of data from one provider in a console.
+    Monitor a single set of data from one provider in a console, or every
+    provider at once (--all, see HostsMonitor.py).
 
     Usage:
       terminal-monitor.py  <provider_id> [--run_once]
+      terminal-monitor.py  --all [--sort=<column>] [--min_load=<percent>]
+                           [--match=<text>] [--run_once]
       terminal-monitor.py  --help | -h
       terminal-monitor.py  --version
 
     Options:
-      -h --help     Show this screen
-      --verison     Show version
-      --run_once    Don't refresh the display - run once and terminate
+      -h --help             Show this screen
+      --verison             Show version
+      --run_once            Don't refresh the display - run once and terminate
+      --all                 Watch every provider, one line each
+      --sort=<column>       Sort by 'load' (default), 'host' or 'age'
+      --min_load=<percent>  Only show providers with at least this load
+      --match=<text>        Only show providers whose id contains this text
+
+    The display is redrawn when Caterpillar NOTIFYs that the provider has new
+    records. Settings are read from environment variables:
+
+      TERMINAL_REFRESH_INTERVAL  Seconds after which the display is refreshed even
+                                   if no notification has arrived (default 30)
+      TERMINAL_MIN_REFRESH       The fewest seconds between two redraws (default 0.5)
+
+    Query times, redraws, notifications and errors are kept as metrics, published
+    as set by the METRICS_ variables (see argus.common.Metrics).
 """
 
 from docopt import docopt
 
 import json
-from time import sleep
+from time import monotonic, perf_counter, sleep
 import os, sys
+import select
 from pprint import pprint
 
+environment_variable_map = {
+    "refresh_interval": "TERMINAL_REFRESH_INTERVAL",
+    "min_refresh": "TERMINAL_MIN_REFRESH",
+}
+
+environment_variable_defaults = {
+    "refresh_interval": 30.0,
+    "min_refresh": 0.5,
+}
+
+# moves the cursor home and clears the screen, without starting a shell to do it
+CLEAR_SCREEN = "\033[H\033[2J"
+
 
 class TerminalMonitor:
     def __init__(self, args):
         """
         Sets up to connect to Postgres and initialises default values
         """
+        from argus.common.Common import settings_from_environment
+        from argus.common.Metrics import Metrics
         from argus.common.PostgresConnection import PostgresConnection
         self.log_buffer = []
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+        # before the Postgres connection, which can log as it is created
+        self.metrics = Metrics()
+        self.query_seconds = self.metrics.histogram(
+            "terminal_query_seconds", "Seconds taken to fetch the latest heartbeat."
+        )
+        self.events = self.metrics.counter(
+            "terminal_events_total", "Redraws, notifications and messages logged.", ["event"]
+        )
         self.postgres = PostgresConnection(self)
         self.latest = {}
+        self.last_refresh = 0
         self.args = args
-        # below nifty funciton sourced from
-        #  https://www.delftstack.com/howto/python/python-clear-console/
-        self.clear_cmd = lambda: os.system(
-            "cls" if os.name in ("nt", "dos") else "clear"
-        )
         pprint(self.args)
         self.target = self.args.get("<provider_id>")
 
-    def log(self, message, level):
+    def log(self, message, level=None):
         """
         Logging function also provided for (and used by) the PostgresConnection object
         """
         self.log_buffer.append(message)
+        self.events.inc(labels=("logged",))
 
     def run(self, exception_passthrough=False):
         """
         Connects to postgres, and then depending on if 'run_once' is set or not,
-        will generate and loop over a display until terminated.
+        will generate a display once, or redraw it each time new data arrives
+        until terminated.
         """
         # establish the postgres connection
+        self.metrics.start()
         self.postgres.connect()
         # just show one screen if 'run-once' is set
         if self.args["--run_once"]:
-            fetch_latest_data()
-            update_display()
+            self.fetch_latest_data()
+            self.update_display()
+            self.metrics.stop()
             exit(0)
+        self.listen(exception_passthrough)
         # loop until a keyboard interrupt
         try:
             while True:
                 self.fetch_latest_data()
                 self.update_display()
+                self.metrics.publish()
+                self.wait_for_update()
         except KeyboardInterrupt:
             print("Press Ctl-C to terminate")
             pass
+        self.metrics.stop()
+
+    def listen(self, exception_passthrough=False):
+        """
+        Subscribes to the notifications Caterpillar sends after committing new
+        records. The connection is put in autocommit mode, as Postgres only
+        delivers notifications to sessions that are not inside a transaction.
+        'exception_passthrough' will pass any exceptions generated up the chain
+        """
+        from argus.common.data.tables import NOTIFY_CHANNEL
+        try:
+            self.postgres.db_connection.set_session(autocommit=True)
+            cursor = self.postgres.db_connection.cursor()
+            cursor.execute("LISTEN {};".format(NOTIFY_CHANNEL))
+            cursor.close()
+        except Exception as e:
+            self.log("Error encountered while listening for updates {}".format(str(e)))
+            if exception_passthrough:
+                raise e
+
+    def wait_for_update(self):
+        """
+        Blocks until a notification arrives for the target provider, or until
+        'refresh_interval' seconds have passed since the last redraw. Returns no
+        sooner than 'min_refresh' seconds after the last redraw, so a busy provider
+        can not make the display flicker.
+        """
+        connection = self.postgres.db_connection
+        deadline = self.last_refresh + self.settings["refresh_interval"]
+        while True:
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+            try:
+                # sleeps in the kernel until the connection has something to read
+                if select.select([connection], [], [], timeout)[0]:
+                    connection.poll()
+                    self.events.inc(len(connection.notifies), ("notification",))
+                    updated = any(
+                        notify.payload == self.target for notify in connection.notifies
+                    )
+                    del connection.notifies[:]
+                    if updated:
+                        break
+            except Exception as e:
+                self.log("Error encountered while waiting for updates {}".format(str(e)))
+                sleep(max(0, deadline - monotonic()))
+                self._reconnect()
+                break
+        wait = self.last_refresh + self.settings["min_refresh"] - monotonic()
+        if wait > 0:
+            sleep(wait)
+
+    def _reconnect(self):
+        """
+        Opens a new connection (and listens again) if the current one has been lost.
+        """
+        if self.postgres.db_connection is None or self.postgres.db_connection.closed:
+            if self.postgres.ensure_connected():
+                self.listen()
 
     def fetch_latest_data(self, exception_passthrough=False):
         """
-        Queries Postgres for the last heartbeat record from a given producer_id
-        (set by self.target)
+        Looks up the latest heartbeat record from a given producer_id (set by
+        self.target) in the heartbeat_latest table Caterpillar maintains, which
+        takes the same time however much history has been stored
         'exception_passthrough' will pass any exceptions generated up the chain
         """
+        start = perf_counter()
         try:
             cursor = self.postgres.db_connection.cursor()
-            cursor.execute(
-                "SELECT * FROM heartbeat "
-                "WHERE producer_id='{}' "
-                "ORDER BY id DESC "
-                "LIMIT 1;".format(self.target)
+            # prepared once, as it is run on every redraw
+            self.postgres.execute_prepared(
+                cursor,
+                "SELECT producer_id, recorded_at, info FROM heartbeat_latest "
+                "WHERE producer_id = %s;",
+                (self.target,),
             )
-            self.latest = cursor.fetchall()[0]
+            self.latest = cursor.fetchone() or {}
+            cursor.close()
+            self.query_seconds.observe(perf_counter() - start)
         except Exception as e:
             self.log("Error encountered while fetching data {}".format(str(e)))
             if exception_passthrough:
@@ -93,8 +205,14 @@ class TerminalMonitor:
         Clears the terminal and displays formatted data taken from the last
         entry for the given provider_id
         """
-        self.clear_cmd()
+        self.last_refresh = monotonic()
+        self.events.inc(labels=("redraw",))
+        print(CLEAR_SCREEN, end="")
         print("Argus Terminal Monitor - {}\n\n".format(self.target))
+        if not self.latest:
+            print("No records found yet")
+            sys.stdout.flush()
+            return
         data = self.latest[2].get("data", {}).get("data", {})
         meta = self.latest[2].get("meta", {})
         cpu_times = ""
@@ -107,15 +225,23 @@ class TerminalMonitor:
             "Time Data:\n{CPU_Times}".format(
                 timestamp=meta.get("timestamp"),
                 offset=meta.get("kafka_offset"),
-                CPU_Load="%, ".join(data.get("cpus", {}).get("load", [])),
+                CPU_Load="%, ".join(
+                    str(load) for load in data.get("cpus", {}).get("load", [])
+                ),
                 CPU_Times=cpu_times,
             )
         )
+        sys.stdout.flush()
 
 
 if __name__ == "__main__":
     print("Starting Terminal Monitor")
     sys.path.append("/app")
     args = docopt(__doc__, version="Argus Terminal Monitor 0.1")
-    monitor = TerminalMonitor(args)
+    if args["--all"]:
+        from HostsMonitor import HostsMonitor
+
+        monitor = HostsMonitor(args)
+    else:
+        monitor = TerminalMonitor(args)
     monitor.run()
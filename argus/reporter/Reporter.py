@@ -0,0 +1,330 @@
+"""
+    The Reporter sends heartbeats of the real CPUs of the host it runs on, read
+    with psutil, in place of Faker's made-up ones. It is meant to run on every host
+    being watched, so it does as little as it can:
+
+    - each sample is one read of the per-CPU times (/proc/stat on Linux), from which
+      both the load of each CPU (since the last sample) and the host's total times
+      are worked out, rather than a read for each
+    - samples are kept in a local buffer and sent together every
+      REPORTER_SEND_INTERVAL seconds, without waiting on the broker, so the producer
+      sends them as one request rather than making a round trip per sample. Each
+      message keeps the time its sample was taken as its Kafka timestamp.
+    - while Kafka can not be reached, up to REPORTER_BUFFER samples are kept and
+      sent once it can, the oldest being dropped (and counted) beyond that
+
+    Settings are read from environment variables:
+
+        REPORTER_INTERVAL       Seconds between samples (default 1)
+        REPORTER_SEND_INTERVAL  Seconds between sending the samples taken (default 10)
+        REPORTER_BUFFER         The most samples kept waiting to be sent
+                                    (default 3600)
+        REPORTER_DURATION       Seconds to run for (default 0, until stopped)
+        REPORTER_MEASURE        'true' logs the Reporter's own CPU use and memory
+                                    every REPORTER_MEASURE_INTERVAL seconds, and
+                                    keeps them in its metrics (default 'false')
+        REPORTER_MEASURE_INTERVAL  Seconds between those measurements (default 60)
+
+    Its own CPU use is given as a percentage of one core, so should stay well under
+    1% at a one second interval.
+
+    >>> from argus.common.MemoryKafka import MemoryBroker, MemoryKafkaConnection
+    >>> broker = MemoryBroker(partitions=2)
+    >>> reporter = Reporter(
+    ...     kafka_connection=lambda app: MemoryKafkaConnection(app, broker))
+    >>> reporter.log_level = LogLevel.CRITICAL
+    >>> reporter.settings.update(interval=0.05, send_interval=0.2, duration=0.5,
+    ...                          measure=True)
+    >>> report = reporter.run()
+    >>> report["sampled"] == report["delivered"] == sum(broker.end_offsets()) > 0
+    True
+    >>> sorted(report["overhead"])
+    ['cpu_percent', 'max_rss_kib']
+    >>> reader = MemoryKafkaConnection(None, broker, client_id="reader")
+    >>> reader.start_consumer()
+    >>> messages = reader.fetch()
+    >>> heartbeat = schema.compiled_colander_set()["heartbeat"]
+    >>> data = heartbeat.deserialize(reader.decode(messages[0])["data"])
+    >>> len(data["cpus"]["load"]) == psutil.cpu_count()
+    True
+    >>> timestamps = sorted(message.timestamp for message in messages)
+    >>> timestamps[-1] - timestamps[0] >= 300
+    True
+"""
+
+from argus.common.Common import CommonAppFramework, LogLevel, settings_from_environment
+from argus.common.data import schema
+from argus.common.KafkaConnection import KafkaConnection
+
+from collections import deque
+from datetime import datetime
+from time import monotonic, sleep, time
+import psutil
+import resource
+import signal
+import sys
+import threading
+
+environment_variable_map = {
+    "interval": "REPORTER_INTERVAL",
+    "send_interval": "REPORTER_SEND_INTERVAL",
+    "buffer": "REPORTER_BUFFER",
+    "duration": "REPORTER_DURATION",
+    "measure": "REPORTER_MEASURE",
+    "measure_interval": "REPORTER_MEASURE_INTERVAL",
+}
+
+environment_variable_defaults = {
+    "interval": 1.0,
+    "send_interval": 10.0,
+    "buffer": 3600,
+    "duration": 0.0,
+    "measure": False,
+    "measure_interval": 60.0,
+}
+
+CPU_TIME_FIELDS = [child.name for child in schema.CPUTimes().children]
+
+
+class CPUSampler:
+    """
+    Reads the per-CPU times once per sample, and returns the load of each CPU since
+    the last sample along with the host's total times.
+    """
+
+    def __init__(self):
+        self.previous = psutil.cpu_times(percpu=True)
+
+    def sample(self):
+        """
+        Returns the cpus part of a heartbeat: {"load": [...], "times": {...}}.
+        """
+        current = psutil.cpu_times(percpu=True)
+        loads = [
+            _busy_percent(before, after)
+            for before, after in zip(self.previous, current)
+        ]
+        self.previous = current
+        times = {}
+        for field in CPU_TIME_FIELDS:
+            # not every platform has every time, which are then reported as 0
+            times[field] = round(sum(getattr(cpu, field, 0.0) for cpu in current), 2)
+        return {"load": loads, "times": times}
+
+
+def _busy_percent(before, after):
+    """
+    The percentage of the time between two readings of one CPU's times that it was
+    busy, worked out as psutil.cpu_percent() does.
+    """
+    total = _total_time(after) - _total_time(before)
+    if total <= 0:
+        return 0
+    idle = (after.idle + getattr(after, "iowait", 0.0)) - (
+        before.idle + getattr(before, "iowait", 0.0)
+    )
+    return min(100, max(0, round(100 * (total - idle) / total)))
+
+
+def _total_time(times):
+    # on Linux guest time is also counted in user (and guest_nice in nice)
+    return (
+        sum(times)
+        - getattr(times, "guest", 0.0)
+        - getattr(times, "guest_nice", 0.0)
+    )
+
+
+class Reporter(CommonAppFramework):
+    def __init__(self, kafka_connection=KafkaConnection):
+        """
+        'kafka_connection' is called with the application to build the Kafka
+        connection, and can be replaced by a stand-in for testing.
+        """
+        super().__init__()
+        self.settings = settings_from_environment(
+            environment_variable_map, environment_variable_defaults
+        )
+        self.kafka = kafka_connection(self)
+        # samples are sent together, so need not wait for the broker one at a time
+        self.kafka.env["send_mode"] = "async"
+        self.schema = schema.compiled_colander_set()
+        self.sampler = CPUSampler()
+        self.process = psutil.Process()
+        # (Kafka timestamp, heartbeat) pairs waiting to be sent, oldest first
+        self.buffer = deque()
+        self._buffer_lock = threading.Lock()
+        self.running = False
+        self.messages = self.metrics.counter(
+            "reporter_messages_total",
+            "Samples taken, delivered, failed (and kept to send again) and dropped.",
+            ["outcome"],
+        )
+        self.buffered = self.metrics.gauge(
+            "reporter_buffered_samples", "Samples waiting to be sent."
+        )
+        self.cpu_percent = self.metrics.gauge(
+            "reporter_cpu_percent",
+            "The Reporter's own CPU use, as a percentage of one core.",
+        )
+        self.rss = self.metrics.gauge(
+            "reporter_max_rss_kib", "The Reporter's largest resident set, in KiB."
+        )
+        self.counts = {"sampled": 0, "delivered": 0, "failed": 0, "dropped": 0}
+
+    def run(self):
+        """
+        Samples the CPUs every REPORTER_INTERVAL seconds until stopped (or for
+        REPORTER_DURATION seconds), sending them every REPORTER_SEND_INTERVAL.
+        Returns a report of the samples sent and the Reporter's own overhead.
+        """
+        self.metrics.start()
+        self.kafka.start_producer()
+        self.running = True
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+        interval = self.settings["interval"]
+        duration = self.settings["duration"]
+        self.log(
+            "Reporting {} CPU(s) every {}s".format(psutil.cpu_count(), interval),
+            LogLevel.INFO,
+        )
+        start = monotonic()
+        usage = self._usage()
+        measured = (start, usage)
+        next_sample = start + interval
+        next_send = start + self.settings["send_interval"]
+        while self.running:
+            now = monotonic()
+            if duration > 0 and now - start >= duration:
+                break
+            if now >= next_sample:
+                self.take_sample()
+                # keep to the schedule, skipping samples missed rather than bunching
+                next_sample += max(1, int((now - next_sample) / interval) + 1) * interval
+            if now >= next_send:
+                self.send_samples()
+                next_send = now + self.settings["send_interval"]
+            if self.settings["measure"] and (
+                now - measured[0] >= self.settings["measure_interval"]
+            ):
+                measured = self._measure(measured)
+            self.metrics.publish()
+            sleep(max(0, min(next_sample, next_send) - monotonic()))
+        self.send_samples()
+        self.kafka.close()
+        overhead = self._overhead((start, usage))
+        report = dict(self.counts, seconds=monotonic() - start, overhead=overhead)
+        self.log(
+            "Sampled {sampled}, delivered {delivered}, failed {failed}, dropped "
+            "{dropped}".format(**report),
+            LogLevel.INFO,
+        )
+        self._log_overhead(overhead, report["seconds"])
+        self.metrics.stop()
+        sys.stdout.flush()
+        return report
+
+    def stop(self, *args):
+        """
+        Asks a running Reporter to send what it has and finish. Also used as the
+        SIGTERM handler.
+        """
+        self.running = False
+
+    def take_sample(self):
+        """
+        Samples the CPUs and adds the heartbeat to the buffer.
+        """
+        timestamp = int(time() * 1000)
+        data = self.schema["heartbeat"].serialize(
+            {"timestamp": datetime.now(), "cpus": self.sampler.sample()}
+        )
+        self.counts["sampled"] += 1
+        self.messages.inc(labels=("sampled",))
+        self._keep([(timestamp, data)])
+
+    def send_samples(self):
+        """
+        Sends every buffered sample without waiting for the broker. Samples that
+        fail are put back in the buffer, to go with the next send.
+        """
+        with self._buffer_lock:
+            samples = list(self.buffer)
+            self.buffer.clear()
+        for timestamp, data in samples:
+            self.kafka.send(
+                "heartbeat",
+                data,
+                on_delivery=lambda metadata, exception, sample=(timestamp, data): (
+                    self._delivered(sample, exception)
+                ),
+                timestamp_ms=timestamp,
+            )
+        self.buffered.set(len(self.buffer))
+        if len(samples) > 0:
+            self.log("Sent {} sample(s)", LogLevel.DEBUG, len(samples))
+
+    def _delivered(self, sample, exception):
+        """
+        Delivery callback, called on the producer's thread.
+        """
+        if exception is None:
+            self.counts["delivered"] += 1
+            self.messages.inc(labels=("delivered",))
+            return
+        self.counts["failed"] += 1
+        self.messages.inc(labels=("failed",))
+        self._keep([sample])
+
+    def _keep(self, samples):
+        """
+        Adds 'samples' to the buffer in time order, dropping the oldest beyond
+        REPORTER_BUFFER.
+        """
+        with self._buffer_lock:
+            self.buffer.extend(samples)
+            if samples[0][0] < self.buffer[-1][0]:
+                # a sample sent again is older than those taken since
+                self.buffer = deque(sorted(self.buffer, key=lambda sample: sample[0]))
+            dropped = len(self.buffer) - max(1, self.settings["buffer"])
+            for _ in range(dropped):
+                self.buffer.popleft()
+        if dropped > 0:
+            self.counts["dropped"] += dropped
+            self.messages.inc(dropped, ("dropped",))
+            self.log(
+                "The buffer is full, dropped {} sample(s)", LogLevel.WARNING, dropped
+            )
+
+    def _usage(self):
+        times = self.process.cpu_times()
+        return times.user + times.system
+
+    def _overhead(self, since):
+        """
+        Returns the CPU use (as a percentage of one core) since 'since', a
+        (monotonic time, CPU seconds used) pair, and the largest resident set.
+        """
+        started, usage = since
+        elapsed = monotonic() - started
+        return {
+            "cpu_percent": 100 * (self._usage() - usage) / elapsed if elapsed > 0 else 0,
+            "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+    def _measure(self, since):
+        overhead = self._overhead(since)
+        self.cpu_percent.set(overhead["cpu_percent"])
+        self.rss.set(overhead["max_rss_kib"])
+        self._log_overhead(overhead, monotonic() - since[0])
+        return monotonic(), self._usage()
+
+    def _log_overhead(self, overhead, seconds):
+        self.log(
+            "Overhead over {:.0f}s: {:.3f}% of a CPU, {:.1f} MiB max resident",
+            LogLevel.INFO,
+            seconds,
+            overhead["cpu_percent"],
+            overhead["max_rss_kib"] / 1024,
+        )
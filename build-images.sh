@@ -9,6 +9,8 @@ cd argus
 build common
 build caterpillar
 build faker
+build reporter
+build janitor
 
 cd presenter
 build terminal